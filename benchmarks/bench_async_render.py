@@ -0,0 +1,96 @@
+"""
+Compare the time needed to generate a directory of templates calling a slow lookup (e.g., a query to a service),
+with template_directory and a blocking lookup, and with AsyncRenderer and a coroutine lookup, at different
+concurrency levels.
+
+Usage:
+
+    python benchmarks/bench_async_render.py [--files 200] [--latency-ms 5] [--repeat 3]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+from template_formatter.AppContext import AppContext
+from template_formatter.AsyncRenderer import AsyncRenderer
+from template_formatter.main import apply_defaults, add_commons, add_functions, create_formatter, template_directory
+
+
+def generate_tree(root: str, files: int):
+    os.makedirs(root)
+    for i in range(files):
+        with open(os.path.join(root, f"file{i}.txt.template"), "w") as f:
+            f.write("{% for i in range(3) %}{{ lookup(i) }} {{ model.name }}\n{% endfor %}")
+
+
+def create_app_context() -> AppContext:
+    app_context = add_functions(add_commons(apply_defaults(AppContext())))
+    app_context.model.values.set_field("name", "Pluto")
+    return app_context
+
+
+def run_sync(input_dir: str, output_dir: str, latency: float):
+    app_context = create_app_context()
+
+    def lookup(key):
+        time.sleep(latency)
+        return key
+
+    app_context.model.functions["lookup"] = lookup
+    template_directory(app_context, input_dir, output_dir, create_formatter("jinja2"))
+
+
+def run_async(input_dir: str, output_dir: str, latency: float, concurrency: int):
+    app_context = create_app_context()
+
+    async def lookup(key):
+        await asyncio.sleep(latency)
+        return key
+
+    app_context.model.functions["lookup"] = lookup
+
+    async def run():
+        async with AsyncRenderer(app_context, concurrency=concurrency) as renderer:
+            await renderer.template_directory(input_dir, output_dir)
+
+    asyncio.run(run())
+
+
+def measure(function, output_dir: str, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        shutil.rmtree(output_dir, ignore_errors=True)
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--repeat", type=int, default=3)
+    options = parser.parse_args()
+
+    latency = options.latency_ms / 1000
+    with tempfile.TemporaryDirectory() as tmp:
+        input_dir = os.path.join(tmp, "input")
+        output_dir = os.path.join(tmp, "output")
+        generate_tree(input_dir, options.files)
+        cases = [("template_directory", lambda: run_sync(input_dir, output_dir, latency))]
+        for concurrency in (1, 16, 64):
+            cases.append((f"AsyncRenderer, {concurrency} at once", lambda c=concurrency: run_async(input_dir, output_dir, latency, c)))
+        baseline = None
+        for name, function in cases:
+            seconds = measure(function, output_dir, options.repeat)
+            baseline = baseline or seconds
+            print(f"{name:28} {seconds * 1000:10.1f}ms ({baseline / seconds:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Compare the time needed to load a big generated configuration file with the toml package (the previous parser),
+with tomllib (python 3.11+) and from the parsed configuration cache (see ConfigCache, used when --cacheDir is set).
+
+Usage:
+
+    python benchmarks/bench_config_loading.py [--values 200000]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from template_formatter.AppContext import AppContext
+from template_formatter.ConfigCache import ConfigCache, parse_toml, get_toml_parser_name
+from template_formatter.main import update_using_config
+
+
+def generate_config(path: str, values: int):
+    tables = max(1, values // 50)
+    with open(path, "w") as f:
+        f.write("[values]\nname = \"Pluto\"\n\n")
+        for t in range(tables):
+            f.write(f"[values.group{t}]\n")
+            for k in range(values // tables):
+                f.write(f"key{k} = \"value {t} {k}\"\nnumber{k} = {k}\n")
+            f.write("\n")
+
+
+def measure(function) -> float:
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--values", type=int, default=200000)
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "config.toml")
+        generate_config(path, options.values)
+        with open(path, "rb") as f:
+            content = f.read()
+        print(f"config size: {len(content) / 2 ** 20:.1f}MB")
+
+        import toml
+        legacy = measure(lambda: toml.loads(content.decode("utf-8")))
+        print(f"toml package:        {legacy:.3f}s")
+        if get_toml_parser_name() == "tomllib":
+            current = measure(lambda: parse_toml(content))
+            print(f"tomllib:             {current:.3f}s ({legacy / current:.1f}x)")
+
+        cache_dir = os.path.join(tmp, "cache")
+        cold = measure(lambda: ConfigCache(cache_dir).load(path, get_toml_parser_name(), parse_toml))
+        warm = measure(lambda: ConfigCache(cache_dir).load(path, get_toml_parser_name(), parse_toml))
+        print(f"cache (cold/warm):   {cold:.3f}s / {warm:.3f}s ({legacy / warm:.1f}x)")
+
+        def load_config():
+            app_context = AppContext()
+            app_context.cache_dir = cache_dir
+            update_using_config(app_context, path)
+
+        print(f"update_using_config: {measure(load_config):.3f}s (cached)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Compare the time needed to walk a big input directory (without templating or copying anything) with the os.walk loop
+previously used by template_directory and with DirectoryWalker, with and without pruning a node_modules directory
+containing half of the entries.
+
+Usage:
+
+    python benchmarks/bench_directory_walk.py [--entries 200000] [--repeat 3]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from template_formatter.DirectoryWalker import DirectoryWalker
+
+TRAILING_STRING = ".template"
+
+
+def generate_tree(root: str, entries: int):
+    # half of the entries are in node_modules, 20 files per directory
+    for i in range(entries // 21):
+        parent = "node_modules" if i % 2 == 0 else "src"
+        dir_path = os.path.join(root, parent, f"package{i // 100}", f"module{i}")
+        os.makedirs(dir_path)
+        for j in range(20):
+            name = f"file{j}.txt.template" if j % 4 == 0 else f"file{j}.txt"
+            open(os.path.join(dir_path, name), "w").close()
+
+
+def walk_with_os_walk(root: str) -> int:
+    # the loop of the previous implementation of template_directory
+    result = 0
+    output_dirs = {os.path.abspath(root): "output"}
+    for dir_path, folders, filenames in os.walk(root):
+        output_dir_path = output_dirs[os.path.abspath(dir_path)]
+        for folder_name in folders:
+            output_dirs[os.path.abspath(os.path.join(dir_path, folder_name))] = os.path.abspath(os.path.join(output_dir_path, folder_name))
+        for f in filenames:
+            file_to_copy = os.path.join(dir_path, f)
+            if file_to_copy.endswith(TRAILING_STRING):
+                os.path.basename(file_to_copy)[:-len(TRAILING_STRING)]
+            result += 1
+    return result
+
+
+def walk_with_walker(root: str, excludes=None) -> int:
+    result = 0
+    output_dirs = {root: "output"}
+    for dir_path, folders, files in DirectoryWalker(root, excludes=excludes).walk():
+        output_dir_path = output_dirs.pop(dir_path)
+        for entry in folders:
+            output_dirs[entry.path] = os.path.abspath(os.path.join(output_dir_path, entry.name))
+        for entry in files:
+            if entry.name.endswith(TRAILING_STRING):
+                entry.name[:-len(TRAILING_STRING)]
+            result += 1
+    return result
+
+
+def measure(function, repeat: int):
+    best = None
+    files = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        files = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, files
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=3)
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        generate_tree(tmp, options.entries)
+        cases = [
+            ("os.walk", lambda: walk_with_os_walk(tmp)),
+            ("DirectoryWalker", lambda: walk_with_walker(tmp)),
+            ("DirectoryWalker, exclude", lambda: walk_with_walker(tmp, excludes=["node_modules/"])),
+        ]
+        baseline = None
+        for name, function in cases:
+            seconds, files = measure(function, options.repeat)
+            baseline = baseline or seconds
+            print(f"{name:28} {seconds * 1000:10.1f}ms {files:8} files ({baseline / seconds:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Compare the memory used by the model and the time needed to look up its values, between the current DynamicObject
+and the previous implementation (LegacyDynamicObject, copied below), which created a node on every read miss.
+
+Usage:
+
+    python benchmarks/bench_dynamic_object.py [--groups 1000] [--items 100]
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+from template_formatter.Jinja2Model import DynamicObject
+
+
+class LegacyDynamicObject(object):
+
+    _slots = "_dictionary", "_list", "_value"
+
+    def __init__(self):
+        self._dictionary: Optional[Dict[str, Any]] = None
+        self._list: Optional[List[Any]] = None
+        self._value: Any = None
+
+    def __getattr__(self, item: str) -> Any:
+        if item in self._slots:
+            return self.__dict__[item]
+        elif item in '__len__':
+            return self.__len__
+        else:
+            if self._dictionary is None:
+                self._dictionary = {}
+            if item not in self._dictionary:
+                self._dictionary[item] = LegacyDynamicObject()
+            return self._dictionary[item]
+
+    def set_value(self, v: Any):
+        self._value = v
+
+
+def build_legacy(groups: int, items: int) -> LegacyDynamicObject:
+    root = LegacyDynamicObject()
+    for g in range(groups):
+        group = getattr(root, f"group{g}")
+        for i in range(items):
+            getattr(group, f"item{i}").set_value(i)
+    return root
+
+
+def build_current(groups: int, items: int) -> DynamicObject:
+    root = DynamicObject()
+    for g in range(groups):
+        group = root.get_or_create_field(f"group{g}")
+        for i in range(items):
+            group.get_or_create_field(f"item{i}").set_value(i)
+    return root
+
+
+def measure_memory(build: Callable[[], Any]) -> int:
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def measure_growth(root: Any, groups: int, items: int) -> int:
+    """
+    :return: the memory allocated while looking up keys that are not in the model
+    """
+    gc.collect()
+    tracemalloc.start()
+    measure_lookups(root, groups, items, True)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size
+
+
+def measure_lookups(root: Any, groups: int, items: int, missing: bool) -> float:
+    names = [(f"group{g}", f"{'missing' if missing else 'item'}{i}") for g in range(groups) for i in range(items)]
+    start = time.perf_counter()
+    for group, item in names:
+        getattr(getattr(root, group), item)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--groups", type=int, default=1000)
+    parser.add_argument("--items", type=int, default=100)
+    options = parser.parse_args()
+    groups, items = options.groups, options.items
+
+    legacy_memory = measure_memory(lambda: build_legacy(groups, items))
+    current_memory = measure_memory(lambda: build_current(groups, items))
+    legacy = build_legacy(groups, items)
+    current = build_current(groups, items)
+    legacy_hits = measure_lookups(legacy, groups, items, False)
+    current_hits = measure_lookups(current, groups, items, False)
+    legacy_misses = measure_lookups(legacy, groups, items, True)
+    current_misses = measure_lookups(current, groups, items, True)
+    legacy_after_misses = measure_growth(build_legacy(groups, items), groups, items)
+    current_after_misses = measure_growth(build_current(groups, items), groups, items)
+
+    print(f"nodes:                     {groups * (items + 1)}")
+    print(f"memory (legacy/current):   {legacy_memory / 2 ** 20:.1f}MB / {current_memory / 2 ** 20:.1f}MB")
+    print(f"hits (legacy/current):     {legacy_hits:.3f}s / {current_hits:.3f}s")
+    print(f"misses (legacy/current):   {legacy_misses:.3f}s / {current_misses:.3f}s")
+    print(f"growth after misses (legacy/current): {legacy_after_misses / 2 ** 20:.1f}MB / {current_after_misses / 2 ** 20:.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
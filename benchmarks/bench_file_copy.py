@@ -0,0 +1,81 @@
+"""
+Compare the strategies used by template_directory to copy the files which are not templates (see FileCopier), on a
+tree of large binary files. Each strategy copies the tree in a new output directory; the skip identical modes copy
+it again in an output directory already up to date.
+
+Usage:
+
+    python benchmarks/bench_file_copy.py [--files 20] [--size-mb 16] [--repeat 3]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from template_formatter.FileCopier import FileCopier, COPY_MODES
+
+
+def generate_tree(root: str, files: int, size: int):
+    block = os.urandom(1024 * 1024)
+    for i in range(files):
+        dir_path = os.path.join(root, f"assets{i % 4}")
+        os.makedirs(dir_path, exist_ok=True)
+        with open(os.path.join(dir_path, f"blob_{i}.bin"), "wb") as f:
+            for _ in range(size // len(block)):
+                f.write(block)
+            f.write(os.urandom(size % len(block)))
+
+
+def copy_tree(copier: FileCopier, input_dir: str, output_dir: str) -> set:
+    """
+    :return: the strategies used
+    """
+    result = set()
+    for dir_path, _, filenames in os.walk(input_dir):
+        output_dir_path = os.path.join(output_dir, os.path.relpath(dir_path, input_dir))
+        os.makedirs(output_dir_path, exist_ok=True)
+        for f in filenames:
+            result.add(copier.copy(os.path.join(dir_path, f), os.path.join(output_dir_path, f)))
+    return result
+
+
+def measure(copier: FileCopier, input_dir: str, output_dir: str, repeat: int, fresh: bool):
+    best = None
+    strategies = set()
+    for _ in range(repeat):
+        if fresh:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        start = time.perf_counter()
+        strategies = copy_tree(copier, input_dir, output_dir)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, strategies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--size-mb", type=float, default=16)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--directory", type=str, default=None, help="where to generate the tree. Default to a temporary directory")
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=options.directory) as tmp:
+        input_dir = os.path.join(tmp, "input")
+        generate_tree(input_dir, options.files, int(options.size_mb * 1024 * 1024))
+        print(f"{options.files} files of {options.size_mb}MB")
+
+        for mode in COPY_MODES:
+            seconds, strategies = measure(FileCopier(mode), input_dir, os.path.join(tmp, mode), options.repeat, fresh=True)
+            print(f"{mode:20} {seconds * 1000:10.1f}ms (used {', '.join(sorted(strategies))})")
+        for skip_identical in ("mtime", "hash"):
+            output_dir = os.path.join(tmp, f"skip-{skip_identical}")
+            copier = FileCopier(skip_identical=skip_identical)
+            copy_tree(copier, input_dir, output_dir)
+            seconds, strategies = measure(copier, input_dir, output_dir, options.repeat, fresh=False)
+            print(f"{'skip ' + skip_identical:20} {seconds * 1000:10.1f}ms (used {', '.join(sorted(strategies))})")
+
+
+if __name__ == "__main__":
+    main()
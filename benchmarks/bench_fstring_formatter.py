@@ -0,0 +1,97 @@
+"""
+Compare the time needed to template a generated directory in the fstring format with the previous FStringFormatter
+(LegacyFStringFormatter, copied below), which compiled the f-string at every render, against the current one,
+which compiles each template once.
+
+Usage:
+
+    python benchmarks/bench_fstring_formatter.py [--directories 100] [--files 50]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from typing import Dict, Any, Callable, Optional
+
+from template_formatter.AppContext import AppContext
+from template_formatter.FStringFormatter import FStringFormatter
+from template_formatter.ITemplateFormatter import ITemplateFormatter
+from template_formatter.main import apply_defaults, add_commons, add_functions, template_directory
+
+
+class LegacyFStringFormatter(ITemplateFormatter):
+
+    def __init__(self):
+        self.__template_string: Optional[str] = None
+
+    def init_string(self, string: str, app_context: "AppContext"):
+        self.__template_string = string
+
+    def init_file(self, f: str, encoding: str, app_context: "AppContext"):
+        with open(f, "r", encoding=encoding) as handle:
+            self.__template_string = handle.read().strip()
+
+    def render_template(self, model: Dict[str, Any], commons: Dict[str, Any], functions: Dict[str, Callable]) -> str:
+        global_dict = dict()
+        global_dict["model"] = model
+        global_dict["commons"] = commons
+        global_dict["functions"] = functions
+        for k, v in functions.items():
+            global_dict[k] = v
+        result = eval("f\"\"\"" + self.__template_string + "\"\"\"", global_dict, {})
+        return result.strip('\'\"')
+
+    def reset(self):
+        self.__template_string = None
+
+
+def generate_tree(root: str, directories: int, files: int):
+    for d in range(directories):
+        dir_path = os.path.join(root, f"module{d}")
+        os.makedirs(dir_path)
+        for f in range(files):
+            # file names repeat in every directory, like in a real scaffold
+            with open(os.path.join(dir_path, f"{{model.name}}_{f}.txt.template"), "w") as fw:
+                fw.write("'Hello {model.name}!\n" + "".join(f"{{model.age + {i}}} " for i in range(20)) + "\n'")
+
+
+def build_app_context() -> AppContext:
+    app_context = apply_defaults(AppContext())
+    app_context.format = "fstring"
+    app_context.model.values.set_field("name", "Pluto")
+    app_context.model.values.set_field("age", 10)
+    app_context = add_commons(app_context)
+    return add_functions(app_context)
+
+
+def run(input_dir: str, output_dir: str, formatter: ITemplateFormatter) -> float:
+    shutil.rmtree(output_dir, ignore_errors=True)
+    start = time.perf_counter()
+    template_directory(build_app_context(), input_dir, output_dir, formatter)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--directories", type=int, default=100)
+    parser.add_argument("--files", type=int, default=50)
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        input_dir = os.path.join(tmp, "input")
+        output_dir = os.path.join(tmp, "output")
+        generate_tree(input_dir, options.directories, options.files)
+
+        # a render for the name and one for the content of each file
+        renders = 2 * options.directories * options.files
+        legacy = run(input_dir, output_dir, LegacyFStringFormatter())
+        current = run(input_dir, output_dir, FStringFormatter())
+        print(f"renders:           {renders}")
+        print(f"legacy formatter:  {legacy:.3f}s ({legacy / renders * 1e6:.1f}us per render)")
+        print(f"current formatter: {current:.3f}s ({current / renders * 1e6:.1f}us per render)")
+        print(f"speedup:           {legacy / current:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
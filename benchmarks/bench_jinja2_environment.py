@@ -0,0 +1,96 @@
+"""
+Compare the time needed to template a generated directory with a fresh jinja2 environment per template
+against the persistent environment (with its compiled template cache):
+ - once: every template is compiled, since the templates are distinct files;
+ - again: the same directory is templated --rounds times by the same formatter, like a watcher or a build system
+   calling a long running process would do;
+ - server: --requests requests rendering the same few templates, handled by a new RenderServer each (like one shot
+   runs of the program) and by the same RenderServer.
+
+Usage:
+
+    python benchmarks/bench_jinja2_environment.py [--directories 100] [--files 50] [--rounds 5] [--requests 2000]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from typing import List
+
+from template_formatter.AppContext import AppContext
+from template_formatter.Jinja2Formatter import Jinja2Formatter
+from template_formatter.RenderServer import RenderServer
+from template_formatter.main import apply_defaults, add_commons, add_functions, template_directory
+
+
+def generate_tree(root: str, directories: int, files: int):
+    for d in range(directories):
+        dir_path = os.path.join(root, f"module{d}")
+        os.makedirs(dir_path)
+        for f in range(files):
+            # file names repeat in every directory, like in a real scaffold
+            with open(os.path.join(dir_path, f"{{{{ model.name }}}}_{f}.txt.template"), "w") as fw:
+                fw.write("Hello {{ model.name }}!\n{% for i in range(model.age) %}{{ i }} {% endfor %}\n")
+
+
+def build_app_context() -> AppContext:
+    app_context = apply_defaults(AppContext())
+    app_context.model.values.set_field("name", "Pluto")
+    app_context.model.values.set_field("age", 10)
+    app_context = add_commons(app_context)
+    return add_functions(app_context)
+
+
+def run(input_dir: str, output_dir: str, formatter: Jinja2Formatter, rounds: int = 1) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        shutil.rmtree(output_dir, ignore_errors=True)
+        template_directory(build_app_context(), input_dir, output_dir, formatter)
+    return time.perf_counter() - start
+
+
+def run_requests(config_file: str, template_files: List[str], requests: int, shared_server: bool) -> float:
+    server = RenderServer()
+    start = time.perf_counter()
+    for i in range(requests):
+        if not shared_server:
+            server = RenderServer()
+        response = server.handle({"config_file": config_file, "template_file": template_files[i % len(template_files)], "write_on_stdout": True})
+        if "error" in response:
+            raise ValueError(response["error"])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--directories", type=int, default=100)
+    parser.add_argument("--files", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--requests", type=int, default=2000)
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        input_dir = os.path.join(tmp, "input")
+        output_dir = os.path.join(tmp, "output")
+        generate_tree(input_dir, options.directories, options.files)
+        config_file = os.path.join(tmp, "config.toml")
+        with open(config_file, "w") as f:
+            f.write('[values]\nname = "Pluto"\nage = 10\n')
+
+        print(f"templates: {options.directories * options.files}")
+        template_files = [os.path.join(input_dir, "module0", f"{{{{ model.name }}}}_{f}.txt.template") for f in range(min(options.files, 10))]
+        cases = [
+            ("once", lambda: run(input_dir, output_dir, Jinja2Formatter()), lambda: run(input_dir, output_dir, Jinja2Formatter(persistent_environment=True))),
+            (f"again x{options.rounds}", lambda: run(input_dir, output_dir, Jinja2Formatter(), options.rounds), lambda: run(input_dir, output_dir, Jinja2Formatter(persistent_environment=True), options.rounds)),
+            (f"server x{options.requests}", lambda: run_requests(config_file, template_files, options.requests, False), lambda: run_requests(config_file, template_files, options.requests, True)),
+        ]
+        print(f"{'case':16} {'fresh':>10} {'persistent':>12} {'speedup':>8}")
+        for name, fresh_case, persistent_case in cases:
+            fresh = fresh_case()
+            persistent = persistent_case()
+            print(f"{name:16} {fresh:9.3f}s {persistent:11.3f}s {fresh / persistent:7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Compare the time needed to render the same "format" template many times (like the batch and directory modes do)
+with the previous PythonFormatFormatter (LegacyPythonFormatFormatter, copied below), which called str.format with
+every function as keyword argument, against the current one, which parses each template once.
+
+Usage:
+
+    python benchmarks/bench_python_format_formatter.py [--renders 100000]
+"""
+import argparse
+import time
+import types
+from typing import Optional, Dict, Any, Callable
+
+from template_formatter.AppContext import AppContext
+from template_formatter.ITemplateFormatter import ITemplateFormatter
+from template_formatter.PythonFormatFormatter import PythonFormatFormatter
+from template_formatter.main import apply_defaults, add_commons, add_functions, template_string
+
+TEMPLATE = "server {model.name}:{model.port} # {model.tenant[name]!r:>20} {math.pi:.3f} " * 4
+
+
+class LegacyPythonFormatFormatter(ITemplateFormatter):
+
+    def __init__(self):
+        self.__template_string: Optional[str] = None
+
+    def init_string(self, string: str, app_context: "AppContext"):
+        self.__template_string = string
+
+    def init_file(self, f: str, encoding: str, app_context: "AppContext"):
+        with open(f, "r", encoding=encoding) as handle:
+            self.__template_string = handle.read().strip()
+
+    def render_template(self, model: Dict[str, Any], commons: Dict[str, Any], functions: Dict[str, Callable]) -> str:
+        global_dict = dict()
+        global_dict["model"] = model
+        global_dict["commons"] = commons
+        global_dict["functions"] = functions
+        for k, v in functions.items():
+            global_dict[k] = v
+        return self.__template_string.format(**global_dict)
+
+    def reset(self):
+        self.__template_string = None
+
+
+def build_app_context() -> AppContext:
+    app_context = apply_defaults(AppContext())
+    app_context.model.values.set_fields({"name": "Pluto", "port": 8080, "tenant": {"name": "acme"}})
+    app_context = add_commons(app_context)
+    return add_functions(app_context)
+
+
+def run(formatter: ITemplateFormatter, renders: int, model: Any) -> float:
+    app_context = build_app_context()
+    app_context.model.values = model
+    start = time.perf_counter()
+    for _ in range(renders):
+        template_string(app_context, TEMPLATE, formatter)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--renders", type=int, default=100000)
+    options = parser.parse_args()
+
+    legacy_formatter, current_formatter = LegacyPythonFormatFormatter(), PythonFormatFormatter()
+    app_context = build_app_context()
+    assert template_string(app_context, TEMPLATE, legacy_formatter) == template_string(app_context, TEMPLATE, current_formatter)
+
+    # the lookups in the model cost the same with both formatters: a plain object shows the cost of the formatter alone
+    plain_model = types.SimpleNamespace(name="Pluto", port=8080, tenant={"name": "acme"})
+    print(f"renders: {options.renders}")
+    for name, model in (("model", app_context.model.values), ("plain object", plain_model)):
+        legacy = run(legacy_formatter, options.renders, model)
+        current = run(current_formatter, options.renders, model)
+        print(f"{name}:")
+        print(f"    legacy formatter:  {legacy:.3f}s ({legacy / options.renders * 1e6:.1f}us per render)")
+        print(f"    current formatter: {current:.3f}s ({current / options.renders * 1e6:.1f}us per render)")
+        print(f"    speedup:           {legacy / current:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
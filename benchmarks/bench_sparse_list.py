@@ -0,0 +1,77 @@
+"""
+Compare the time and the memory needed to build indexed values of the model (like --value rows[i].x v does)
+between the current SparseList and the previous implementation, which appended a node for each missing index.
+
+Usage:
+
+    python benchmarks/bench_sparse_list.py [--items 100000]
+"""
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+from typing import Callable, Iterable, Tuple
+
+from template_formatter.Jinja2Model import DynamicObject
+
+
+def legacy_set_item(node: DynamicObject, index: int, value: str):
+    # the previous DynamicObject.__getitem__, followed by set_value
+    if node._list is None:
+        node._list = []
+    while True:
+        if 0 <= index < len(node._list):
+            break
+        node._list.append(DynamicObject())
+    node._list[index].get_or_create_field("x").set_value(value)
+
+
+def current_set_item(node: DynamicObject, index: int, value: str):
+    node.get_or_create_item(index).get_or_create_field("x").set_value(value)
+
+
+def measure(set_item: Callable[[DynamicObject, int, str], None], indices: Iterable[int]) -> Tuple[float, int]:
+    def build() -> DynamicObject:
+        root = DynamicObject()
+        rows = root.get_or_create_field("rows")
+        for i in indices:
+            set_item(rows, i, "v")
+        return root
+
+    gc.collect()
+    start = time.perf_counter()
+    build()
+    elapsed = time.perf_counter() - start
+    # tracemalloc slows down the program: measure the memory on another run
+    gc.collect()
+    tracemalloc.start()
+    root = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=100000)
+    options = parser.parse_args()
+    n = options.items
+
+    shuffled = list(range(n))
+    random.Random(0).shuffle(shuffled)
+    scenarios = [
+        ("sequential writes", list(range(n))),
+        ("random writes", shuffled),
+        (f"single write at {n}", [n]),
+        (f"every 100th index", list(range(0, n, 100))),
+    ]
+    for name, indices in scenarios:
+        legacy_time, legacy_size = measure(legacy_set_item, indices)
+        current_time, current_size = measure(current_set_item, indices)
+        print(f"{name + ':':24} legacy {legacy_time:.3f}s {legacy_size / 2 ** 20:6.1f}MB, "
+              f"current {current_time:.3f}s {current_size / 2 ** 20:6.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
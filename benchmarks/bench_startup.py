@@ -0,0 +1,97 @@
+"""
+Measure how long the program takes to start, and check it against the budget in startup_budget.json.
+
+We measure:
+ - the time needed to import template_formatter.main, as reported by "python -X importtime" (median of several runs);
+ - the wall time of some cheap invocations of the program (median of several runs);
+ - the modules imported by template_formatter.main: the ones in "forbidden_modules" need to be imported lazily.
+
+The program exits with 1 if any budget is exceeded, so it can be used to catch regressions.
+
+Usage:
+
+    python benchmarks/bench_startup.py [--runs 15] [--budget benchmarks/startup_budget.json]
+"""
+import argparse
+import json
+import os
+import shlex
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_python(args: List[str]) -> subprocess.CompletedProcess:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    return subprocess.run([sys.executable] + args, env=env, cwd=ROOT, capture_output=True, text=True, check=True)
+
+
+def measure_import() -> Tuple[float, Dict[str, int]]:
+    """
+    :return: the cumulative time (in ms) needed to import template_formatter.main and the cumulative time (in us) of
+        every module imported
+    """
+    output = run_python(["-X", "importtime", "-c", "import template_formatter.main"]).stderr
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            modules[name.strip()] = int(cumulative.strip())
+    return modules["template_formatter.main"] / 1000, modules
+
+
+def measure_command(command: str) -> float:
+    """
+    :return: the wall time (in ms) of the given invocation of the program
+    """
+    start = time.perf_counter()
+    run_python(["-m", "template_formatter.main"] + shlex.split(command))
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=15)
+    parser.add_argument("--budget", type=str, default=os.path.join(ROOT, "benchmarks", "startup_budget.json"))
+    options = parser.parse_args()
+    with open(options.budget, "r", encoding="utf-8") as f:
+        budget = json.load(f)
+
+    failures = []
+    import_times = []
+    modules = {}
+    for _ in range(options.runs):
+        import_time, modules = measure_import()
+        import_times.append(import_time)
+    import_time = statistics.median(import_times)
+    print(f"import template_formatter.main: {import_time:.1f}ms (budget {budget['import_ms']}ms)")
+    if import_time > budget["import_ms"]:
+        failures.append(f"importing template_formatter.main takes {import_time:.1f}ms")
+    print("slowest modules:")
+    for name, cumulative in sorted(modules.items(), key=lambda x: -x[1])[:10]:
+        print(f"    {cumulative / 1000:7.1f}ms {name}")
+
+    for module in budget["forbidden_modules"]:
+        if module in modules:
+            failures.append(f"template_formatter.main imports {module}")
+
+    for command, command_budget in budget["commands"].items():
+        elapsed = statistics.median(measure_command(command) for _ in range(options.runs))
+        print(f"template-formatter {command}: {elapsed:.1f}ms (budget {command_budget}ms)")
+        if elapsed > command_budget:
+            failures.append(f"template-formatter {command} takes {elapsed:.1f}ms")
+
+    for failure in failures:
+        print(f"OVER BUDGET: {failure}")
+    sys.exit(1 if len(failures) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
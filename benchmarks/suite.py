@@ -0,0 +1,272 @@
+"""
+Benchmark suite of the hot paths of template_formatter:
+
+ - formatter/<format>/<size>: each formatter renders a small and a large template (via template_string);
+ - directory/<files>-<ratio>: template_directory on a generated tree of <files> files, where a fraction <ratio> of
+   them are templates (the other ones are copied);
+ - config/<values>: update_using_config on a generated TOML file with <values> values;
+ - command_line/<values>: a whole invocation of the program with <values> --value options.
+
+Each case is run --repeat times: a run calls the case enough times to last at least --min-time seconds. The results
+(median and best time per call, in seconds) are written as JSON on stdout or in --output.
+With --compare, the results are compared with a baseline (a file previously written with --output), using the best
+time of each case: the program exits with 1 if a case is slower than the baseline by more than --tolerance.
+
+Usage:
+
+    python benchmarks/suite.py [--quick] [--filter formatter/] [--output results.json]
+    python benchmarks/suite.py [--quick] --compare baseline.json [--tolerance 0.2]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from template_formatter import version
+from template_formatter.AppContext import AppContext
+from template_formatter.main import apply_defaults, add_commons, add_functions, create_formatter, main as cli_main, \
+    template_directory, template_string, update_using_config
+
+# template rendered by each formatter: a single line, and the same line repeated LARGE_LINES times
+LARGE_LINES = 500
+TEMPLATES = {
+    "jinja2": (
+        "Hello {{ model.name }}!",
+        "{{ model.name }}:{{ model.port }} {{ model.tenant.name }} {{ model.port + 1 }}\n" * LARGE_LINES,
+    ),
+    "format": (
+        "Hello {model.name}!",
+        "{model.name}:{model.port} {model.tenant[name]} {model.port:>6}\n" * LARGE_LINES,
+    ),
+    "fstring": (
+        "'Hello {model.name}!'",
+        "'" + "{model.name}:{model.port} {model.tenant['name']} {model.port + 1}\n" * LARGE_LINES + "'",
+    ),
+    "python": (
+        "print('Hello', model.name, end='!')",
+        f"for _ in range({LARGE_LINES}):\n    print(f'{{model.name}}:{{model.port}}', model.tenant['name'], model.port + 1)",
+    ),
+}
+
+
+class Case(object):
+    """
+    A function to measure.
+
+    :param name: name of the case, used in the results
+    :param function: function to measure
+    :param before: if present, called (without measuring it) before each call of function
+    """
+
+    def __init__(self, name: str, function: Callable[[], Any], before: Optional[Callable[[], Any]] = None):
+        self.name = name
+        self.function = function
+        self.before = before
+
+    def time_calls(self, number: int) -> float:
+        """
+        :return: the time (in seconds) needed to call the function number times
+        """
+        if self.before is None:
+            function = self.function
+            start = time.perf_counter()
+            for _ in range(number):
+                function()
+            return time.perf_counter() - start
+        result = 0.0
+        for _ in range(number):
+            self.before()
+            start = time.perf_counter()
+            self.function()
+            result += time.perf_counter() - start
+        return result
+
+    def measure(self, repeat: int, min_time: float) -> Dict[str, Any]:
+        # the first call fills the caches (e.g., compiled templates): it is not measured
+        self.time_calls(1)
+        number = 1
+        while True:
+            elapsed = self.time_calls(number)
+            if elapsed >= min_time or number >= 1000000:
+                break
+            number *= 10 if elapsed < min_time / 10 else 2
+        runs = [self.time_calls(number) / number for _ in range(repeat)]
+        return {
+            "seconds": statistics.median(runs),
+            "best": min(runs),
+            "calls_per_run": number,
+            "runs": runs,
+        }
+
+
+def build_app_context(format: str = "jinja2") -> AppContext:
+    app_context = apply_defaults(AppContext())
+    app_context.format = format
+    app_context.model.values.set_fields({"name": "Pluto", "port": 8080, "tenant": {"name": "acme"}})
+    app_context = add_commons(app_context)
+    return add_functions(app_context)
+
+
+def formatter_cases(tmp: str, quick: bool) -> List[Case]:
+    result = []
+    for format, (small, large) in TEMPLATES.items():
+        app_context = build_app_context(format)
+        formatter = create_formatter(format)
+        for size, template in (("small", small), ("large", large)):
+            result.append(Case(
+                f"formatter/{format}/{size}",
+                lambda app_context=app_context, template=template, formatter=formatter: template_string(app_context, template, formatter)
+            ))
+    return result
+
+
+def generate_tree(root: str, files: int, template_ratio: float):
+    templates = round(files * template_ratio)
+    for i in range(files):
+        dir_path = os.path.join(root, f"module{i // 50}")
+        os.makedirs(dir_path, exist_ok=True)
+        if i < templates:
+            with open(os.path.join(dir_path, f"{{{{ model.name }}}}_{i}.txt.template"), "w") as f:
+                f.write("Hello {{ model.name }}!\n" + "".join(f"{{{{ model.port + {j} }}}} " for j in range(20)) + "\n")
+        else:
+            with open(os.path.join(dir_path, f"asset_{i}.txt"), "w") as f:
+                f.write("static content\n" * 20)
+
+
+def directory_cases(tmp: str, quick: bool) -> List[Case]:
+    result = []
+    trees = [(100, 0.5), (500, 0.2), (500, 1.0)] if quick else [(100, 0.5), (2000, 0.2), (2000, 1.0)]
+    for files, template_ratio in trees:
+        name = f"{files}-{template_ratio}"
+        input_dir = os.path.join(tmp, "directory", name, "input")
+        output_dir = os.path.join(tmp, "directory", name, "output")
+        generate_tree(input_dir, files, template_ratio)
+        app_context = build_app_context("jinja2")
+        formatter = create_formatter("jinja2")
+        result.append(Case(
+            f"directory/{name}",
+            lambda app_context=app_context, input_dir=input_dir, output_dir=output_dir, formatter=formatter: template_directory(app_context, input_dir, output_dir, formatter),
+            before=lambda output_dir=output_dir: shutil.rmtree(output_dir, ignore_errors=True)
+        ))
+    return result
+
+
+def generate_config(path: str, values: int):
+    tables = max(1, values // 50)
+    with open(path, "w") as f:
+        f.write("[general]\nformat = \"jinja2\"\n\n[values]\nname = \"Pluto\"\n\n")
+        for t in range(tables):
+            f.write(f"[values.group{t}]\n")
+            for k in range(values // tables):
+                f.write(f"key{k} = \"value {t} {k}\"\n")
+            f.write("\n")
+
+
+def config_cases(tmp: str, quick: bool) -> List[Case]:
+    result = []
+    for values in ((1000, 5000) if quick else (1000, 20000)):
+        path = os.path.join(tmp, f"config{values}.toml")
+        generate_config(path, values)
+        result.append(Case(f"config/{values}", lambda path=path: update_using_config(AppContext(), path)))
+    return result
+
+
+def command_line_cases(tmp: str, quick: bool) -> List[Case]:
+    result = []
+    for values in ((100, 2000) if quick else (100, 10000)):
+        args = ["--format", "format", "--writeOnStdout"]
+        for i in range(values):
+            args.extend(["--value", f"group{i % 50}.key{i}", str(i)])
+        args.append("{model.group0.key0}")
+
+        def run(args=args):
+            with contextlib.redirect_stdout(io.StringIO()):
+                cli_main(args)
+
+        result.append(Case(f"command_line/{values}", run))
+    return result
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], tolerance: float) -> Dict[str, Dict[str, Any]]:
+    """
+    :return: for each case both in the results and in the baseline, the ratio between the current and the baseline
+        time and whether the case is "slower", "faster" or the "same" (within the tolerance)
+    """
+    result = {}
+    for name, current in results.items():
+        if name not in baseline:
+            continue
+        # the best run is the least affected by the noise of the machine
+        ratio = current["best"] / baseline[name]["best"]
+        if ratio > 1 + tolerance:
+            status = "slower"
+        elif ratio < 1 - tolerance:
+            status = "faster"
+        else:
+            status = "same"
+        result[name] = {"baseline": baseline[name]["best"], "current": current["best"], "ratio": ratio, "status": status}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--quick", action="store_true", help="smaller inputs and fewer runs")
+    parser.add_argument("--filter", type=str, default="", help="run only the cases whose name contains this string")
+    parser.add_argument("--repeat", type=int, default=None, help="runs per case (5, 3 with --quick)")
+    parser.add_argument("--min-time", type=float, default=None, help="minimum seconds per run (0.2, 0.05 with --quick)")
+    parser.add_argument("--output", type=str, default=None, help="file where to write the results. Default to stdout")
+    parser.add_argument("--compare", type=str, default=None, help="results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown reported as regression")
+    options = parser.parse_args()
+    repeat = options.repeat or (3 if options.quick else 5)
+    min_time = options.min_time or (0.05 if options.quick else 0.2)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for factory in (formatter_cases, directory_cases, config_cases, command_line_cases):
+            for case in factory(tmp, options.quick):
+                if options.filter not in case.name:
+                    continue
+                results[case.name] = case.measure(repeat, min_time)
+                print(f"{case.name:32} {results[case.name]['seconds'] * 1e6:12.1f}us", file=sys.stderr)
+
+    report = {
+        "version": version.VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "quick": options.quick,
+        "cases": results,
+    }
+    regressions = []
+    if options.compare is not None:
+        with open(options.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("quick") != options.quick:
+            print(f"warning: the baseline has been run with quick={baseline.get('quick')}", file=sys.stderr)
+        report["comparison"] = compare(results, baseline["cases"], options.tolerance)
+        for name, comparison in report["comparison"].items():
+            print(f"{name:32} {comparison['ratio']:6.2f}x {comparison['status']}", file=sys.stderr)
+            if comparison["status"] == "slower":
+                regressions.append(name)
+
+    if options.output is not None:
+        with open(options.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+    if len(regressions) > 0:
+        print(f"REGRESSIONS: {', '.join(regressions)}", file=sys.stderr)
+    sys.exit(1 if len(regressions) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -49,6 +49,9 @@ setuptools.setup(
     install_requires=list(get_requirements("requirements.txt")),
     include_package_data=True,
     #data_files=get_data_files(),
-    entry_points={"console_scripts": ["template-formatter=template_formatter.main:main"]},
+    entry_points={"console_scripts": [
+        "template-formatter=template_formatter.main:main",
+        "template-formatter-server=template_formatter.RenderServer:main",
+    ]},
     python_requires='>=3.8',
 )
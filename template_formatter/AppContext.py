@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 
 from template_formatter.Jinja2Model import Jinja2Model
 
@@ -25,3 +25,23 @@ class AppContext:
         self.write_on_stdout: bool = False
         self.template_string: Optional[str] = None
         self.format: Optional[str] = None
+        self.force_write: Optional[bool] = None
+        self.cache_dir: Optional[str] = None
+        self.cache_max_size: Optional[int] = None
+        self.jobs: Optional[int] = None
+        self.includes: Optional[List[str]] = None
+        self.excludes: Optional[List[str]] = None
+        self.copy_mode: Optional[str] = None
+        self.preserve_symlinks: Optional[bool] = None
+        self.skip_identical: Optional[str] = None
+        self.incremental: Optional[bool] = None
+        self.dependency_file: Optional[str] = None
+        self.dependency_format: Optional[str] = None
+        self.config_file: Optional[str] = None
+        self.batch_file: Optional[str] = None
+        self.batch_format: Optional[str] = None
+        self.batch_output: Optional[str] = None
+        # set only if the run is profiled (see --profile)
+        self.profiler: Optional["Profiler"] = None
+        # writer of the output files of the run (see main._get_output_writer)
+        self.output_writer: Optional["OutputWriter"] = None
@@ -0,0 +1,267 @@
+import asyncio
+import concurrent.futures
+import functools
+import inspect
+import os
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, Iterator, List, Optional
+
+from template_formatter import main as cli
+from template_formatter.AppContext import AppContext
+from template_formatter.FormatterRegistry import registry
+from template_formatter.ITemplateFormatter import ITemplateFormatter, ASYNC, THREAD_SAFE
+
+
+class AsyncRenderer(object):
+    """
+    Renders templates from asyncio code (e.g., a web service) without blocking the event loop.
+
+    Reading template files, compiling them and writing the output files is done in a bounded pool of threads. How
+    templates are rendered depends on the formatter of app_context.format:
+     - if some functions of the model are coroutine functions and the formatter supports ASYNC, templates are compiled
+       in async mode and rendered in the event loop: the coroutines the templates call are awaited, so that many
+       templates waiting for them can be rendered at once;
+     - otherwise, if the formatter is THREAD_SAFE, templates are rendered in the pool of threads;
+     - otherwise, templates are rendered in the event loop.
+    Formatters render a template at a time, hence each render takes a formatter from a pool, which grows up to the
+    number of renders running at once.
+    Templates, values and output files are the ones of app_context (after apply_defaults, add_commons and
+    add_functions). Output files are written like the program writes them (see OutputWriter)
+    """
+
+    def __init__(self, app_context: AppContext, max_workers: int = 4, concurrency: int = 16, executor: Optional[concurrent.futures.Executor] = None):
+        """
+        :param app_context: context of the whole application
+        :param max_workers: number of threads of the pool. Ignored if executor is given
+        :param concurrency: maximum number of files template_directory generates at once
+        :param executor: the executor to use instead of a new pool of threads. It is not shut down by close
+        """
+        if concurrency < 1:
+            raise ValueError(f"concurrency needs to be at least 1, not {concurrency}")
+        self.app_context = app_context
+        self.concurrency = concurrency
+        capabilities = registry.capabilities(app_context.format)
+        self.use_async = ASYNC in capabilities and any(map(inspect.iscoroutinefunction, app_context.model.functions.values()))
+        self.thread_safe = THREAD_SAFE in capabilities
+        self.writer = cli._get_output_writer(app_context)
+        self._own_executor = executor is None
+        self._executor = executor if executor is not None else concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix="template_formatter")
+        # formatters not used by any render. Only the event loop thread takes and puts them back
+        self._formatters: List[ITemplateFormatter] = []
+
+    async def __aenter__(self) -> "AsyncRenderer":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def close(self):
+        """
+        Shut down the pool of threads, if created by this renderer
+        """
+        if self._own_executor:
+            self._executor.shutdown(wait=True)
+
+    async def render_string(self, string: str, model: Any = None) -> str:
+        """
+        Like template_string
+
+        :param model: the values to use in the template. If None, we use the ones in app_context
+        :return: the rendered string
+        """
+        return await self._render(lambda formatter: cli._init_string(self.app_context, string, formatter), model)
+
+    async def render_file(self, file: str, model: Any = None) -> str:
+        """
+        Like template_file
+
+        :param model: the values to use in the template. If None, we use the ones in app_context
+        :return: the content of the instantiated file
+        """
+        return await self._render(lambda formatter: cli._init_file(self.app_context, file, formatter), model)
+
+    def stream_string(self, string: str, model: Any = None) -> AsyncIterator[str]:
+        """
+        Like template_string_stream. Pieces rendered in the pool of threads are buffered, so that we do not switch
+        thread for each small piece
+
+        :return: the pieces of the rendered string
+        """
+        return self._stream(lambda formatter: cli._init_string(self.app_context, string, formatter), model)
+
+    def stream_file(self, file: str, model: Any = None) -> AsyncIterator[str]:
+        """
+        Like template_file_stream (see stream_string)
+
+        :return: the pieces of the instantiated file
+        """
+        return self._stream(lambda formatter: cli._init_file(self.app_context, file, formatter), model)
+
+    async def write_file(self, file: str, output_file: str, model: Any = None) -> bool:
+        """
+        Template a file and write the result in output_file
+
+        :param model: the values to use in the template. If None, we use the ones in app_context
+        :return: true if the output file has been written, false if its content has not changed
+        """
+        if self.use_async:
+            content = await self.render_file(file, model)
+            written = await self._in_executor(self.writer.write, output_file, content)
+        else:
+            written = await self._with_formatter(lambda formatter: self.writer.write_stream(
+                output_file, cli.template_file_stream(self.app_context, file, formatter, model=model)
+            ))
+        cli._record_output(self.app_context, output_file, written)
+        return written
+
+    async def template_directory(self, directory_to_copy: str, directory_to_generate: str) -> int:
+        """
+        Like template_directory, but at most self.concurrency files are generated at once: a file is started only
+        when another one is done, so that a huge directory does not fill the memory with pending renders. If a file
+        cannot be generated, no other file is started and the error is raised once the running ones are done.
+        Incremental builds and dependency files are not supported
+
+        :param directory_to_copy: directory where templates are
+        :param directory_to_generate: directory to generate
+        :return: the number of files generated or copied
+        """
+        if not os.path.isdir(directory_to_copy):
+            raise ValueError(f"{directory_to_copy} is not a valid directory!")
+        if self.app_context.incremental or self.app_context.dependency_file is not None:
+            raise ValueError("incremental builds and dependency files are not supported by AsyncRenderer")
+
+        # names are rendered synchronously, hence they cannot use the coroutine functions
+        files_to_copy, files_to_template = await self._in_executor(
+            cli._scan_directory, self.app_context, directory_to_copy, directory_to_generate, cli._new_formatter(self.app_context)
+        )
+        copier = cli._create_file_copier(self.app_context)
+        jobs: List[Callable[[], Awaitable[Any]]] = []
+        for file_to_copy, output_file in files_to_copy:
+            jobs.append(functools.partial(self._in_executor, cli._copy_file, self.app_context, copier, file_to_copy, output_file))
+        for file_to_template, output_file, _ in files_to_template:
+            jobs.append(functools.partial(self.write_file, file_to_template, output_file))
+        await self._run_bounded(jobs)
+        return len(jobs)
+
+    async def _run_bounded(self, jobs: Iterable[Callable[[], Awaitable[Any]]]):
+        """
+        Run the jobs, at most self.concurrency at once
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        pending = set()
+        errors = []
+
+        def on_done(task: asyncio.Future):
+            pending.discard(task)
+            semaphore.release()
+            if not task.cancelled() and task.exception() is not None:
+                errors.append(task.exception())
+
+        try:
+            for job in jobs:
+                await semaphore.acquire()
+                if len(errors) > 0:
+                    break
+                task = asyncio.ensure_future(job())
+                pending.add(task)
+                task.add_done_callback(on_done)
+            if len(pending) > 0:
+                await asyncio.wait(list(pending))
+        except BaseException:
+            for task in pending:
+                task.cancel()
+            raise
+        if len(errors) > 0:
+            raise errors[0]
+
+    def _acquire(self) -> ITemplateFormatter:
+        if len(self._formatters) > 0:
+            return self._formatters.pop()
+        if self.use_async:
+            formatter = registry.create(self.app_context.format, enable_async=True)
+            if self.app_context.profiler is not None:
+                formatter.set_metrics_callback(self.app_context.profiler.formatter_callback)
+            return formatter
+        return cli._new_formatter(self.app_context)
+
+    async def _in_executor(self, function: Callable[..., Any], *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(function, *args))
+
+    async def _with_formatter(self, function: Callable[[ITemplateFormatter], Any]) -> Any:
+        """
+        :return: the result of function, called with a formatter of the pool in the pool of threads (in the event
+            loop if the formatter is not thread safe)
+        """
+        formatter = self._acquire()
+        try:
+            if self.thread_safe:
+                return await self._in_executor(function, formatter)
+            return function(formatter)
+        finally:
+            self._formatters.append(formatter)
+
+    async def _render(self, init: Callable[[ITemplateFormatter], Any], model: Any) -> str:
+        if not self.use_async:
+            return await self._with_formatter(lambda formatter: self._render_sync(init, formatter, model))
+        formatter = self._acquire()
+        try:
+            await self._in_executor(init, formatter)
+            return await formatter.render_template_async(**self._get_render_arguments(model))
+        finally:
+            formatter.reset()
+            self._formatters.append(formatter)
+
+    def _render_sync(self, init: Callable[[ITemplateFormatter], Any], formatter: ITemplateFormatter, model: Any) -> str:
+        try:
+            # _init_file returns the path of the template
+            template = init(formatter) or cli.STRING_TEMPLATE
+            return cli._render(self.app_context, template, formatter, model)
+        finally:
+            formatter.reset()
+
+    async def _stream(self, init: Callable[[ITemplateFormatter], Any], model: Any) -> AsyncIterator[str]:
+        formatter = self._acquire()
+        try:
+            if self.use_async:
+                await self._in_executor(init, formatter)
+                async for chunk in formatter.render_stream_async(**self._get_render_arguments(model)):
+                    yield chunk
+            elif self.thread_safe:
+                await self._in_executor(init, formatter)
+                chunks = iter(formatter.render_stream(**self._get_render_arguments(model)))
+                while True:
+                    piece = await self._in_executor(_next_piece, chunks)
+                    if piece is None:
+                        break
+                    yield piece
+            else:
+                init(formatter)
+                for chunk in formatter.render_stream(**self._get_render_arguments(model)):
+                    yield chunk
+        finally:
+            formatter.reset()
+            self._formatters.append(formatter)
+
+    def _get_render_arguments(self, model: Any) -> dict:
+        return dict(
+            model=self.app_context.model.values if model is None else model,
+            commons=self.app_context.model.commons,
+            functions=self.app_context.model.functions,
+        )
+
+
+def _next_piece(chunks: Iterator[str], buffer_size: int = 64 * 1024) -> Optional[str]:
+    """
+    :return: the next pieces of chunks, joined until they reach (about) buffer_size characters. None if there are no
+        more pieces
+    """
+    buffer = []
+    buffer_length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffer_length += len(chunk)
+        if buffer_length >= buffer_size:
+            break
+    if len(buffer) == 0:
+        return None
+    return "".join(buffer)
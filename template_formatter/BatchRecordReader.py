@@ -0,0 +1,71 @@
+import csv
+import json
+import os
+from typing import Optional, Dict, Any, Iterator
+
+from template_formatter.ConfigCache import parse_toml
+
+
+class BatchRecordReader(object):
+    """
+    Read the value sets of a batch render, one at a time.
+
+    Allowed formats are:
+     - jsonl: a json object per line. Read lazily;
+     - csv: a csv file with a header row. Read lazily. Values are strings;
+     - toml: a toml file with an array of tables named "records" (i.e., several [[records]] sections).
+        Since toml needs to be parsed as a whole, the file is loaded in memory
+    """
+
+    EXTENSIONS = {
+        ".jsonl": "jsonl",
+        ".ndjson": "jsonl",
+        ".csv": "csv",
+        ".toml": "toml",
+    }
+
+    def __init__(self, path: str, format: Optional[str] = None, encoding: str = "utf-8"):
+        """
+        :param path: file containing the records
+        :param format: format of the file. If None, it is inferred from the extension of the file
+        :param encoding: encoding of the file
+        """
+        if format is None:
+            format = self.EXTENSIONS.get(os.path.splitext(path)[1].lower())
+            if format is None:
+                raise ValueError(f"cannot infer the format of the batch file {path}. Please specify it")
+        if format not in self.EXTENSIONS.values():
+            raise ValueError(f"invalid batch format {format}")
+        self.path = path
+        self.format = format
+        self.encoding = encoding
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        if self.format == "jsonl":
+            return self._read_jsonl()
+        elif self.format == "csv":
+            return self._read_csv()
+        else:
+            return self._read_toml()
+
+    def _read_jsonl(self) -> Iterator[Dict[str, Any]]:
+        with open(self.path, "r", encoding=self.encoding) as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError(f"{self.path}:{line_number}: a record needs to be a json object")
+                yield record
+
+    def _read_csv(self) -> Iterator[Dict[str, Any]]:
+        with open(self.path, "r", encoding=self.encoding, newline="") as f:
+            yield from csv.DictReader(f)
+
+    def _read_toml(self) -> Iterator[Dict[str, Any]]:
+        with open(self.path, "rb") as f:
+            parsed_toml = parse_toml(f.read())
+        if "records" not in parsed_toml or not isinstance(parsed_toml["records"], list):
+            raise ValueError(f"{self.path} needs to contain an array of tables named records")
+        yield from parsed_toml["records"]
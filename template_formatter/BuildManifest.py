@@ -0,0 +1,330 @@
+import gc
+import hashlib
+import json
+import logging
+import marshal
+import os
+import tempfile
+from typing import Dict, Any, Optional, Iterable, Tuple, List
+
+from template_formatter import version
+from template_formatter.DependencyGraph import DependencyGraph, TemplateDependencies
+from template_formatter.Jinja2Model import resolve_key_path, DynamicObject, KeyPath, MISSING, EMPTY
+
+
+def hash_file(path: str) -> str:
+    """
+    :param path: file to hash
+    :return: the sha256 of the file content
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _stat(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def _check_file(path: str, recorded: List[Any]) -> Optional[List[Any]]:
+    """
+    :param path: file to check
+    :param recorded: size, mtime and hash of the file when it was recorded
+    :return: the up to date size, mtime and hash of the file if its content has not changed, None otherwise
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if st.st_size == recorded[0] and st.st_mtime_ns == recorded[1]:
+        return recorded
+    # the file has been touched. Maybe its content is the same
+    if st.st_size != recorded[0] or hash_file(path) != recorded[2]:
+        return None
+    return [st.st_size, st.st_mtime_ns, recorded[2]]
+
+
+def _describe_function(f: Any) -> str:
+    if hasattr(f, "__code__"):
+        # lambdas defined in the configuration file: their repr changes at every run, their bytecode does not
+        return "code:" + hashlib.sha256(marshal.dumps(f.__code__)).hexdigest()
+    if hasattr(f, "__name__"):
+        return f"{getattr(f, '__module__', None)}.{f.__name__}"
+    return repr(type(f))
+
+
+class BuildManifest(object):
+    """
+    Manifest stored in the output directory of an incremental directory templating.
+
+    For each input file (relative to the input directory) it contains the size, mtime and hash of the input file,
+    the output file (relative to the output directory) and its size, mtime and hash.
+    For templates, it also contains the size, mtime and hash of the templates they include, extend or import, and
+    the hash of each key of the model they read.
+    It also contains the fingerprint of the application context used to generate the outputs (the values of
+    the model excluded): if it changes, every output needs to be generated again.
+    """
+
+    FILENAME = ".template-formatter-manifest.json"
+    VERSION = 2
+
+    def __init__(self, input_directory: str, output_directory: str, fingerprint: str, values: Optional[DynamicObject] = None):
+        self.input_directory = os.path.abspath(input_directory)
+        self.output_directory = os.path.abspath(output_directory)
+        self.fingerprint = fingerprint
+        self.values = values
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.previous_entries: Dict[str, Dict[str, Any]] = {}
+        # paths are relativized by stripping these prefixes, since os.path.relpath is too slow on huge trees
+        self.__input_prefix = os.path.join(input_directory, "")
+        self.__output_prefix = os.path.join(self.output_directory, "")
+        # true if the manifest needs to be written again
+        self.__changed = False
+        # key of the model -> hash of its value. Many templates read the same keys
+        self.__key_hashes: Dict[KeyPath, str] = {}
+        # template -> size, mtime and hash. Many templates include the same templates
+        self.__checked_templates: Dict[str, Optional[List[Any]]] = {}
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.output_directory, self.FILENAME)
+
+    @classmethod
+    def load(cls, input_directory: str, output_directory: str, app_context: "AppContext") -> "BuildManifest":
+        """
+        Load the manifest of the previous build. Entries of the previous build are kept only if they have been built
+        with the same fingerprint
+        """
+        fingerprint = cls.compute_fingerprint(app_context)
+        result = cls(input_directory, output_directory, fingerprint, app_context.model.values)
+        # a manifest of a huge tree contains hundreds of thousands of lists and dictionaries: the garbage collector
+        # would scan them over and over while they are created, even if they cannot contain cycles
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(result.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return result
+        finally:
+            if gc_enabled:
+                gc.enable()
+        if data.get("version") != cls.VERSION:
+            return result
+        previous_entries = data.get("entries", {})
+        if data.get("fingerprint") != fingerprint:
+            logging.info(f"the model or the configuration has changed: every file will be generated again")
+            result.__changed = True
+            # we still need the outputs, in order to remove the ones whose input has been removed
+            previous_entries = {k: {"output": v["output"]} for k, v in previous_entries.items()}
+        result.previous_entries = previous_entries
+        return result
+
+    @staticmethod
+    def compute_fingerprint(app_context: "AppContext") -> str:
+        """
+        Fingerprint of everything in the application context that may change the generated files.
+        commons now and utc_now are not considered, otherwise nothing would ever be up to date.
+        The values of the model are not considered either, since we track which values each template reads
+        """
+        data = {
+            "program_version": version.VERSION,
+            "format": app_context.format,
+            "settings": [
+                app_context.block_start_string,
+                app_context.block_end_string,
+                app_context.expression_start_string,
+                app_context.expression_end_string,
+                app_context.comment_start_string,
+                app_context.comment_end_string,
+                app_context.line_statement_prefix,
+                app_context.trailing_string_template_file,
+                app_context.input_file_encoding,
+                app_context.output_file_encoding,
+            ],
+            "commons": {k: repr(v) for k, v in app_context.model.commons.items() if k not in ("now", "utc_now")},
+            "functions": {k: _describe_function(v) for k, v in app_context.model.functions.items()},
+        }
+        return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _relative_input(self, input_file: str) -> str:
+        if input_file.startswith(self.__input_prefix):
+            return input_file[len(self.__input_prefix):]
+        return os.path.relpath(os.path.abspath(input_file), self.input_directory)
+
+    def _relative_output(self, output_file: str) -> str:
+        if output_file.startswith(self.__output_prefix):
+            return output_file[len(self.__output_prefix):]
+        return os.path.relpath(os.path.abspath(output_file), self.output_directory)
+
+    def _hash_key(self, path: KeyPath) -> str:
+        if path not in self.__key_hashes:
+            value = resolve_key_path(self.values, path)
+            if value is MISSING:
+                # templates reading a missing key see an empty node
+                value = EMPTY
+            value = str(value) if isinstance(value, DynamicObject) else repr(value)
+            self.__key_hashes[path] = hashlib.sha256(value.encode("utf-8")).hexdigest()
+        return self.__key_hashes[path]
+
+    def _check_template(self, path: str, recorded: List[Any]) -> Optional[List[Any]]:
+        if path not in self.__checked_templates:
+            self.__checked_templates[path] = _check_file(path, recorded)
+        return self.__checked_templates[path]
+
+    def is_up_to_date(self, input_file: str, output_file: Optional[str] = None) -> bool:
+        """
+        Check if the output generated by the input file in the previous build is still valid.
+        If so, the entry is carried over the manifest of this build
+
+        :param input_file: input file to check
+        :param output_file: output file the input file generates. If None, we use the output of the previous build
+        """
+        key = self._relative_input(input_file)
+        entry = self.previous_entries.get(key)
+        if entry is None or "input" not in entry or not entry.get("complete", True):
+            return False
+        if output_file is not None and self._relative_output(output_file) != entry["output"]:
+            return False
+
+        # this runs for every file of a no-op rebuild: nothing is copied unless a file has been touched
+        input_record = _check_file(input_file, entry["input"])
+        if input_record is None:
+            return False
+        output_stat = entry["output_stat"]
+        output_record = _check_file(self.__output_prefix + entry["output"], [output_stat[0], output_stat[1], entry["output_hash"]])
+        if output_record is None:
+            return False
+        changed = input_record is not entry["input"] or output_record[1] != output_stat[1]
+        recorded_templates = entry.get("templates")
+        if recorded_templates:
+            templates = {}
+            for template, recorded in recorded_templates.items():
+                template_record = self._check_template(template, recorded)
+                if template_record is None:
+                    return False
+                changed = changed or template_record is not recorded
+                templates[template] = template_record
+        for path, value_hash in entry.get("model_keys", ()):
+            if self._hash_key(tuple(path)) != value_hash:
+                return False
+
+        if changed:
+            entry = dict(entry)
+            entry["input"] = input_record
+            entry["output_stat"] = output_record[:2]
+            if recorded_templates:
+                entry["templates"] = templates
+            self.__changed = True
+        self.entries[key] = entry
+        return True
+
+    def record(self, input_file: str, output_file: str, copied: bool = False, dependencies: Optional[TemplateDependencies] = None):
+        """
+        Record an output that we have just generated
+
+        :param input_file: input file used to generate the output
+        :param output_file: output generated
+        :param copied: true if the output is a copy of the input
+        :param dependencies: what the generated file depends on, if it is a template
+        """
+        input_stat = _stat(input_file)
+        output_stat = _stat(output_file)
+        input_hash = hash_file(input_file)
+        entry = {
+            "input": [input_stat[0], input_stat[1], input_hash],
+            "output": self._relative_output(output_file),
+            "output_stat": list(output_stat),
+            "output_hash": input_hash if copied else hash_file(output_file),
+        }
+        if dependencies is not None:
+            entry["complete"] = dependencies.templates is not None
+            entry["templates"] = {}
+            for template in dependencies.templates or []:
+                template_stat = _stat(template)
+                entry["templates"][template] = [template_stat[0], template_stat[1], hash_file(template)]
+            entry["model_keys"] = sorted(map(lambda x: [list(x), self._hash_key(x)], dependencies.model_keys), key=str)
+        self.entries[self._relative_input(input_file)] = entry
+        self.__changed = True
+
+    def add_to_graph(self, graph: DependencyGraph, config_file: Optional[str]):
+        """
+        Add the dependencies of every output of this build in the given graph
+
+        :param graph: graph to update
+        :param config_file: configuration file every template depends on, if any
+        """
+        for key, entry in self.entries.items():
+            input_files = [os.path.join(self.input_directory, key)]
+            if "model_keys" in entry:
+                input_files.extend(entry["templates"].keys())
+                if config_file is not None:
+                    input_files.append(config_file)
+            graph.add(
+                os.path.join(self.output_directory, entry["output"]),
+                input_files,
+                map(lambda x: tuple(x[0]), entry.get("model_keys", [])),
+                complete=entry.get("complete", True)
+            )
+
+    def stale_outputs(self) -> Iterable[str]:
+        """
+        :return: absolute paths of outputs generated in the previous build that are not generated by this build anymore
+        """
+        current = set(map(lambda x: x["output"], self.entries.values()))
+        for entry in self.previous_entries.values():
+            if entry["output"] not in current:
+                yield self.__output_prefix + entry["output"]
+
+    def remove_stale_outputs(self) -> List[str]:
+        """
+        Remove every output generated in the previous build that this build did not generate
+
+        :return: the removed files
+        """
+        result = []
+        for output_file in self.stale_outputs():
+            try:
+                os.remove(output_file)
+            except FileNotFoundError:
+                continue
+            logging.info(f"Removing stale output file {output_file}...")
+            result.append(output_file)
+        if len(self.entries) != len(self.previous_entries):
+            self.__changed = True
+        return result
+
+    def save(self):
+        """
+        Write the manifest in the output directory, unless nothing has changed since the previous build
+        """
+        if not self.__changed and os.path.exists(self.path):
+            return
+        data = {
+            "version": self.VERSION,
+            "fingerprint": self.fingerprint,
+            "entries": self.entries,
+        }
+        os.makedirs(self.output_directory, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=self.output_directory, prefix=self.FILENAME, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                # json.dump encodes in pure python: dumps is much faster on huge manifests
+                f.write(json.dumps(data, separators=(",", ":")))
+            os.replace(tmp_name, self.path)
+        except BaseException:
+            try:
+                os.remove(tmp_name)
+            except OSError:
+                pass
+            raise
+
@@ -0,0 +1,98 @@
+import hashlib
+import logging
+import os
+import pickle
+import sys
+import tempfile
+from typing import Any, Callable, Dict
+
+
+def parse_toml(content: bytes) -> Dict[str, Any]:
+    """
+    Parse a toml document with the standard library tomllib (python 3.11+), which is several times faster than the
+    toml package. The toml package is used on older pythons
+
+    :param content: the document, encoded in utf-8 (as toml requires)
+    :return: the parsed document
+    """
+    try:
+        import tomllib
+    except ImportError:
+        import toml
+        return toml.loads(content.decode("utf-8"))
+    return tomllib.loads(content.decode("utf-8"))
+
+
+def get_toml_parser_name() -> str:
+    """
+    :return: the name of the library parse_toml uses
+    """
+    return "tomllib" if sys.version_info >= (3, 11) else "toml"
+
+
+class ConfigCache(object):
+    """
+    Cache of parsed files (configuration files, values files, ...) that survives across several invocations of the
+    program, so that a big file which has not changed does not need to be parsed again.
+
+    There is an entry per file, named after its absolute path: it contains the parsed file and a hash of the raw
+    content of the file (together with the parser and the python version). An entry is reused only if the hash
+    matches, so a file changed without altering its size or its modification time is parsed again. Hashing the file
+    is much cheaper than parsing it.
+    Entries are written in a temporary file and then atomically renamed, hence several processes can share the same
+    directory (e.g., the one of --cacheDir)
+    """
+
+    PATTERN = "__template_formatter_config_%s.pickle"
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def load(self, path: str, parser_name: str, parse: Callable[[bytes], Any]) -> Any:
+        """
+        :param path: file to parse
+        :param parser_name: name of the parser. Files parsed by a different parser (or version of the parser)
+            need to have different names
+        :param parse: function parsing the content of the file. Its result needs to be picklable
+        :return: the parsed file
+        """
+        path = os.path.abspath(path)
+        with open(path, "rb") as f:
+            content = f.read()
+        digest = hashlib.blake2b(content, digest_size=32)
+        digest.update(f"\0{parser_name}\0{sys.version}".encode("utf-8"))
+        digest = digest.digest()
+
+        entry_file = self._get_entry_file(path)
+        try:
+            with open(entry_file, "rb") as f:
+                entry_digest, parsed = pickle.load(f)
+            if entry_digest == digest:
+                return parsed
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            # a corrupted or incompatible entry: parse the file again
+            logging.info(f"ignoring the config cache entry {entry_file}: {e}")
+
+        parsed = parse(content)
+        self._save(entry_file, digest, parsed)
+        return parsed
+
+    def _get_entry_file(self, path: str) -> str:
+        return os.path.join(self.directory, self.PATTERN % hashlib.sha256(path.encode("utf-8")).hexdigest())
+
+    def _save(self, entry_file: str, digest: bytes, parsed: Any):
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory, prefix=os.path.basename(entry_file), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump((digest, parsed), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_name, entry_file)
+        except (OSError, pickle.PicklingError) as e:
+            # the cache is just an optimization
+            logging.info(f"cannot write the config cache entry {entry_file}: {e}")
+            try:
+                os.remove(tmp_name)
+            except OSError:
+                pass
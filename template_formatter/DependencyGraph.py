@@ -0,0 +1,98 @@
+import json
+import os
+from typing import Dict, Optional, List, Set, Iterable
+
+from template_formatter.Jinja2Model import KeyPath, format_key_path
+
+
+class TemplateDependencies(object):
+    """
+    What a generated file depends on, besides the template file itself
+    """
+
+    def __init__(self, templates: Optional[List[str]], model_keys: Set[KeyPath]):
+        """
+        :param templates: absolute paths of the templates included, extended or imported (even transitively) by the
+            template. None if they cannot be computed (e.g., a template is included via a variable)
+        :param model_keys: keys of the model read while rendering the template
+        """
+        self.templates = templates
+        self.model_keys = model_keys
+
+
+class DependencyGraph(object):
+    """
+    Dependencies of every file generated by a run, which can be exported for external build tools
+    """
+
+    def __init__(self):
+        # output file -> input files (the template first)
+        self.__inputs: Dict[str, List[str]] = {}
+        # output file -> keys of the model
+        self.__model_keys: Dict[str, List[str]] = {}
+        # output file -> true if the dependencies are not complete
+        self.__unknown: Dict[str, bool] = {}
+
+    def add(self, output_file: str, input_files: Iterable[str], model_keys: Iterable[KeyPath], complete: bool = True):
+        """
+        :param output_file: file generated
+        :param input_files: files the generated file depends on. The first one is the template
+        :param model_keys: keys of the model the generated file depends on
+        :param complete: false if input_files may not contain every file the output depends on
+        """
+        output_file = os.path.abspath(output_file)
+        self.__inputs[output_file] = list(map(os.path.abspath, input_files))
+        self.__model_keys[output_file] = sorted(map(format_key_path, model_keys))
+        self.__unknown[output_file] = not complete
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "outputs": {
+                output_file: {
+                    "inputs": self.__inputs[output_file],
+                    "model_keys": self.__model_keys[output_file],
+                    "complete": not self.__unknown[output_file],
+                }
+                for output_file in sorted(self.__inputs.keys())
+            }
+        }, indent=4)
+
+    def to_makefile(self) -> str:
+        """
+        Generate a makefile in the same format of "gcc -MD -MP": a rule for each output, plus an empty rule for
+        each dependency, so make does not fail if a template is removed
+        """
+
+        def escape(path: str) -> str:
+            return path.replace("$", "$$").replace(" ", "\\ ").replace("#", "\\#")
+
+        lines = []
+        dependencies = set()
+        for output_file in sorted(self.__inputs.keys()):
+            inputs = self.__inputs[output_file]
+            lines.append(f"{escape(output_file)}: " + " \\\n  ".join(map(escape, inputs)))
+            if self.__unknown[output_file]:
+                # we cannot know what the output depends on: always rebuild it
+                lines[-1] += " FORCE"
+                dependencies.add("FORCE")
+            dependencies.update(inputs)
+        lines.append("")
+        for dependency in sorted(dependencies):
+            lines.append(f"{escape(dependency)}:")
+        return "\n".join(lines) + "\n"
+
+    def save(self, path: str, format: Optional[str] = None):
+        """
+        :param path: file where to save the graph
+        :param format: either "json" or "make". If None, we use "make" if the file ends with ".d", "json" otherwise
+        """
+        if format is None:
+            format = "make" if path.endswith(".d") else "json"
+        if format == "json":
+            content = self.to_json()
+        elif format == "make":
+            content = self.to_makefile()
+        else:
+            raise ValueError(f"invalid dependency format {format}")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
@@ -0,0 +1,235 @@
+import logging
+import os
+import re
+from typing import Iterable, Iterator, List, Optional, Pattern, Tuple
+
+# file containing the rules of the files to ignore in the directory where it is (and in its subdirectories)
+IGNORE_FILE = ".templateignore"
+
+
+class IgnoreRule(object):
+    """
+    A pattern with the semantics of a line of a .gitignore file (see https://git-scm.com/docs/gitignore):
+     - "*" and "?" match anything but "/", "[...]" matches a set of characters;
+     - "**/" at the beginning, "/**/" in the middle and "/**" at the end match any number of directories;
+     - a pattern containing a "/" (except at the end) is relative to the base directory, otherwise it matches a name
+       at any depth;
+     - a pattern ending with "/" matches only directories;
+     - a pattern starting with "!" negates a previous match.
+    """
+
+    __slots__ = ("pattern", "base", "negate", "dir_only", "anchored", "segments", "regex")
+
+    def __init__(self, pattern: str, base: str = ""):
+        """
+        :param pattern: the pattern
+        :param base: path (relative to the root of the walk, with "/" as separator and ending with "/") of the
+            directory the pattern is relative to. "" for the root
+        """
+        self.pattern = pattern
+        self.base = base
+        self.negate = pattern.startswith("!")
+        if self.negate or pattern.startswith("\\!") or pattern.startswith("\\#"):
+            pattern = pattern[1:]
+        self.dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        self.anchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+        self.segments = pattern.split("/")
+        self.regex: Pattern = re.compile(("" if self.anchored else "(?:.*/)?") + _translate(self.segments) + r"\Z", re.DOTALL)
+
+    def matches(self, path: str, is_dir: bool) -> bool:
+        """
+        :param path: path relative to the root of the walk, with "/" as separator
+        :param is_dir: true if path is a directory
+        """
+        if self.dir_only and not is_dir:
+            return False
+        if not path.startswith(self.base):
+            return False
+        return self.regex.match(path, len(self.base)) is not None
+
+    def may_match_below(self, directory: str) -> bool:
+        """
+        :param directory: directory relative to the root of the walk, with "/" as separator
+        :return: false if the pattern cannot match anything inside the directory
+        """
+        if not directory.startswith(self.base):
+            # the directory is not inside the base directory
+            return self.base.startswith(directory + "/")
+        if not self.anchored:
+            return True
+        directory = directory[len(self.base):]
+        return _match_prefix(self.segments, directory.split("/") if directory != "" else [])
+
+
+def _translate(segments: List[str]) -> str:
+    result = []
+    for i, segment in enumerate(segments):
+        last = i == len(segments) - 1
+        if segment == "**":
+            result.append(".*" if last else "(?:.*/)?")
+            continue
+        result.append(_translate_segment(segment))
+        if not last:
+            result.append("/")
+    return "".join(result)
+
+
+def _translate_segment(segment: str) -> str:
+    result = []
+    i = 0
+    while i < len(segment):
+        c = segment[i]
+        i += 1
+        if c == "*":
+            result.append("[^/]*")
+        elif c == "?":
+            result.append("[^/]")
+        elif c == "\\" and i < len(segment):
+            result.append(re.escape(segment[i]))
+            i += 1
+        elif c == "[":
+            start = i + 1 if i < len(segment) and segment[i] in "!^" else i
+            # a "]" right after the "[" is a character of the set
+            start = start + 1 if start < len(segment) and segment[start] == "]" else start
+            end = segment.find("]", start)
+            if end < 0:
+                result.append(re.escape(c))
+                continue
+            chars = segment[i:end]
+            i = end + 1
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            result.append("[" + chars.replace("\\", "\\\\") + "]")
+        else:
+            result.append(re.escape(c))
+    return "".join(result)
+
+
+def _match_prefix(segments: List[str], directories: List[str]) -> bool:
+    """
+    :return: true if the path made of directories may be the beginning of a path matching the pattern segments
+    """
+    if len(directories) == 0:
+        return True
+    if len(segments) == 0:
+        return False
+    if segments[0] == "**":
+        return True
+    if re.match(_translate_segment(segments[0]) + r"\Z", directories[0]) is None:
+        return False
+    return _match_prefix(segments[1:], directories[1:])
+
+
+def read_ignore_file(path: str, base: str = "") -> List[IgnoreRule]:
+    """
+    :param path: an ignore file
+    :param base: directory containing the ignore file, relative to the root of the walk (see IgnoreRule)
+    :return: the rules in the ignore file
+    """
+    result = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n").rstrip("\r")
+            # trailing spaces are ignored, unless they are escaped
+            stripped = line.rstrip(" ")
+            if stripped.endswith("\\") and len(stripped) < len(line):
+                stripped += " "
+            if stripped == "" or stripped.startswith("#"):
+                continue
+            result.append(IgnoreRule(stripped, base))
+    return result
+
+
+def is_ignored(rules: Iterable[IgnoreRule], path: str, is_dir: bool) -> bool:
+    """
+    :return: true if the last rule matching path is not negated
+    """
+    result = False
+    for rule in rules:
+        if rule.negate == result and rule.matches(path, is_dir):
+            result = not rule.negate
+    return result
+
+
+class DirectoryWalker(object):
+    """
+    Walks a directory top-down, like os.walk, but it yields the os.DirEntry of each file and directory, so that callers
+    can reuse the information the operating system has given while listing the directory (whether an entry is a
+    directory or a symbolic link, ...) without further system calls.
+
+    Entries can be excluded by:
+     - the ignore files (IGNORE_FILE) in the directory or in its parents, with the semantics of .gitignore;
+     - exclude patterns: entries matching any of them are ignored;
+     - include patterns: if there is at least one, only files matching one of them (or inside a directory matching
+       one of them) are kept.
+    Include and exclude patterns have the same syntax of the ignore files and are relative to the root.
+    Ignored directories are not scanned at all, hence ignoring big trees (".git", "node_modules", ...) is cheap.
+    Symbolic links to directories are yielded as directories, but they are not scanned (like os.walk).
+    Ignore files are never yielded.
+    """
+
+    def __init__(self, root: str, includes: Optional[Iterable[str]] = None, excludes: Optional[Iterable[str]] = None, ignore_file: Optional[str] = IGNORE_FILE):
+        """
+        :param root: directory to walk
+        :param includes: patterns of the files to keep. If empty, we keep every file
+        :param excludes: patterns of the files and directories to ignore
+        :param ignore_file: name of the ignore files. If None, ignore files are not read
+        """
+        self.root = root
+        self.includes = [IgnoreRule(x) for x in includes or []]
+        self.excludes = [IgnoreRule(x) for x in excludes or []]
+        self.ignore_file = ignore_file
+
+    def walk(self) -> Iterator[Tuple[str, List[os.DirEntry], List[os.DirEntry]]]:
+        """
+        :return: for each directory, its path, its subdirectories and its files. Like os.walk, subdirectories removed
+            from the list by the caller are not scanned
+        """
+        # directory, its path relative to the root, the rules of the ignore files of its parents, whether it is inside a directory matching an include pattern
+        stack = [(self.root, "", [], len(self.includes) == 0)]
+        while len(stack) > 0:
+            dir_path, relative_path, rules, included = stack.pop()
+            try:
+                with os.scandir(dir_path) as it:
+                    entries = list(it)
+            except OSError as e:
+                logging.info(f"cannot scan {dir_path}: {e}")
+                continue
+
+            if self.ignore_file is not None:
+                for entry in entries:
+                    if entry.name == self.ignore_file:
+                        rules = rules + read_ignore_file(entry.path, relative_path)
+                        break
+
+            folders = []
+            files = []
+            for entry in entries:
+                if entry.name == self.ignore_file:
+                    continue
+                is_dir = entry.is_dir()
+                path = relative_path + entry.name
+                # the rules of the ignore files cannot include again what the exclude patterns have excluded
+                if is_ignored(self.excludes, path, is_dir) or is_ignored(rules, path, is_dir):
+                    continue
+                if is_dir:
+                    if included or any(map(lambda x: x.may_match_below(path), self.includes)):
+                        folders.append(entry)
+                elif included or any(map(lambda x: x.matches(path, False), self.includes)):
+                    files.append(entry)
+
+            yield dir_path, folders, files
+
+            # the first directory is scanned first, like os.walk
+            for entry in reversed(folders):
+                if entry.is_symlink():
+                    continue
+                path = relative_path + entry.name
+                stack.append((
+                    entry.path,
+                    path + "/",
+                    rules,
+                    included or any(map(lambda x: x.matches(path, True), self.includes))
+                ))
@@ -1,31 +1,42 @@
-from typing import Dict, Any, Callable, Optional
+import functools
+from types import CodeType
+from typing import Dict, Any, Callable, Optional, Tuple
 
-from template_formatter.ITemplateFormatter import ITemplateFormatter
+from template_formatter.ITemplateFormatter import ITemplateFormatter, THREAD_SAFE, CACHEABLE
+from template_formatter.RenderContext import get_render_context
+
+
+def _compile(template: str) -> CodeType:
+    # we assume in template there is a string endpoint
+    return compile("f\"\"\"" + template + "\"\"\"", "<template>", "eval")
 
 
 class FStringFormatter(ITemplateFormatter):
 
-    def __init__(self):
-        self.__template_string: Optional[str] = None
+    CAPABILITIES = frozenset([THREAD_SAFE, CACHEABLE])
+
+    def __init__(self, cache_size: int = 400):
+        """
+        :param cache_size: maximum number of compiled templates to keep. Templates are keyed by their source
+        """
+        self.__code: Optional[CodeType] = None
+        self.__compile = functools.lru_cache(maxsize=cache_size)(_compile)
 
     def init_string(self, string: str, app_context: "AppContext"):
-        self.__template_string = string
+        self.__code = self.__compile(string)
 
     def init_file(self, f: str, encoding: str, app_context: "AppContext"):
         with open(f, "r", encoding=encoding) as handle:
-            self.__template_string = handle.read().strip()
+            self.__code = self.__compile(handle.read().strip())
 
     def render_template(self, model: Dict[str, Any], commons: Dict[str, Any], functions: Dict[str, Callable]) -> str:
-        global_dict = dict()
-        global_dict["model"] = model
-        global_dict["commons"] = commons
-        global_dict["functions"] = functions
-        for k, v in functions.items():
-            global_dict[k] = v
-        # we assume in __template_string there is a string endpoint
-        result = eval("f\"\"\"" + self.__template_string + "\"\"\"", global_dict, {})
+        result = eval(self.__code, get_render_context(commons, functions).get_names(model), {})
         # it is a string, hence we need to remove the trailing characters
         return result.strip('\'\"')
 
+    def cache_info(self) -> Optional[Tuple[int, int]]:
+        info = self.__compile.cache_info()
+        return info.hits, info.misses
+
     def reset(self):
-        self.__template_string = None
+        self.__code = None
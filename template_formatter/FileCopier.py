@@ -0,0 +1,205 @@
+import errno
+import logging
+import os
+import shutil
+import sys
+from typing import Callable, Dict, List, Optional, Tuple
+
+# strategies used to copy a file which is not a template
+AUTO = "auto"
+REFLINK = "reflink"
+COPY_FILE_RANGE = "copy_file_range"
+SENDFILE = "sendfile"
+COPY = "copy"
+HARDLINK = "hardlink"
+COPY_MODES = (AUTO, REFLINK, COPY_FILE_RANGE, SENDFILE, COPY, HARDLINK)
+
+# results of FileCopier.copy besides the strategies
+SYMLINK = "symlink"
+SKIPPED = "skipped"
+
+# how FileCopier.copy detects an output identical to its input
+SKIP_IDENTICAL_MODES = ("mtime", "hash")
+
+# ioctl cloning a whole file (linux/fs.h)
+_FICLONE = 0x40049409
+
+# errors meaning that a strategy is not supported by the platform or by the filesystems involved
+_UNSUPPORTED_ERRORS = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.EBADF, errno.EPERM, getattr(errno, "EOPNOTSUPP", errno.ENOTSUP), errno.ENOTSUP}
+
+
+def _reflink(fsrc, fdst, size: int):
+    import fcntl
+    fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+
+
+def _copy_file_range(fsrc, fdst, size: int):
+    copied = 0
+    while copied < size:
+        sent = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+        if sent == 0:
+            _copy_rest(fsrc, fdst, copied)
+            return
+        copied += sent
+
+
+def _sendfile(fsrc, fdst, size: int):
+    copied = 0
+    while copied < size:
+        sent = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, size - copied)
+        if sent == 0:
+            _copy_rest(fsrc, fdst, copied)
+            return
+        copied += sent
+
+
+def _copy_rest(fsrc, fdst, copied: int):
+    """
+    Copy the input from the offset copied to its end, reading it. Kernel copies may copy nothing before the end of the
+    input (e.g., on filesystems whose files do not report their real size, or if the input has changed meanwhile)
+    """
+    logging.info(f"{fsrc.name} has been copied by the kernel up to {copied} bytes. Copying the rest")
+    fsrc.seek(copied)
+    fdst.seek(copied)
+    shutil.copyfileobj(fsrc, fdst)
+
+
+def _get_kernel_copies() -> Dict[str, Callable]:
+    """
+    :return: the strategies copying a file inside the kernel available on this platform, from the fastest one
+    """
+    result = {}
+    if sys.platform.startswith("linux"):
+        result[REFLINK] = _reflink
+        if hasattr(os, "copy_file_range"):
+            result[COPY_FILE_RANGE] = _copy_file_range
+        # on other platforms sendfile can write only on sockets
+        if hasattr(os, "sendfile"):
+            result[SENDFILE] = _sendfile
+    return result
+
+
+class FileCopier(object):
+    """
+    Copies the files of a directory to template which are not templates.
+
+    The mode chooses how a file is copied:
+     - reflink: the output shares the blocks of the input until one of them is modified (btrfs, xfs, ...);
+     - copy_file_range, sendfile: the kernel copies the data, without moving it into this process;
+     - copy: shutil.copyfile;
+     - hardlink: the output is a hard link to the input. Modifying one of them modifies the other;
+     - auto: the fastest of reflink, copy_file_range, sendfile and copy supported by the platform.
+    A strategy which turns out to be unsupported (by the platform or by the filesystems of the input and of the output)
+    falls back to the next one, and it is not tried again for the same pair of filesystems. Hardlinks fall back to auto.
+
+    If preserve_symlinks is set, symbolic links are copied as links (with the same target) instead of copying the file
+    they point to.
+    If skip_identical is set, we do not copy files whose output is already identical to them:
+     - mtime: the output has the same size and modification time of the input (copies keep the modification time
+       of the input);
+     - hash: the output has the same content of the input.
+
+    A copier can be used by several threads at once
+    """
+
+    def __init__(self, mode: str = AUTO, preserve_symlinks: bool = False, skip_identical: Optional[str] = None):
+        if mode not in COPY_MODES:
+            raise ValueError(f"invalid copy mode {mode}. Allowed values are {', '.join(COPY_MODES)}")
+        if skip_identical is not None and skip_identical not in SKIP_IDENTICAL_MODES:
+            raise ValueError(f"invalid skip identical mode {skip_identical}. Allowed values are {', '.join(SKIP_IDENTICAL_MODES)}")
+        self.mode = mode
+        self.preserve_symlinks = preserve_symlinks
+        self.skip_identical = skip_identical
+        self._kernel_copies = _get_kernel_copies()
+        # (device of the input, device of the output) -> strategies which have failed on them
+        self._unsupported: Dict[Tuple[int, int], set] = {}
+
+    def get_strategies(self) -> List[str]:
+        """
+        :return: the strategies tried (in order) to copy a regular file. The last one always works
+        """
+        if self.mode == HARDLINK:
+            return [HARDLINK] + list(self._kernel_copies.keys()) + [COPY]
+        if self.mode == AUTO:
+            return list(self._kernel_copies.keys()) + [COPY]
+        if self.mode == COPY or self.mode not in self._kernel_copies:
+            return [COPY]
+        return [self.mode, COPY]
+
+    def copy(self, file_to_copy: str, output_file: str) -> str:
+        """
+        Copy a file (or a symbolic link, if preserve_symlinks is set). An existing output file is replaced
+
+        :param file_to_copy: file to copy
+        :param output_file: file to generate
+        :return: the strategy used, SYMLINK if we have copied a symbolic link, SKIPPED if the output was already
+            identical to the input
+        """
+        if self.preserve_symlinks and os.path.islink(file_to_copy):
+            return self._copy_symlink(file_to_copy, output_file)
+
+        input_stat = os.stat(file_to_copy)
+        try:
+            output_stat = os.lstat(output_file)
+        except FileNotFoundError:
+            output_stat = None
+        if output_stat is not None:
+            if self._is_identical(file_to_copy, input_stat, output_file, output_stat):
+                return SKIPPED
+            # never write through an existing output: it may be a (hard or symbolic) link to the input
+            os.remove(output_file)
+
+        devices = (input_stat.st_dev, os.stat(os.path.dirname(os.path.abspath(output_file))).st_dev)
+        unsupported = self._unsupported.setdefault(devices, set())
+        for strategy in self.get_strategies():
+            if strategy in unsupported:
+                continue
+            try:
+                self._copy_with(strategy, file_to_copy, output_file, input_stat.st_size)
+            except OSError as e:
+                if strategy == COPY or e.errno not in _UNSUPPORTED_ERRORS:
+                    raise
+                logging.info(f"cannot copy {file_to_copy} with {strategy} ({e}). Trying the next strategy")
+                unsupported.add(strategy)
+                continue
+            if self.skip_identical == "mtime" and strategy != HARDLINK:
+                os.utime(output_file, ns=(input_stat.st_atime_ns, input_stat.st_mtime_ns))
+            return strategy
+        raise AssertionError("copy always succeeds")
+
+    def _copy_with(self, strategy: str, file_to_copy: str, output_file: str, size: int):
+        if strategy == HARDLINK:
+            # on some platforms link does not follow symbolic links, even if asked to
+            os.link(os.path.realpath(file_to_copy), output_file)
+        elif strategy == COPY:
+            shutil.copyfile(file_to_copy, output_file)
+        else:
+            with open(file_to_copy, "rb") as fsrc, open(output_file, "wb") as fdst:
+                self._kernel_copies[strategy](fsrc, fdst, size)
+
+    def _copy_symlink(self, file_to_copy: str, output_file: str) -> str:
+        target = os.readlink(file_to_copy)
+        if os.path.islink(output_file) and os.readlink(output_file) == target:
+            return SKIPPED if self.skip_identical is not None else SYMLINK
+        if os.path.isdir(output_file) and not os.path.islink(output_file):
+            # a directory generated by a previous run which did not preserve links
+            shutil.rmtree(output_file)
+        elif os.path.lexists(output_file):
+            os.remove(output_file)
+        os.symlink(target, output_file)
+        return SYMLINK
+
+    def _is_identical(self, file_to_copy: str, input_stat: os.stat_result, output_file: str, output_stat: os.stat_result) -> bool:
+        import stat
+
+        if self.skip_identical is None or not stat.S_ISREG(output_stat.st_mode):
+            return False
+        if self.mode == HARDLINK:
+            # an output which is not a link to the input needs to become one
+            return os.path.samestat(input_stat, output_stat)
+        if output_stat.st_size != input_stat.st_size:
+            return False
+        if self.skip_identical == "mtime":
+            return output_stat.st_mtime_ns == input_stat.st_mtime_ns
+        from template_formatter.BuildManifest import hash_file
+        return hash_file(file_to_copy) == hash_file(output_file)
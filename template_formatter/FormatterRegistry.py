@@ -0,0 +1,128 @@
+import importlib
+from typing import Dict, Any, Callable, List, Union, FrozenSet, Tuple
+
+# group of the entry points other packages use to add formatters. The name of the entry point is the format and its
+# value the class (or any callable) creating the formatter, e.g. in a pyproject.toml:
+#
+#   [project.entry-points."template_formatter.formatters"]
+#   mustache = "my_package.MustacheFormatter:MustacheFormatter"
+ENTRY_POINT_GROUP = "template_formatter.formatters"
+
+
+class FormatterRegistry(object):
+    """
+    The formats template_formatter knows about, each with the formatter rendering it.
+
+    Formatters are registered as "module:attribute" strings and imported only the first time they are needed, so that
+    the startup does not pay for the formatters (e.g., jinja2) a run does not use. The installed entry points of
+    ENTRY_POINT_GROUP are read only when a format is not registered (or when every format is listed)
+    """
+
+    def __init__(self):
+        # format -> "module:attribute" or the callable creating the formatter, and its keyword arguments
+        self._factories: Dict[str, Tuple[Union[str, Callable[..., Any]], Dict[str, Any]]] = {}
+        # format -> callable creating the formatter, once imported
+        self._loaded: Dict[str, Callable[..., Any]] = {}
+        self._entry_points_read = False
+
+    def register(self, format: str, factory: Union[str, Callable[..., Any]], **kwargs):
+        """
+        Add (or replace) a format
+
+        :param format: name of the format, as given to --format
+        :param factory: the class (or any callable) creating the formatter, or a "module:attribute" string
+            locating it, imported the first time the format is used
+        :param kwargs: keyword arguments given to the factory
+        """
+        self._factories[format] = (factory, kwargs)
+        self._loaded.pop(format, None)
+
+    def unregister(self, format: str):
+        """
+        Remove a format, if present
+
+        :param format: name of the format
+        """
+        self._factories.pop(format, None)
+        self._loaded.pop(format, None)
+
+    def names(self) -> List[str]:
+        """
+        :return: every available format, installed plugins included
+        """
+        self._read_entry_points()
+        return sorted(self._factories)
+
+    def load(self, format: str) -> Callable[..., Any]:
+        """
+        :param format: name of the format
+        :return: the class (or any callable) creating the formatter of the format
+        :raise ValueError: if the format is unknown
+        """
+        factory = self._loaded.get(format)
+        if factory is not None:
+            return factory
+        if format not in self._factories:
+            self._read_entry_points()
+        if format not in self._factories:
+            raise ValueError(f"invalid format {format}")
+        factory, _ = self._factories[format]
+        if isinstance(factory, str):
+            module_name, _, attribute = factory.partition(":")
+            factory = getattr(importlib.import_module(module_name), attribute)
+        self._loaded[format] = factory
+        return factory
+
+    def create(self, format: str, **kwargs) -> "ITemplateFormatter":
+        """
+        :param format: name of the format
+        :param kwargs: keyword arguments given to the factory, besides (or instead of) the registered ones
+        :return: a new formatter of the format
+        :raise ValueError: if the format is unknown
+        """
+        factory = self.load(format)
+        return factory(**{**self._factories[format][1], **kwargs})
+
+    def capabilities(self, format: str) -> FrozenSet[str]:
+        """
+        :param format: name of the format
+        :return: the capabilities (see ITemplateFormatter) the formatter of the format declares
+        """
+        return get_capabilities(self.load(format))
+
+    def _read_entry_points(self):
+        if self._entry_points_read:
+            return
+        self._entry_points_read = True
+        from importlib import metadata
+        entry_points = metadata.entry_points()
+        if hasattr(entry_points, "select"):
+            group = entry_points.select(group=ENTRY_POINT_GROUP)
+        else:
+            # python < 3.10 returns a dictionary of groups
+            group = entry_points.get(ENTRY_POINT_GROUP, ())
+        for entry_point in group:
+            # formats registered by hand win over the plugins
+            if entry_point.name not in self._factories:
+                self._factories[entry_point.name] = (entry_point.value, {})
+
+
+def get_capabilities(formatter: Any) -> FrozenSet[str]:
+    """
+    :param formatter: a formatter or its class
+    :return: the capabilities the formatter declares. Formatters not declaring any have none
+    """
+    return frozenset(getattr(formatter, "CAPABILITIES", ()))
+
+
+def _create_default_registry() -> FormatterRegistry:
+    result = FormatterRegistry()
+    result.register("jinja2", "template_formatter.Jinja2Formatter:Jinja2Formatter", persistent_environment=True)
+    result.register("format", "template_formatter.PythonFormatFormatter:PythonFormatFormatter")
+    result.register("fstring", "template_formatter.FStringFormatter:FStringFormatter")
+    result.register("python", "template_formatter.PythonFormatter:PythonFormatter")
+    return result
+
+
+# the registry used by the command line
+registry: FormatterRegistry = _create_default_registry()
@@ -1,9 +1,28 @@
 import abc
-from typing import Dict, Any, Callable
+from typing import Dict, Any, Callable, List, Optional, Iterable, FrozenSet, Tuple, AsyncIterator
+
+# capabilities a formatter may declare in CAPABILITIES:
+# render_stream generates the output piece by piece
+STREAMING = "streaming"
+# different instances can render at the same time in different threads of the same process
+THREAD_SAFE = "thread_safe"
+# compiled templates survive init_string/init_file/reset, hence an instance is worth reusing
+CACHEABLE = "cacheable"
+# if created with enable_async=True, render_template_async and render_stream_async await the coroutines returned by
+# the functions the template calls
+ASYNC = "async"
+
+# called with the name of an event (e.g., "init", "render", "environment"), the seconds it has taken and its details
+MetricsCallback = Callable[[str, float, Dict[str, Any]], None]
 
 
 class ITemplateFormatter(abc.ABC):
 
+    CAPABILITIES: FrozenSet[str] = frozenset()
+
+    # see set_metrics_callback
+    metrics_callback: Optional[MetricsCallback] = None
+
     @abc.abstractmethod
     def init_string(self, string: str, app_context: "AppContext"):
         pass
@@ -16,6 +35,77 @@ class ITemplateFormatter(abc.ABC):
     def render_template(self, model: Dict[str, Any], commons: Dict[str, Any], functions: Dict[str, Callable]) -> str:
         pass
 
+    def render_stream(self, model: Dict[str, Any], commons: Dict[str, Any], functions: Dict[str, Callable]) -> Iterable[str]:
+        """
+        Render the template piece by piece, so that the output can be written while it is generated.
+        By default, the whole template is rendered in a single piece
+
+        :return: the pieces of the rendered template
+        """
+        yield self.render_template(model=model, commons=commons, functions=functions)
+
+    async def render_template_async(self, model: Dict[str, Any], commons: Dict[str, Any], functions: Dict[str, Callable]) -> str:
+        """
+        Like render_template, but it can be awaited. Formatters declaring ASYNC (and created with enable_async=True)
+        await the coroutine functions the template calls while rendering it, without blocking the event loop.
+        By default, the template is rendered by render_template
+        """
+        return self.render_template(model=model, commons=commons, functions=functions)
+
+    async def render_stream_async(self, model: Dict[str, Any], commons: Dict[str, Any], functions: Dict[str, Callable]) -> AsyncIterator[str]:
+        """
+        Like render_stream, but the pieces are generated asynchronously (see render_template_async).
+        By default, the pieces are the ones of render_stream
+        """
+        for chunk in self.render_stream(model=model, commons=commons, functions=functions):
+            yield chunk
+
     @abc.abstractmethod
     def reset(self):
-        pass
\ No newline at end of file
+        pass
+
+    def may_contain_template(self, string: str, app_context: "AppContext") -> bool:
+        """
+        Check cheaply whether rendering a string may generate something different from the string itself.
+        Used to avoid rendering the names of the files and directories to template which contain no template syntax.
+        By default, every string may contain a template
+
+        :return: false if rendering the string surely generates the string itself
+        """
+        return True
+
+    def get_template_dependencies(self) -> Optional[List[str]]:
+        """
+        Templates the template currently initialized includes, extends or imports, even transitively
+
+        :return: the absolute paths of the templates, or None if they cannot be determined statically.
+            By default, templates cannot include other files
+        """
+        return []
+
+    def cache_info(self) -> Optional[Tuple[int, int]]:
+        """
+        :return: how many times the compiled template has been found in the cache (hits) and how many times it has
+            been compiled (misses) by init_string and init_file. None if the formatter has no cache
+        """
+        return None
+
+    def set_metrics_callback(self, callback: Optional[MetricsCallback]):
+        """
+        Let a host application collect the metrics of this formatter (the same ones --profile shows).
+        The callback is called with:
+
+         - "init", when a template is initialized: details contain the template and whether it was found in the
+           cache (cache_hit, None if the formatter has no cache);
+         - "render", when a template is rendered: details contain the template and the number of characters
+           generated;
+         - "environment", when the formatter sets up what it needs to compile templates (e.g., a jinja2
+           environment).
+
+        :param callback: function to call, or None to stop collecting metrics
+        """
+        self.metrics_callback = callback
+
+    def _report_metric(self, event: str, seconds: float, **details):
+        if self.metrics_callback is not None:
+            self.metrics_callback(event, seconds, details)
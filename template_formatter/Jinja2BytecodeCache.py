@@ -0,0 +1,121 @@
+import hashlib
+import logging
+import os
+import tempfile
+from typing import Optional
+
+import jinja2
+from jinja2.bccache import Bucket
+
+
+class Jinja2BytecodeCache(jinja2.FileSystemBytecodeCache):
+    """
+    A jinja2 bytecode cache that survives across several invocations of the program.
+
+    Entries are keyed on the template content, on the delimiters of the environment and on the jinja2 version, so
+    a template compiled with different settings is never reused by mistake. Entries are written in a temporary
+    file and then atomically renamed, hence several processes can share the same directory.
+    The directory is bounded: whenever it grows over max_size bytes, the least recently used entries are removed.
+    """
+
+    PATTERN = "__template_formatter_%s.cache"
+
+    def __init__(self, directory: str, max_size: int):
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(directory=directory, pattern=self.PATTERN)
+        self.max_size = max_size
+        # estimate of the cache directory size. None if we still need to scan the directory
+        self.__current_size: Optional[int] = None
+
+    def get_bucket(self, environment: jinja2.Environment, name: str, filename: Optional[str], source: str) -> Bucket:
+        key = hashlib.sha256("\0".join(map(str, (
+            jinja2.__version__,
+            environment.block_start_string,
+            environment.block_end_string,
+            environment.variable_start_string,
+            environment.variable_end_string,
+            environment.comment_start_string,
+            environment.comment_end_string,
+            environment.line_statement_prefix,
+            environment.line_comment_prefix,
+            environment.trim_blocks,
+            environment.lstrip_blocks,
+            environment.keep_trailing_newline,
+            environment.is_async,
+            # the compiled code contains the name of the template
+            name,
+            filename,
+            source,
+        ))).encode("utf-8")).hexdigest()
+        bucket = Bucket(environment, key, self.get_source_checksum(source))
+        self.load_bytecode(bucket)
+        return bucket
+
+    def load_bytecode(self, bucket: Bucket):
+        super().load_bytecode(bucket)
+        if bucket.code is not None:
+            # mark the entry as recently used
+            try:
+                os.utime(self._get_cache_filename(bucket))
+            except OSError:
+                pass
+
+    def dump_bytecode(self, bucket: Bucket):
+        name = self._get_cache_filename(bucket)
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory, prefix=os.path.basename(name), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                bucket.write_bytecode(f)
+                size = f.tell()
+            os.replace(tmp_name, name)
+        except OSError as e:
+            # another process may have cleared the directory in the meantime. The cache is just an optimization
+            logging.info(f"cannot write the jinja2 bytecode cache entry {name}: {e}")
+            try:
+                os.remove(tmp_name)
+            except OSError:
+                pass
+            return
+
+        if self.__current_size is None:
+            self.__current_size = self._compute_size()
+        else:
+            self.__current_size += size
+        if self.__current_size > self.max_size:
+            self._evict()
+
+    def _compute_size(self) -> int:
+        result = 0
+        for entry in self._scan():
+            result += entry[2]
+        return result
+
+    def _scan(self):
+        prefix, suffix = self.PATTERN.split("%s")
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not (entry.name.startswith(prefix) and entry.name.endswith(suffix)):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                yield entry.path, stat.st_mtime, stat.st_size
+
+    def _evict(self):
+        """
+        Remove the least recently used entries until the cache uses at most 90% of its maximum size
+        """
+        entries = sorted(self._scan(), key=lambda x: x[1])
+        total = sum(map(lambda x: x[2], entries))
+        target = self.max_size * 0.9
+        for path, _, size in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # another process has already removed it
+                pass
+            total -= size
+        self.__current_size = total
@@ -1,50 +1,273 @@
+import collections
 import os
-from typing import Dict, Any, Callable
+import time
+from typing import Dict, Any, Callable, Optional, Tuple, List, Iterable, AsyncIterator
 
 import jinja2
+import jinja2.meta
 from jinja2 import BaseLoader
+from jinja2.utils import LRUCache
 
-from template_formatter.ITemplateFormatter import ITemplateFormatter
+from template_formatter.ITemplateFormatter import ITemplateFormatter, STREAMING, THREAD_SAFE, CACHEABLE, ASYNC
+from template_formatter.Jinja2BytecodeCache import Jinja2BytecodeCache
+from template_formatter.RenderContext import get_render_context
 
 
 class Jinja2Formatter(ITemplateFormatter):
 
-    def __init__(self):
+    CAPABILITIES = frozenset([STREAMING, THREAD_SAFE, CACHEABLE, ASYNC])
+
+    def __init__(self, persistent_environment: bool = False, cache_size: int = 400, enable_async: bool = False):
+        """
+        :param persistent_environment: if set, the jinja2 environment is created only once (per delimiter settings)
+            and it survives to reset(). Compiled templates are kept in a LRU cache: string templates are keyed by their
+            source, file templates by their path (jinja2 checks the file mtime before reusing them).
+            If not set, a brand new environment is created every time we initialize a template
+        :param cache_size: maximum number of compiled templates to keep in the cache in persistent mode
+        :param enable_async: if set, templates are compiled with the jinja2 async mode: render_template_async and
+            render_stream_async await the coroutine functions the templates call. The synchronous methods run their
+            own event loop (render_stream still generates the pieces one at a time), hence they cannot be called from
+            a coroutine. The bytecode cache is not used
+        """
+        self.__persistent_environment = persistent_environment
+        self.__enable_async = enable_async
+        self.__cache_size = cache_size
         self.__template_loader = None
         self.__env = None
         self.__template = None
+        # persistent mode only
+        self.__env_settings: Optional[Tuple[str, ...]] = None
+        self.__base_env: Optional[jinja2.Environment] = None
+        self.__file_envs: Optional[LRUCache] = None
+        self.__string_templates: Optional[LRUCache] = None
+        self.__bytecode_cache: Optional[Jinja2BytecodeCache] = None
+        # (template file, mtime) -> templates directly referenced by the template file
+        self.__referenced_templates: LRUCache = LRUCache(cache_size)
+        # persistent mode only: compiled templates found in the cache (hits) and compiled (misses)
+        self.__cache_hits = 0
+        self.__cache_misses = 0
 
     def init_string(self, string: str, app_context: "AppContext"):
+        if self.__persistent_environment:
+            self._setup_persistent_env(app_context)
+            self.__env = self.__base_env
+            template = self.__string_templates.get(string)
+            if template is None:
+                self.__cache_misses += 1
+                template = self._compile_string(string)
+                self.__string_templates[string] = template
+            else:
+                self.__cache_hits += 1
+            self.__template = template
+            return
+
         self.__template_loader = BaseLoader()
         self._setup_env(app_context)
-        self.__template = self.__env.from_string(string)
+        self.__template = self._compile_string(string)
 
     def init_file(self, f: str, encoding: str, app_context: "AppContext"):
+        search_path = os.path.abspath(os.path.dirname(f))
+        if self.__persistent_environment:
+            self._setup_persistent_env(app_context)
+            key = (search_path, encoding)
+            env = self.__file_envs.get(key)
+            if env is None:
+                # the overlay shares the compiled template cache with the base environment. Entries are keyed by
+                # loader and template name, so templates with the same name in different directories do not clash
+                env = self.__base_env.overlay(loader=_CountingFileSystemLoader(searchpath=search_path, encoding=encoding))
+                env.cache = self.__base_env.cache
+                self.__file_envs[key] = env
+            self.__env = env
+            # jinja2 asks the loader for a template only if it has no up to date compiled template in its cache
+            loads = env.loader.loads
+            self.__template = self.__env.get_template(os.path.basename(f))
+            if env.loader.loads == loads:
+                self.__cache_hits += 1
+            else:
+                self.__cache_misses += 1
+            return
+
         self.__template_loader = jinja2.FileSystemLoader(
-            searchpath=os.path.abspath(os.path.dirname(f)),
+            searchpath=search_path,
             encoding=encoding
         )
         self._setup_env(app_context)
         self.__template = self.__env.get_template(os.path.basename(f))
 
+    def may_contain_template(self, string: str, app_context: "AppContext") -> bool:
+        # jinja2 removes a single trailing newline
+        if "\n" in string:
+            return True
+        delimiters = (app_context.block_start_string or "{%", app_context.expression_start_string or "{{", app_context.comment_start_string or "{#")
+        if any(map(lambda x: x in string, delimiters)):
+            return True
+        return app_context.line_statement_prefix is not None and app_context.line_statement_prefix in string
+
     def render_template(self, model: Dict[str, Any], commons: Dict[str, Any], functions: Dict[str, Callable]) -> str:
-        return self.__template.render(
-            # data
-            model=model,
-            commons=commons,
-            functions=functions,
-            # commons function (they are so popular that we put them on the cwd)
-            **functions
-        )
+        if self.__enable_async:
+            # like jinja2 does for async templates
+            import asyncio
+            return asyncio.run(self.render_template_async(model, commons, functions))
+        # like self.__template.render, without copying the variables and the globals at every render
+        template = self.__template
+        context = template.new_context(self._get_variables(model, commons, functions), shared=True)
+        try:
+            return template.environment.concat(template.root_render_func(context))
+        except Exception:
+            return template.environment.handle_exception()
+
+    def render_stream(self, model: Dict[str, Any], commons: Dict[str, Any], functions: Dict[str, Callable]) -> Iterable[str]:
+        template = self.__template
+        context = template.new_context(self._get_variables(model, commons, functions), shared=True)
+        if self.__enable_async:
+            return self._generate_in_loop(self._generate_async(template, context))
+        return self._generate(template, context)
+
+    @staticmethod
+    def _generate(template: jinja2.Template, context: "jinja2.runtime.Context") -> Iterable[str]:
+        try:
+            yield from template.root_render_func(context)
+        except Exception:
+            yield template.environment.handle_exception()
+
+    @staticmethod
+    async def _generate_async(template: jinja2.Template, context: "jinja2.runtime.Context") -> AsyncIterator[str]:
+        try:
+            async for chunk in template.root_render_func(context):
+                yield chunk
+        except Exception:
+            yield template.environment.handle_exception()
+
+    @staticmethod
+    def _generate_in_loop(chunks: AsyncIterator[str]) -> Iterable[str]:
+        """
+        :return: the pieces generated by chunks, each one generated (one at a time) in an event loop of our own
+        """
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(chunks.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(chunks.aclose())
+            loop.close()
+
+    async def render_template_async(self, model: Dict[str, Any], commons: Dict[str, Any], functions: Dict[str, Callable]) -> str:
+        if not self.__enable_async:
+            return self.render_template(model, commons, functions)
+        template = self.__template
+        context = template.new_context(self._get_variables(model, commons, functions), shared=True)
+        try:
+            return template.environment.concat([x async for x in template.root_render_func(context)])
+        except Exception:
+            return template.environment.handle_exception()
+
+    async def render_stream_async(self, model: Dict[str, Any], commons: Dict[str, Any], functions: Dict[str, Callable]) -> AsyncIterator[str]:
+        if not self.__enable_async:
+            for chunk in self.render_stream(model, commons, functions):
+                yield chunk
+            return
+        template = self.__template
+        context = template.new_context(self._get_variables(model, commons, functions), shared=True)
+        async for chunk in self._generate_async(template, context):
+            yield chunk
+
+    def _get_variables(self, model: Dict[str, Any], commons: Dict[str, Any], functions: Dict[str, Callable]) -> Dict[str, Any]:
+        """
+        :return: the globals of the template, plus model, commons, functions and every function (which are so popular
+            that we put them on the cwd). Since the template context is shared, the result needs to contain the
+            globals as well
+        """
+        template_globals = self.__template.globals
+        if isinstance(template_globals, collections.ChainMap) and len(template_globals.maps) == 2 and len(template_globals.maps[0]) == 0:
+            # the template has no globals of its own: every template of the environment has the same globals
+            template_globals = template_globals.maps[1]
+        return get_render_context(commons, functions).get_names(model, template_globals)
+
+    def get_template_dependencies(self) -> Optional[List[str]]:
+        env = self.__env
+        if env.loader is None or self.__template.filename is None:
+            # a string template cannot include anything
+            return []
+        result = []
+        visited = set()
+        to_visit = [self.__template.name]
+        while len(to_visit) > 0:
+            name = to_visit.pop()
+            if name in visited:
+                continue
+            visited.add(name)
+            try:
+                source, filename, _ = env.loader.get_source(env, name)
+            except jinja2.TemplateNotFound:
+                # e.g., {% include "foo" ignore missing %}
+                continue
+            if name != self.__template.name:
+                result.append(os.path.abspath(filename))
+            references = self._get_referenced_templates(name, source, filename)
+            if references is None:
+                return None
+            to_visit.extend(map(lambda x: env.join_path(x, name), references))
+        return result
+
+    def _get_referenced_templates(self, name: str, source: str, filename: Optional[str]) -> Optional[List[str]]:
+        """
+        :return: the names of the templates directly referenced by the given template. None if some of them is not
+            a constant
+        """
+        key = (filename, os.stat(filename).st_mtime_ns) if filename is not None else None
+        if key is not None and key in self.__referenced_templates:
+            return self.__referenced_templates[key]
+        references = list(jinja2.meta.find_referenced_templates(self.__env.parse(source, name, filename)))
+        result = None if None in references else references
+        if key is not None:
+            self.__referenced_templates[key] = result
+        return result
+
+    def cache_info(self) -> Optional[Tuple[int, int]]:
+        if not self.__persistent_environment:
+            return None
+        return self.__cache_hits, self.__cache_misses
 
     def reset(self):
         self.__template_loader = None
         self.__env = None
         self.__template = None
 
+    def _compile_string(self, string: str) -> jinja2.Template:
+        """
+        Compile a string template, using the bytecode cache if present.
+        Jinja2 uses the bytecode cache only for templates loaded by a loader, hence we need to do it by ourselves
+        """
+        bytecode_cache = self.__env.bytecode_cache
+        if bytecode_cache is None:
+            return self.__env.from_string(string)
+        bucket = bytecode_cache.get_bucket(self.__env, "<template>", None, string)
+        code = bucket.code
+        if code is None:
+            code = self.__env.compile(string)
+            bucket.code = code
+            bytecode_cache.set_bucket(bucket)
+        return self.__env.template_class.from_code(self.__env, code, self.__env.make_globals(None), None)
+
+    def _get_bytecode_cache(self, app_context: "AppContext") -> Optional[Jinja2BytecodeCache]:
+        if app_context.cache_dir is None:
+            return None
+        cache_dir = os.path.abspath(app_context.cache_dir)
+        if self.__bytecode_cache is None or self.__bytecode_cache.directory != cache_dir or self.__bytecode_cache.max_size != app_context.cache_max_size:
+            self.__bytecode_cache = Jinja2BytecodeCache(cache_dir, app_context.cache_max_size)
+        return self.__bytecode_cache
+
     def _setup_env(self, app_context: "AppContext"):
+        start = time.perf_counter()
         self.__env = jinja2.Environment(
             loader=self.__template_loader,
+            # the bytecode cache keys do not depend on the async mode, while the compiled code does
+            bytecode_cache=None if self.__enable_async else self._get_bytecode_cache(app_context),
+            enable_async=self.__enable_async,
             block_start_string=app_context.block_start_string,
             block_end_string=app_context.block_end_string,
             variable_start_string=app_context.expression_start_string,
@@ -52,4 +275,44 @@ class Jinja2Formatter(ITemplateFormatter):
             comment_start_string=app_context.comment_start_string,
             comment_end_string=app_context.comment_end_string,
             line_statement_prefix=app_context.line_statement_prefix
-        )
\ No newline at end of file
+        )
+        self._report_metric("environment", time.perf_counter() - start)
+
+    def _setup_persistent_env(self, app_context: "AppContext"):
+        """
+        Create the persistent environment, unless we have already built one with the same delimiters
+        """
+        settings = (
+            app_context.block_start_string,
+            app_context.block_end_string,
+            app_context.expression_start_string,
+            app_context.expression_end_string,
+            app_context.comment_start_string,
+            app_context.comment_end_string,
+            app_context.line_statement_prefix,
+            app_context.cache_dir,
+            app_context.cache_max_size,
+        )
+        if self.__base_env is not None and self.__env_settings == settings:
+            return
+        self.__template_loader = None
+        self._setup_env(app_context)
+        self.__env.cache = LRUCache(self.__cache_size)
+        self.__base_env = self.__env
+        self.__env_settings = settings
+        self.__file_envs = LRUCache(self.__cache_size)
+        self.__string_templates = LRUCache(self.__cache_size)
+
+
+class _CountingFileSystemLoader(jinja2.FileSystemLoader):
+    """
+    A FileSystemLoader counting the templates it loads (and compiles)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loads = 0
+
+    def load(self, environment: jinja2.Environment, name: str, globals: Optional[Dict[str, Any]] = None) -> jinja2.Template:
+        self.loads += 1
+        return super().load(environment, name, globals)
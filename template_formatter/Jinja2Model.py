@@ -1,5 +1,9 @@
-import pprint
-from typing import Dict, Any, Callable, List, Optional
+import functools
+import re
+from typing import Dict, Any, Callable, List, Optional, Set, Tuple, Union
+
+# a path inside the model, like ("persons", 0, "surname") for persons[0].surname
+KeyPath = Tuple[Union[str, int], ...]
 
 
 class ValueKeyNotFound(Exception):
@@ -10,8 +14,16 @@ class ValueKeyNotFound(Exception):
 
 
 class DynamicObject(object):
+    """
+    A node of the model. It is either a dictionary of fields, a list of items or a plain value.
+
+    Reading never changes the tree: reading a missing field or item yields EMPTY, a shared empty node. Nodes are
+    created only by the write methods (e.g., get_or_create_field), used when the model is built.
+    Fields and items may be plain python objects (e.g., dictionaries read from the configuration file):
+    they are converted into nodes only if we need to write inside them
+    """
 
-    _slots = "_dictionary", "_list", "_value"
+    __slots__ = ("_dictionary", "_list", "_value")
 
     def __init__(self):
         self._dictionary: Optional[Dict[str, Any]] = None
@@ -19,24 +31,17 @@ class DynamicObject(object):
         self._value: Any = None
 
     def __getattr__(self, item: str) -> Any:
+        # called only for names which are not methods or initialized slots
+        if item.startswith("__") or item in DynamicObject.__slots__:
+            # protocols looked up on the instance (e.g., __deepcopy__) are not fields
+            raise AttributeError(item)
+        dictionary = self._dictionary
+        if dictionary is None:
+            return EMPTY
+        return dictionary.get(item, EMPTY)
 
-        if item in self._slots:
-            return self.__dict__[item]
-            # object.__getattribute__(self, item)
-        elif item in '__len__':
-            return self.__len__
-        else:
-            if self._dictionary is None:
-                self._dictionary = {}
-
-            if item not in self._dictionary:
-                self._dictionary[item] = DynamicObject()
-            return self._dictionary[item]
-
-    def __contains__(self, item):
-        if self._dictionary is None:
-            self._dictionary = {}
-        return item in self._dictionary
+    def __contains__(self, item) -> bool:
+        return self._dictionary is not None and item in self._dictionary
 
     def __iter__(self):
         if self._dictionary is not None:
@@ -46,23 +51,118 @@ class DynamicObject(object):
         else:
             return iter(self._value)
 
-    def __getitem__(self, item: int):
+    def __getitem__(self, item: Union[int, str]):
+        if isinstance(item, str):
+            return self.__getattr__(item)
         if self._list is None:
-            self._list = []
-        while True:
-            if 0 <= item < len(self._list):
-                break
-            self._list.append(DynamicObject())
-        return self._list[item]
+            return EMPTY
+        try:
+            return self._list[item]
+        except IndexError:
+            return EMPTY
+
+    def get_or_create_field(self, k: str) -> "DynamicObject":
+        """
+        :param k: name of the field
+        :return: the node of the given field. If the field does not exist, it is created. If the field contains a
+            plain value (e.g., a string read from the configuration file), it is replaced by a new node, while
+            dictionaries and lists are converted into nodes
+        """
+        if self._dictionary is None:
+            self._dictionary = {}
+        result = self._dictionary.get(k)
+        if not isinstance(result, DynamicObject):
+            result = DynamicObject.from_plain(result)
+            self._dictionary[k] = result
+        return result
+
+    def get_or_create_item(self, index: Optional[int]) -> "DynamicObject":
+        """
+        :param index: index of the item. If None, we use the last item.
+            If the list is too short, it is extended: the items in between are left empty and take no memory.
+            Negative indices count from the end of the list
+        :return: the node of the given item. Plain values are handled like in get_or_create_field
+        """
+        items, index = self._get_item_index(index)
+        if index < len(items):
+            result = items[index]
+            if result is EMPTY or not isinstance(result, DynamicObject):
+                result = DynamicObject.from_plain(result)
+                items[index] = result
+        else:
+            result = DynamicObject()
+            items[index] = result
+        return result
+
+    def set_item(self, index: Optional[int], v: Any):
+        """
+        :param index: index of the item, like in get_or_create_item
+        :param v: value of the item
+        """
+        items, index = self._get_item_index(index)
+        items[index] = v
+
+    def _get_item_index(self, index: Optional[int]) -> Tuple["SparseList", int]:
+        """
+        :return: the items of this node (converted into a SparseList, if needed) and the non negative index the given
+            one refers to (see get_or_create_item)
+        """
+        if self._list is None:
+            self._list = SparseList()
+        elif not isinstance(self._list, SparseList):
+            # a list read from the configuration file
+            self._list = SparseList(self._list)
+        items = self._list
+        length = items._length
+        if index is None:
+            index = max(length - 1, 0)
+        elif index < 0:
+            if -index > length:
+                raise ValueError(f"index {index} is out of range, since the list has only {length} items")
+            index += length
+        return items, index
+
+    @classmethod
+    def from_plain(cls, value: Any) -> "DynamicObject":
+        """
+        :param value: a dictionary or a list (e.g., read from the configuration file). Anything else is discarded
+        :return: a node containing the items of the given dictionary or list. The dictionary or list is not copied:
+            the node uses it directly
+        """
+        result = cls()
+        if isinstance(value, dict):
+            result._dictionary = value
+        elif isinstance(value, list):
+            result._list = value
+        return result
 
     def set_field(self, k: str, v: Any):
         if self._dictionary is None:
             self._dictionary = {}
         self._dictionary[k] = v
 
+    def set_fields(self, fields: Dict[str, Any]):
+        """
+        :param fields: fields to set. If this node has no field yet, the dictionary is used as is, without copying it
+        """
+        if self._dictionary is None:
+            self._dictionary = fields
+        else:
+            self._dictionary.update(fields)
+
     def set_value(self, v: Any):
         self._value = v
 
+    def with_fields(self, fields: Dict[str, Any]) -> "DynamicObject":
+        """
+        :param fields: fields to add
+        :return: a shallow copy of this object, where the given fields are added (or replaced)
+        """
+        result = DynamicObject()
+        result._dictionary = dict(self._dictionary) if self._dictionary is not None else {}
+        result._dictionary.update(fields)
+        return result
+
     def __str__(self) -> str:
         if self._list is not None:
             return "[" + ', '.join(map(str, self._list)) + "]"
@@ -73,6 +173,263 @@ class DynamicObject(object):
             return str(self._value)
 
 
+class SparseList(object):
+    """
+    The items of a node of the model built by --value. Writing the item at any index takes O(1): items written in
+    order are stored in a plain list, while the ones written after a gap are stored in a dictionary.
+    Reading an index in a gap yields EMPTY
+    """
+
+    __slots__ = ("_dense", "_sparse", "_length")
+
+    def __init__(self, items: Optional[List[Any]] = None):
+        """
+        :param items: the first items of the list. The list is used as is, without copying it
+        """
+        self._dense: List[Any] = items if items is not None else []
+        self._sparse: Dict[int, Any] = {}
+        self._length = len(self._dense)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index: int) -> Any:
+        i = index + self._length if index < 0 else index
+        if not (0 <= i < self._length):
+            raise IndexError(index)
+        if i < len(self._dense):
+            return self._dense[i]
+        return self._sparse.get(i, EMPTY)
+
+    def __setitem__(self, index: int, value: Any):
+        i = index + self._length if index < 0 else index
+        if i < 0:
+            raise IndexError(index)
+        dense = self._dense
+        if i < len(dense):
+            dense[i] = value
+        elif i == len(dense):
+            dense.append(value)
+            # the gap may be closed: move the items after it in the plain list
+            sparse = self._sparse
+            while len(sparse) > 0 and len(dense) in sparse:
+                dense.append(sparse.pop(len(dense)))
+        else:
+            self._sparse[i] = value
+        if i >= self._length:
+            self._length = i + 1
+
+    def __iter__(self):
+        yield from self._dense
+        sparse = self._sparse
+        for i in range(len(self._dense), self._length):
+            yield sparse.get(i, EMPTY)
+
+
+class _EmptyDynamicObject(DynamicObject):
+    """
+    The node returned when reading something which is not in the model. It cannot be changed
+    """
+
+    __slots__ = ()
+
+    def __init__(self):
+        object.__setattr__(self, "_dictionary", None)
+        object.__setattr__(self, "_list", None)
+        object.__setattr__(self, "_value", None)
+
+    def __setattr__(self, key: str, value: Any):
+        raise ValueError(f"cannot change a node which is not in the model. Use get_or_create_field or get_or_create_item to create it")
+
+    def __reduce__(self):
+        return "EMPTY"
+
+
+EMPTY = _EmptyDynamicObject()
+
+
+class MissingValue(object):
+    """
+    Value returned by resolve_key_path when the key does not exist in the model
+    """
+
+    def __str__(self) -> str:
+        return "<missing>"
+
+
+MISSING = MissingValue()
+
+
+def resolve_key_path(values: DynamicObject, path: KeyPath) -> Any:
+    """
+    Fetch the value at the given path, without creating any missing node in the model
+
+    :param values: root of the model
+    :param path: path to fetch
+    :return: the value at the given path, or MISSING if there is no such value
+    """
+    result = values
+    for step in path:
+        if not isinstance(result, DynamicObject):
+            return MISSING
+        if isinstance(step, int):
+            if result._list is None or not (0 <= step < len(result._list)):
+                return MISSING
+            result = result._list[step]
+        else:
+            if result._dictionary is None or step not in result._dictionary:
+                return MISSING
+            result = result._dictionary[step]
+    return result
+
+
+_KEY_PATH_NAME = re.compile(r"[^.\[\]]+")
+_KEY_PATH_STEP = re.compile(r"\.([^.\[\]]+)|\[(-?\d*)\]")
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_key_path(key: str) -> KeyPath:
+    """
+    Parse a key in the syntax of --value
+
+    :param key: key to parse, e.g., persons[0].surname or persons[].surname
+    :return: the path of the key, e.g., ("persons", 0, "surname"). [] (the last item of a list) is represented by None
+    """
+    match = _KEY_PATH_NAME.match(key)
+    if match is None:
+        raise ValueError(f"invalid key {key!r}: it needs to start with a name")
+    result = [match.group(0)]
+    position = match.end()
+    while position < len(key):
+        match = _KEY_PATH_STEP.match(key, position)
+        if match is None:
+            raise ValueError(f"invalid key {key!r}: unexpected character at position {position}")
+        if match.group(1) is not None:
+            result.append(match.group(1))
+        elif match.group(2) == "":
+            result.append(None)
+        else:
+            result.append(int(match.group(2)))
+        position = match.end()
+    return tuple(result)
+
+
+def set_key_path(values: DynamicObject, path: KeyPath, value: Any):
+    """
+    Set the value at the given path, creating every missing node
+
+    :param values: root of the model
+    :param path: path to set, as returned by parse_key_path
+    :param value: value to set. Dictionaries and lists (e.g., read from a values file) become the fields or the items
+        of the node at the given path
+    """
+    node = values
+    for step in path[:-1]:
+        if isinstance(step, str):
+            node = node.get_or_create_field(step)
+        else:
+            node = node.get_or_create_item(step)
+    step = path[-1]
+    if isinstance(value, (dict, list)):
+        # like the values of the configuration file, they are converted into nodes only if we write inside them
+        if isinstance(step, str):
+            node.set_field(step, value)
+        else:
+            node.set_item(step, value)
+        return
+    if isinstance(step, str):
+        node = node.get_or_create_field(step)
+    else:
+        node = node.get_or_create_item(step)
+    node.set_value(value)
+
+
+def format_key_path(path: KeyPath) -> str:
+    """
+    :param path: path to convert
+    :return: the path in the same syntax of --value, e.g., persons[0].surname
+    """
+    result = ""
+    for step in path:
+        if isinstance(step, int):
+            result += f"[{step}]"
+        elif result == "":
+            result = step
+        else:
+            result += "." + step
+    return result
+
+
+class RecordingDynamicObject(object):
+    """
+    A transparent view over a DynamicObject that records which keys of the model a template reads.
+
+    A key is recorded when the template reaches a plain value (e.g., a string), when it reads a key which is not in
+    the model (so that adding the key later changes the output) or when it uses a whole node (e.g., it prints it,
+    tests it, iterates over it or compares it). Keys are recorded in the shared set accessed_keys
+    """
+
+    __slots__ = ("_target", "_path", "_accessed_keys")
+
+    def __init__(self, target: DynamicObject, path: KeyPath = (), accessed_keys: Optional[Set[KeyPath]] = None):
+        self._target = target
+        self._path = path
+        self._accessed_keys = accessed_keys if accessed_keys is not None else set()
+
+    @property
+    def accessed_keys(self) -> Set[KeyPath]:
+        return self._accessed_keys
+
+    def _wrap(self, value: Any, path: KeyPath) -> Any:
+        if isinstance(value, DynamicObject):
+            if value is EMPTY:
+                self._accessed_keys.add(path)
+            return RecordingDynamicObject(value, path, self._accessed_keys)
+        self._accessed_keys.add(path)
+        return value
+
+    def _record(self) -> DynamicObject:
+        self._accessed_keys.add(self._path)
+        return self._target
+
+    def __getattr__(self, item: str) -> Any:
+        if item.startswith("__"):
+            raise AttributeError(item)
+        return self._wrap(getattr(self._target, item), self._path + (item, ))
+
+    def __getitem__(self, item: int) -> Any:
+        return self._wrap(self._target[item], self._path + (item, ))
+
+    def __iter__(self):
+        target = self._record()
+        if target._list is not None:
+            return iter(map(lambda x: self._wrap(x[1], self._path + (x[0], )), enumerate(target._list)))
+        return iter(target)
+
+    def __contains__(self, item) -> bool:
+        return item in self._record()
+
+    def __bool__(self) -> bool:
+        return bool(self._record())
+
+    def __len__(self) -> int:
+        return len(self._record())
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, RecordingDynamicObject):
+            other = other._record()
+        return self._record() == other
+
+    def __hash__(self) -> int:
+        return hash(self._target)
+
+    def __format__(self, format_spec: str) -> str:
+        return format(self._record(), format_spec)
+
+    def __str__(self) -> str:
+        return str(self._record())
+
+
 class Jinja2Model(object):
 
     def __init__(self):
@@ -81,6 +438,7 @@ class Jinja2Model(object):
         self.commons: Dict[str, Any] = {}
 
     def __str__(self) -> str:
+        import pprint
         pp = pprint.PrettyPrinter(indent=4, sort_dicts=True)
         obj = {
             "values": self.values,
@@ -0,0 +1,224 @@
+import codecs
+import os
+import tempfile
+import threading
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+
+def _get_umask() -> int:
+    # os.umask can only be read by changing it
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+class OutputWriter(object):
+    """
+    Writes the generated files.
+
+    A file is written in a temporary file in the same directory, which is then renamed as the output file: if the
+    program is interrupted (or a template fails) while a file is generated, the previous version of the file is left
+    untouched, instead of a half-written file.
+    If write_if_changed is set, an output file whose content would not change is not written at all, so that its
+    modification time does not change and build systems (make, ninja, ...) do not rebuild what depends on it.
+    The existing file is compared while the new content is generated: first by size (when the whole content is known
+    in advance), then byte by byte.
+
+    Files are written like open(file, "w", encoding=encoding) would write them (hence with the newlines of the
+    platform). New files get the permissions open would give them, existing files keep theirs.
+    A writer can be used by several threads at once: it counts the files it has written and left unchanged.
+    Worker processes forked from the one owning the writer count in their own copy: they send their counts back with
+    drain, and the owner adds them with merge (like Profiler)
+    """
+
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, encoding: str = "utf-8", write_if_changed: bool = True):
+        """
+        :param encoding: encoding of the output files
+        :param write_if_changed: if set, files whose content has not changed are not written
+        """
+        codecs.lookup(encoding)
+        self.encoding = encoding
+        self.write_if_changed = write_if_changed
+        self.written = 0
+        self.unchanged = 0
+        self.pid = os.getpid()
+        self._new_file_mode = 0o666 & ~_get_umask()
+        self._lock = threading.Lock()
+
+    def write(self, path: str, content: str) -> bool:
+        """
+        :param path: output file
+        :param content: content of the output file
+        :return: true if the file has been written, false if it was already up to date
+        """
+        data = self._encode(codecs.getincrementalencoder(self.encoding)(), content, True)
+        if self.write_if_changed and self._has_content(path, data):
+            return self.count(False)
+        with self._open_temporary(path) as (f, temporary):
+            f.write(data)
+        self._replace(temporary, path)
+        return self.count(True)
+
+    def write_stream(self, path: str, chunks: Iterable[str]) -> bool:
+        """
+        Like write, but the content is generated piece by piece, so that it is never completely in memory.
+        If write_if_changed is set, the pieces are compared with the existing file first: the temporary file is
+        created only once they differ from it, and it starts with the part of the existing file they have matched
+
+        :param chunks: the pieces of the content of the output file
+        """
+        pieces = self._encode_stream(chunks)
+        existing = self._open_existing(path) if self.write_if_changed else None
+        if existing is None:
+            with self._open_temporary(path) as (f, temporary):
+                for data in pieces:
+                    f.write(data)
+            self._replace(temporary, path)
+            return self.count(True)
+
+        with existing:
+            size = os.fstat(existing.fileno()).st_size
+            # bytes at the beginning of the existing file equal to the pieces generated so far
+            matched = 0
+            different = b""
+            for data in pieces:
+                if matched + len(data) > size or existing.read(len(data)) != data:
+                    different = data
+                    break
+                matched += len(data)
+            else:
+                if matched == size:
+                    return self.count(False)
+            with self._open_temporary(path) as (f, temporary):
+                existing.seek(0)
+                while matched > 0:
+                    data = existing.read(min(matched, self.BUFFER_SIZE))
+                    f.write(data)
+                    matched -= len(data)
+                f.write(different)
+                for data in pieces:
+                    f.write(data)
+        self._replace(temporary, path)
+        return self.count(True)
+
+    def _encode_stream(self, chunks: Iterable[str]) -> Iterator[bytes]:
+        encoder = codecs.getincrementalencoder(self.encoding)()
+        for chunk in chunks:
+            yield self._encode(encoder, chunk, False)
+        yield self._encode(encoder, "", True)
+
+    def count(self, written: bool) -> bool:
+        """
+        Record that a file has been written (or left unchanged)
+
+        :return: written
+        """
+        with self._lock:
+            if written:
+                self.written += 1
+            else:
+                self.unchanged += 1
+        return written
+
+    def is_forked(self) -> bool:
+        """
+        :return: true if we are in a process forked from the one which has created this writer
+        """
+        return os.getpid() != self.pid
+
+    def drain(self) -> Tuple[int, int]:
+        """
+        Reset the counts
+
+        :return: the files written and left unchanged so far, in the format accepted by merge
+        """
+        with self._lock:
+            result = (self.written, self.unchanged)
+            self.written = 0
+            self.unchanged = 0
+        return result
+
+    def merge(self, drained: Tuple[int, int]):
+        """
+        Add the counts of another writer (typically, in a worker process)
+        """
+        with self._lock:
+            self.written += drained[0]
+            self.unchanged += drained[1]
+
+    def get_counts(self) -> Dict[str, int]:
+        """
+        :return: number of files written and left unchanged
+        """
+        with self._lock:
+            return {"files_written": self.written, "files_unchanged": self.unchanged}
+
+    @staticmethod
+    def _encode(encoder: codecs.IncrementalEncoder, content: str, final: bool) -> bytes:
+        if os.linesep != "\n":
+            content = content.replace("\n", os.linesep)
+        return encoder.encode(content, final)
+
+    @staticmethod
+    def _open_existing(path: str) -> Optional[object]:
+        try:
+            return open(path, "rb")
+        except (FileNotFoundError, IsADirectoryError, PermissionError):
+            return None
+
+    def _has_content(self, path: str, data: bytes) -> bool:
+        try:
+            if os.stat(path).st_size != len(data):
+                return False
+        except OSError:
+            return False
+        existing = self._open_existing(path)
+        if existing is None:
+            return False
+        with existing:
+            view = memoryview(data)
+            for start in range(0, len(data), self.BUFFER_SIZE):
+                if existing.read(self.BUFFER_SIZE) != view[start:start + self.BUFFER_SIZE]:
+                    return False
+            return existing.read(1) == b""
+
+    def _open_temporary(self, path: str) -> "_TemporaryFile":
+        directory, name = os.path.split(os.path.abspath(path))
+        return _TemporaryFile(directory, name)
+
+    def _replace(self, temporary: str, path: str):
+        try:
+            mode = os.stat(path).st_mode & 0o7777
+        except OSError:
+            mode = self._new_file_mode
+        try:
+            os.chmod(temporary, mode)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+
+class _TemporaryFile(object):
+    """
+    A temporary file next to the output file, removed if the content cannot be generated
+    """
+
+    def __init__(self, directory: str, name: str):
+        self.directory = directory
+        self.name = name
+        self.path: Optional[str] = None
+        self.file = None
+
+    def __enter__(self):
+        fd, self.path = tempfile.mkstemp(dir=self.directory, prefix=f".{self.name}.", suffix=".tmp")
+        self.file = os.fdopen(fd, "wb")
+        return self.file, self.path
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.file.close()
+        if exc_type is not None:
+            os.remove(self.path)
+        return False
@@ -0,0 +1,192 @@
+import collections
+import json
+import os
+import threading
+import time
+from typing import Dict, Any, List, Optional, Tuple, IO
+
+# name, category, start, duration (seconds, from time.perf_counter), process id, thread id and details of an event
+Event = Tuple[str, str, float, float, int, int, Dict[str, Any]]
+
+
+class _Stage(object):
+
+    __slots__ = ("profiler", "name", "category", "args", "start")
+
+    def __init__(self, profiler: "Profiler", name: str, category: str, args: Dict[str, Any]):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.profiler.record(self.name, self.category, self.start, time.perf_counter() - self.start, self.args)
+        return False
+
+
+class Profiler(object):
+    """
+    Records how long each stage of a run takes (reading the configuration, setting up the formatter, compiling and
+    rendering templates, writing files, ...), the cache hits and misses of the formatters and the bytes written.
+
+    Formatters report their metrics via formatter_callback (see ITemplateFormatter.set_metrics_callback).
+    A profiler can be used by several threads at once. Worker processes forked from the one owning the profiler
+    record in their own copy: they send their events back with drain, and the owner adds them with merge.
+
+    The results are available as a summary table, as a JSON report and as a trace file in the Chrome trace-event
+    format (which can be opened in chrome://tracing or https://ui.perfetto.dev)
+    """
+
+    def __init__(self, start: Optional[float] = None):
+        """
+        :param start: when the run has started, according to time.perf_counter. If unspecified, now
+        """
+        self.start = time.perf_counter() if start is None else start
+        self.pid = os.getpid()
+        self.events: List[Event] = []
+        self.counters: Dict[str, int] = collections.Counter()
+        # generated file -> its size in bytes
+        self.outputs: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def stage(self, name: str, category: str = "stage", **args) -> _Stage:
+        """
+        :return: a context manager recording how long its body takes
+        """
+        return _Stage(self, name, category, args)
+
+    def record(self, name: str, category: str, start: float, duration: float, args: Dict[str, Any]):
+        """
+        Record an event which has already happened
+
+        :param start: when the event has started, according to time.perf_counter
+        :param duration: seconds the event has taken
+        :param args: details of the event
+        """
+        event = (name, category, start, duration, os.getpid(), threading.get_ident(), args)
+        # drain may replace the list while we append to it
+        with self._lock:
+            self.events.append(event)
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def add_output(self, file: str, copied: bool = False):
+        """
+        Record that a file has been generated (or copied)
+        """
+        size = os.lstat(file).st_size
+        with self._lock:
+            self.outputs[file] = size
+            self.counters["bytes_written"] += size
+            self.counters["files_copied" if copied else "files_written"] += 1
+
+    def formatter_callback(self, event: str, seconds: float, details: Dict[str, Any]):
+        """
+        Callback to give to ITemplateFormatter.set_metrics_callback
+        """
+        self.record(event, "formatter", time.perf_counter() - seconds, seconds, details)
+        cache_hit = details.get("cache_hit")
+        if cache_hit is not None:
+            self.count("cache_hits" if cache_hit else "cache_misses")
+
+    def is_forked(self) -> bool:
+        """
+        :return: true if we are in a process forked from the one which has created this profiler
+        """
+        return os.getpid() != self.pid
+
+    def drain(self) -> Tuple[List[Event], Dict[str, int], Dict[str, int]]:
+        """
+        Remove everything recorded so far
+
+        :return: what has been recorded, in the format accepted by merge
+        """
+        with self._lock:
+            result = (self.events, dict(self.counters), self.outputs)
+            self.events = []
+            self.counters = collections.Counter()
+            self.outputs = {}
+        return result
+
+    def merge(self, drained: Tuple[List[Event], Dict[str, int], Dict[str, int]]):
+        """
+        Add what another profiler (typically, in a worker process) has recorded
+        """
+        events, counters, outputs = drained
+        with self._lock:
+            self.events.extend(events)
+            self.counters.update(counters)
+            self.outputs.update(outputs)
+
+    def get_report(self) -> Dict[str, Any]:
+        """
+        :return: the total time of the run, the time of each stage (count, total and maximum seconds), the time and
+            the size of each generated file and the counters
+        """
+        stages = {}
+        files = []
+        for name, category, start, duration, _, _, args in self.events:
+            stage = stages.setdefault(f"{category}/{name}", {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+            stage["count"] += 1
+            stage["seconds"] += duration
+            stage["max_seconds"] = max(stage["max_seconds"], duration)
+            if name == "file":
+                files.append({"file": args["file"], "seconds": duration, "bytes": self.outputs.get(args["file"])})
+        files.sort(key=lambda x: -x["seconds"])
+        end = max((start + duration for _, _, start, duration, _, _, _ in self.events), default=self.start)
+        return {
+            "seconds": max(end, time.perf_counter()) - self.start,
+            "stages": stages,
+            "files": files,
+            "counters": dict(self.counters),
+        }
+
+    def get_summary(self, files: int = 10) -> str:
+        """
+        :param files: number of the slowest files to show
+        :return: a human readable table of the report
+        """
+        report = self.get_report()
+        lines = [f"total: {report['seconds'] * 1000:.1f}ms", f"{'stage':40} {'count':>8} {'total ms':>10} {'max ms':>10}"]
+        for name, stage in sorted(report["stages"].items(), key=lambda x: -x[1]["seconds"]):
+            lines.append(f"{name:40} {stage['count']:8} {stage['seconds'] * 1000:10.1f} {stage['max_seconds'] * 1000:10.1f}")
+        if len(report["files"]) > 0:
+            lines.append(f"slowest files:")
+            for file in report["files"][:files]:
+                lines.append(f"    {file['seconds'] * 1000:10.1f}ms {file['bytes'] or 0:10}B {file['file']}")
+        for name, value in sorted(report["counters"].items()):
+            lines.append(f"{name}: {value}")
+        return "\n".join(lines)
+
+    def save_report(self, file: str):
+        with open(file, "w", encoding="utf-8") as f:
+            json.dump(self.get_report(), f, indent=4)
+
+    def save_trace(self, file: str):
+        """
+        Save the events in the Chrome trace-event format
+        """
+        trace_events = []
+        for name, category, start, duration, pid, tid, args in self.events:
+            trace_events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self.start) * 1e6,
+                "dur": duration * 1e6,
+                "pid": pid,
+                "tid": tid,
+                "args": args,
+            })
+        with open(file, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+    def print_summary(self, stream: IO[str]):
+        stream.write(self.get_summary() + "\n")
@@ -1,28 +1,101 @@
-from typing import Optional, Dict, Any, Callable
+import _string
+import functools
+import keyword
+import string
+from types import CodeType
+from typing import Optional, Dict, Any, Callable, Tuple
 
-from template_formatter.ITemplateFormatter import ITemplateFormatter
+from template_formatter.ITemplateFormatter import ITemplateFormatter, THREAD_SAFE, CACHEABLE
+from template_formatter.RenderContext import get_render_context
+
+# names of the helpers in the globals of the compiled templates. They cannot clash with the names in the template
+_FORMAT = "__template_formatter_format"
+_CONVERSIONS = {"s": "__template_formatter_str", "r": "__template_formatter_repr", "a": "__template_formatter_ascii"}
+_NAMES = "__template_formatter_globals"
+_GETATTR = "__template_formatter_getattr"
+# like str.format, a template sees only the names it is given: no builtins (e.g., {str} or {open})
+_HELPERS = {
+    "__builtins__": {}, _FORMAT: format, _CONVERSIONS["s"]: str, _CONVERSIONS["r"]: repr, _CONVERSIONS["a"]: ascii,
+    _NAMES: globals, _GETATTR: getattr,
+}
+
+
+def _is_name(name: str) -> bool:
+    return name.isidentifier() and not keyword.iskeyword(name)
+
+
+def _compile_expression(template: str) -> str:
+    """
+    Convert a template in the syntax of str.format into a python expression building the same string.
+    The template is parsed by string.Formatter.parse; each replacement field becomes a direct access to the
+    model (e.g., {model.persons[0]!r:>10} becomes format(repr(model.persons[0]), ">10"))
+    """
+    parts = []
+    for literal, field_name, format_spec, conversion in string.Formatter().parse(template):
+        if len(literal) > 0:
+            parts.append(repr(literal))
+        if field_name is None:
+            continue
+        first, rest = _string.formatter_field_name_split(field_name)
+        if not isinstance(first, str) or len(first) == 0:
+            raise IndexError(f"positional replacement field {{{field_name}}} is not allowed: fields need to be named")
+        expression = first if _is_name(first) else f"{_NAMES}()[{first!r}]"
+        for is_attribute, key in rest:
+            if not is_attribute:
+                expression += f"[{key!r}]"
+            elif _is_name(key):
+                expression += f".{key}"
+            else:
+                expression = f"{_GETATTR}({expression}, {key!r})"
+        if conversion is not None:
+            if conversion not in _CONVERSIONS:
+                raise ValueError(f"unknown conversion specifier {conversion}")
+            expression = f"{_CONVERSIONS[conversion]}({expression})"
+        spec = _compile_expression(format_spec) if "{" in format_spec else repr(format_spec)
+        parts.append(f"{_FORMAT}({expression}, {spec})")
+    if len(parts) == 0:
+        return "''"
+    return "(" + " + ".join(parts) + ")" if len(parts) <= 2 else "''.join((" + ", ".join(parts) + ",))"
+
+
+def _compile(template: str) -> CodeType:
+    return compile(_compile_expression(template), "<template>", "eval")
 
 
 class PythonFormatFormatter(ITemplateFormatter):
 
-    def __init__(self):
-        self.__template_string: Optional[str] = None
+    CAPABILITIES = frozenset([THREAD_SAFE, CACHEABLE])
+
+    def __init__(self, cache_size: int = 400):
+        """
+        :param cache_size: maximum number of compiled templates to keep. Templates are keyed by their source
+        """
+        self.__code: Optional[CodeType] = None
+        self.__compile = functools.lru_cache(maxsize=cache_size)(_compile)
 
     def init_string(self, string: str, app_context: "AppContext"):
-        self.__template_string = string
+        self.__code = self.__compile(string)
 
     def init_file(self, f: str, encoding: str, app_context: "AppContext"):
         with open(f, "r", encoding=encoding) as handle:
-            self.__template_string = handle.read().strip()
+            self.__code = self.__compile(handle.read().strip())
+
+    def may_contain_template(self, string: str, app_context: "AppContext") -> bool:
+        # "{{" and "}}" are escapes, hence they change the string as well
+        return "{" in string or "}" in string
 
     def render_template(self, model: Dict[str, Any], commons: Dict[str, Any], functions: Dict[str, Callable]) -> str:
-        global_dict = dict()
-        global_dict["model"] = model
-        global_dict["commons"] = commons
-        global_dict["functions"] = functions
-        for k, v in functions.items():
-            global_dict[k] = v
-        return self.__template_string.format(**global_dict)
+        # the same names str.format would receive as keyword arguments
+        global_dict = get_render_context(commons, functions).get_names(model, _HELPERS)
+        try:
+            return eval(self.__code, global_dict)
+        except NameError as e:
+            # str.format raises a KeyError for unknown names
+            raise KeyError(e.name) from e
+
+    def cache_info(self) -> Optional[Tuple[int, int]]:
+        info = self.__compile.cache_info()
+        return info.hits, info.misses
 
     def reset(self):
-        self.__template_string = None
+        self.__code = None
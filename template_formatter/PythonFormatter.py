@@ -1,38 +1,51 @@
+import functools
 import io
-import sys
-from typing import Dict, Any, Callable, Optional
+from types import CodeType
+from typing import Dict, Any, Callable, Optional, Tuple
 
-from template_formatter.ITemplateFormatter import ITemplateFormatter
+from template_formatter.ITemplateFormatter import ITemplateFormatter, THREAD_SAFE, CACHEABLE
+from template_formatter.RenderContext import get_render_context
+
+
+def _compile(script: str) -> CodeType:
+    return compile(script, "<template>", "exec")
 
 
 class PythonFormatter(ITemplateFormatter):
+    """
+    The template is a python script: what it prints is the rendered template.
+
+    The script receives its own print function, writing in a buffer of the render, so sys.stdout is never touched
+    and several threads can render at the same time. Scripts are compiled once and cached by source
+    """
 
-    def __init__(self):
-        self.__template_string: Optional[str] = None
+    CAPABILITIES = frozenset([THREAD_SAFE, CACHEABLE])
+
+    def __init__(self, cache_size: int = 400):
+        """
+        :param cache_size: maximum number of compiled scripts to keep
+        """
+        self.__code: Optional[CodeType] = None
+        self.__compile = functools.lru_cache(maxsize=cache_size)(_compile)
 
     def init_string(self, string: str, app_context: "AppContext"):
-        self.__template_string = string
+        self.__code = self.__compile(string)
 
     def init_file(self, f: str, encoding: str, app_context: "AppContext"):
         with open(f, "r", encoding=encoding) as handle:
-            self.__template_string = handle.read().strip()
+            self.__code = self.__compile(handle.read().strip())
 
     def render_template(self, model: Dict[str, Any], commons: Dict[str, Any], functions: Dict[str, Callable]) -> str:
-        global_dict = dict()
-        global_dict["model"] = model
-        global_dict["commons"] = commons
-        global_dict["functions"] = functions
-        for k, v in functions.items():
-            global_dict[k] = v
-        try:
-            old_stdout = sys.stdout
-            buffer = io.StringIO()
-            sys.stdout = buffer
-            exec(self.__template_string, global_dict, {})
-            result = buffer.getvalue()
-            return result
-        finally:
-            sys.stdout = old_stdout
+        buffer = io.StringIO()
+        # a script may change its globals: it works on a copy
+        global_dict = dict(get_render_context(commons, functions).get_names(model))
+        global_dict["print"] = functools.partial(print, file=buffer)
+        exec(self.__code, global_dict, {})
+        return buffer.getvalue()
+
+    def cache_info(self) -> Optional[Tuple[int, int]]:
+        info = self.__compile.cache_info()
+        return info.hits, info.misses
 
     def reset(self):
-        self.__template_string = None
\ No newline at end of file
+        self.__code = None
@@ -0,0 +1,72 @@
+import threading
+from typing import Dict, Any, Callable, Mapping, Optional
+
+
+class RenderContext(object):
+    """
+    The names a template can use: model, commons, functions and every function (functions shadow the other names).
+
+    Building these names costs a few dictionaries per render, hence the names not depending on the model are built
+    once per commons and functions (and per globals they are merged over), while the model is added only when it
+    changes, by copying them. The names must not be changed.
+    A context is used only by the thread which has built it (see get_render_context)
+    """
+
+    __slots__ = ("commons", "functions", "_functions_snapshot", "_names", "_extended")
+
+    # maximum number of globals (i.e., jinja2 environments) extended by the context
+    MAX_EXTENDED = 16
+
+    def __init__(self, commons: Dict[str, Any], functions: Dict[str, Callable]):
+        self.commons = commons
+        self.functions = functions
+        # "model" is added by get_names
+        self._names: Dict[str, Any] = {"commons": commons, "functions": functions}
+        self._names.update(functions)
+        # the functions may be added or replaced in place
+        self._functions_snapshot = dict(functions)
+        # id of the globals -> globals, the names merged over them, the last model and the names including it
+        self._extended: Dict[int, list] = {}
+
+    def is_built_from(self, commons: Dict[str, Any], functions: Dict[str, Callable]) -> bool:
+        return self.commons is commons and self.functions is functions and self._functions_snapshot == functions
+
+    def get_names(self, model: Any, globals: Optional[Mapping[str, Any]] = None) -> Dict[str, Any]:
+        """
+        :param model: the values of the template
+        :param globals: other names (e.g., the globals of a jinja2 environment). They must not change
+        :return: the given globals, where the names of this context are added (or replaced). The result is computed
+            again only if the model is not the same of the previous call with the same globals
+        """
+        entry = self._extended.get(id(globals))
+        if entry is None or entry[0] is not globals:
+            base = dict(globals) if globals is not None else {}
+            base.update(self._names)
+            entry = [globals, base, None, None]
+            if len(self._extended) >= RenderContext.MAX_EXTENDED:
+                # forget the oldest globals
+                del self._extended[next(iter(self._extended))]
+            self._extended[id(globals)] = entry
+        if entry[3] is None or entry[2] is not model:
+            names = dict(entry[1])
+            if "model" not in self.functions:
+                names["model"] = model
+            entry[2] = model
+            entry[3] = names
+        return entry[3]
+
+
+# the last context built by each thread. Renders almost always use the same commons and functions
+_local = threading.local()
+
+
+def get_render_context(commons: Dict[str, Any], functions: Dict[str, Callable]) -> RenderContext:
+    """
+    :return: the context of the given commons and functions, for this thread. It is built again only if one of them
+        is not the same object as in the previous call, or if a function has been added, replaced or removed
+    """
+    context = getattr(_local, "context", None)
+    if context is None or not context.is_built_from(commons, functions):
+        context = RenderContext(commons, functions)
+        _local.context = context
+    return context
@@ -0,0 +1,409 @@
+import argparse
+import contextlib
+import copy
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+from typing import Dict, Any, Optional, IO, Tuple, List
+
+from template_formatter import main as cli
+from template_formatter.AppContext import AppContext
+from template_formatter.ConfigCache import parse_toml
+from template_formatter.OutputWriter import OutputWriter
+
+
+class UnsupportedRequest(ValueError):
+    """
+    A request the server cannot handle, but the program run in process can
+    """
+    pass
+
+
+class ArgumentsExit(Exception):
+    """
+    The arguments of a request made the parser of the command line exit (e.g., --help or invalid arguments)
+    """
+
+    def __init__(self, output: str, error: Optional[str]):
+        super().__init__(error or output)
+        self.output = output
+        self.error = error
+
+
+class RenderServer(object):
+    """
+    A long running process rendering templates on behalf of other processes.
+
+    Clients send a json object per line and receive a json object per line. A request may contain:
+     - id: anything. It is copied as is in the response;
+     - args: a list of command line arguments, interpreted like the program does;
+     - cwd: directory relative paths are relative to. If missing, the CWD of the server;
+     - config_file: the configuration file to use (like --configFile);
+     - values: an object (or a list of key/value pairs) of values to set (like --value);
+     - any field in FIELDS, overriding the corresponding command line argument.
+    The response contains the id of the request and either "output" (the rendered template, if the output needs to be
+    written on stdout), "output_file" (the absolute path of the generated file, with "written" false if its content
+    had not changed) or "error". If "fallback" is true, the request is valid but the server does not handle it: the
+    client should run the program by itself.
+
+    Formatters are created once per format, so compiled templates survive across requests. Configuration files
+    are parsed once, unless they change, and copied only for requests setting values. Requests are rendered one at a
+    time.
+    """
+
+    FIELDS = {
+        "template": "template_string",
+        "template_file": "input_file",
+        "output_file": "output_file_format",
+        "format": "format",
+        "block_start_string": "block_start_string",
+        "block_end_string": "block_end_string",
+        "comment_start_string": "comment_start_string",
+        "comment_end_string": "comment_end_string",
+        "expression_start_string": "expression_start_string",
+        "expression_end_string": "expression_end_string",
+        "line_statement_prefix": "line_statement_prefix",
+        "input_file_encoding": "input_file_encoding",
+        "output_file_encoding": "output_file_encoding",
+        "write_on_stdout": "write_on_stdout",
+        "cache_dir": "cache_dir",
+        "cache_max_size": "cache_max_size",
+    }
+
+    # command line options containing paths, which are relative to the directory of the client. The output file is
+    # made absolute after its placeholders are replaced (see get_output_file)
+    PATH_OPTIONS = ("configFile", "inputFile", "inputDirectory", "outputDirectory", "cacheDir", "dependencyFile", "batchFile", "profileReport", "profileTrace")
+    PATH_LIST_OPTIONS = ("valuesFile",)
+
+    def __init__(self):
+        # format -> formatter
+        self.__formatters: Dict[str, "ITemplateFormatter"] = {}
+        # absolute path -> (size, mtime) and parsed content of a configuration file
+        self.__configs: Dict[str, Tuple[Tuple[int, int], Dict[str, Any]]] = {}
+        # formatters are not thread safe
+        self.__lock = threading.Lock()
+
+    def handle(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        :param request: the request to handle
+        :return: the response to send to the client
+        """
+        response = {"id": request.get("id")}
+        try:
+            with self.__lock:
+                response.update(self._render(request))
+        except UnsupportedRequest as e:
+            response["error"] = str(e)
+            response["fallback"] = True
+        except ArgumentsExit as e:
+            # e.g., the usage printed by --help
+            if e.error is not None:
+                response["error"] = e.error
+            else:
+                response["output"] = e.output
+        except SystemExit:
+            # argparse exits on invalid arguments
+            response["error"] = f"invalid arguments {request.get('args')}"
+        except Exception as e:
+            logging.exception(f"cannot handle request {request.get('id')}")
+            response["error"] = f"{type(e).__name__}: {e}"
+        return response
+
+    def handle_line(self, line: str) -> Dict[str, Any]:
+        """
+        :param line: a request, encoded in json
+        :return: the response to send to the client
+        """
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return {"id": None, "error": f"invalid request: {e}"}
+        if not isinstance(request, dict):
+            return {"id": None, "error": f"invalid request: a request needs to be a json object"}
+        return self.handle(request)
+
+    def serve_stream(self, input: IO[str], output: IO[str]):
+        """
+        Handle the requests read from input (e.g., stdin) until it is closed
+
+        :param input: stream where requests are read
+        :param output: stream where responses are written
+        """
+        for line in input:
+            if len(line.strip()) == 0:
+                continue
+            output.write(json.dumps(self.handle_line(line)) + "\n")
+            output.flush()
+
+    def create_unix_server(self, path: str) -> socketserver.BaseServer:
+        """
+        :param path: the unix socket to listen to
+        :return: a server handling the connections on the socket. Each connection is handled by its own thread
+        """
+        if os.path.exists(path):
+            if is_listening(path):
+                raise ValueError(f"a server is already listening on {path}")
+            # left over by a server which has crashed
+            os.remove(path)
+        server = socketserver.ThreadingUnixStreamServer(path, _RequestHandler)
+        server.daemon_threads = True
+        server.render_server = self
+        return server
+
+    def serve_unix_socket(self, path: str):
+        """
+        Handle the requests received on the given unix socket, forever
+        """
+        server = self.create_unix_server(path)
+        logging.info(f"listening on {path}")
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(path)
+
+    def _get_formatter(self, format: str) -> "ITemplateFormatter":
+        from template_formatter.FormatterRegistry import get_capabilities
+        from template_formatter.ITemplateFormatter import CACHEABLE
+
+        if format not in self.__formatters:
+            formatter = cli.create_formatter(format)
+            # only formatters keeping their compiled templates gain from staying warm across requests
+            if CACHEABLE not in get_capabilities(formatter):
+                return formatter
+            self.__formatters[format] = formatter
+        return self.__formatters[format]
+
+    def _load_config(self, path: str, writable: bool) -> Dict[str, Any]:
+        """
+        :param path: absolute path of the configuration file
+        :param writable: true if the values of the model will be set. The model adopts the parsed values, hence they
+            are copied, so that the request does not alter the ones of the next requests
+        :return: the parsed configuration file. Unless writable, it is shared by every request and must not be changed
+        """
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime_ns)
+        cached = self.__configs.get(path)
+        if cached is None or cached[0] != key:
+            with open(path, "rb") as f:
+                cached = (key, parse_toml(f.read()))
+            self.__configs[path] = cached
+        if writable:
+            return copy.deepcopy(cached[1])
+        return cached[1]
+
+    @staticmethod
+    def _parse_options(args: List[str]) -> argparse.Namespace:
+        """
+        Parse the command line arguments of a request. What the parser prints (e.g., the usage) cannot go on the
+        standard output of the server, which may be the stream of the responses
+
+        :raise ArgumentsExit: if the parser exits
+        """
+        output = io.StringIO()
+        error = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(error):
+                return cli.parse_options(args)
+        except SystemExit as e:
+            if e.code in (0, None):
+                raise ArgumentsExit(output.getvalue().rstrip("\n"), None)
+            raise ArgumentsExit(output.getvalue(), error.getvalue().strip() or f"invalid arguments {args}")
+
+    def _build_app_context(self, request: Dict[str, Any]) -> Tuple[AppContext, str]:
+        """
+        Build the application context of a request, the same way the program does
+
+        :return: the application context and the directory relative paths are relative to
+        """
+        cwd = os.path.abspath(request.get("cwd", os.getcwd()))
+        app_context = AppContext()
+        options = self._parse_options(request.get("args", []))
+        if options.version:
+            raise UnsupportedRequest(f"the server does not print the version")
+        self._resolve_paths(options, cwd)
+
+        config_file = request.get("config_file", options.configFile)
+        if config_file is not None:
+            config_file = os.path.abspath(os.path.join(cwd, config_file))
+            values = request.get("values", [])
+            # --value, --valuesFile and values_file write inside the values of the configuration file
+            writable = len(values) > 0 or len(options.value) > 0 or len(options.valuesFile) > 0
+            config = self._load_config(config_file, writable)
+            if not writable and "values_file" in config.get("general", {}):
+                config = self._load_config(config_file, True)
+            app_context = cli.update_using_parsed_config(app_context, config, config_file)
+        app_context = cli.update_using_command_line(app_context, options)
+        for name, attribute in self.FIELDS.items():
+            if name in request:
+                setattr(app_context, attribute, request[name])
+        values = request.get("values", [])
+        if isinstance(values, dict):
+            values = values.items()
+        for key, value in values:
+            app_context = cli.update_value(app_context, key, value)
+
+        if app_context.input_directory is not None:
+            raise UnsupportedRequest(f"the server does not template directories")
+        if app_context.batch_file is not None:
+            raise UnsupportedRequest(f"the server does not render batches")
+        if app_context.dependency_file is not None:
+            raise UnsupportedRequest(f"the server does not generate dependency files")
+
+        app_context = cli.apply_defaults(app_context)
+        app_context = cli.add_commons(app_context)
+        app_context = cli.add_functions(app_context)
+        app_context.input_file = os.path.join(cwd, app_context.input_file)
+        if app_context.cache_dir is not None:
+            app_context.cache_dir = os.path.join(cwd, app_context.cache_dir)
+        return app_context, cwd
+
+    def _resolve_paths(self, options: argparse.Namespace, cwd: str):
+        """
+        Make the relative paths in the command line options relative to the directory of the client
+        """
+        for name in self.PATH_OPTIONS:
+            if getattr(options, name) is not None:
+                setattr(options, name, os.path.join(cwd, getattr(options, name)))
+        for name in self.PATH_LIST_OPTIONS:
+            setattr(options, name, [os.path.join(cwd, x) for x in getattr(options, name)])
+
+    def _render(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        app_context, cwd = self._build_app_context(request)
+        formatter = self._get_formatter(app_context.format)
+        if app_context.template_string is not None:
+            chunks = cli.template_string_stream(app_context, app_context.template_string, formatter)
+        else:
+            chunks = cli.template_file_stream(app_context, app_context.input_file, formatter)
+
+        if app_context.write_on_stdout:
+            return {"output": "".join(chunks)}
+        output_file = cli.get_output_file(app_context, cwd)
+        writer = OutputWriter(app_context.output_file_encoding, write_if_changed=not app_context.force_write)
+        written = writer.write_stream(output_file, chunks)
+        return {"output_file": output_file, "written": written}
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if len(line.strip()) == 0:
+                continue
+            response = self.server.render_server.handle_line(line.decode("utf-8"))
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+def is_listening(path: str) -> bool:
+    """
+    :param path: a unix socket
+    :return: true if a server is accepting connections on the socket
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(path)
+    except OSError:
+        return False
+    return True
+
+
+def send_request(path: str, request: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Send a request to the server listening on the given unix socket
+
+    :param path: the unix socket the server is listening to
+    :param request: the request to send
+    :return: the response of the server
+    :raise OSError: if the server cannot be reached, or if it closes the connection before sending the whole response
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        with s.makefile("rwb") as f:
+            f.write((json.dumps(request) + "\n").encode("utf-8"))
+            f.flush()
+            line = f.readline()
+    if not line.endswith(b"\n"):
+        raise ConnectionResetError(f"the server listening on {path} has closed the connection")
+    return json.loads(line.decode("utf-8"))
+
+
+def run_client(path: str, args: List[str]):
+    """
+    Run the program with the given command line arguments on the server listening on the given unix socket.
+    If there is no server (or it fails while handling the request), or if the server cannot handle the arguments, the
+    program runs in this process
+
+    :param path: the unix socket the server is listening to
+    :param args: command line arguments of the program
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return cli.main(args)
+    try:
+        response = send_request(path, {"args": args, "cwd": os.getcwd()})
+    except OSError as e:
+        logging.info(f"no server is answering on {path} ({e}): rendering in process")
+        return cli.main(args)
+    if response.get("fallback", False):
+        logging.info(f"{response['error']}: rendering in process")
+        return cli.main(args)
+    if "error" in response:
+        raise ValueError(response["error"])
+    if "output" in response:
+        sys.stdout.write(response["output"])
+        sys.stdout.write("\n")
+
+
+def parse_options(args: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="""template-formatter-server""",
+        description="""
+        Render templates in a long running process, so the startup of the program is paid only once
+        """,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="""
+        Start a server. Requests are json objects, one per line. See RenderServer for the protocol.
+    """)
+    serve_parser.add_argument("--socket", type=str, required=False, default=None, help="""
+        The unix socket to listen to. If unspecified, requests are read from stdin and responses written on stdout
+    """)
+    serve_parser.add_argument("-l", "--loglevel", type=str, required=False, default="CRITICAL", help="""
+        the log level of the server. loglevel allowed values are INFO, DEBUG, CRITICAL
+    """)
+    client_parser = subparsers.add_parser("client", help="""
+        Run the program on the server listening on a unix socket. If there is no server, the program runs in process.
+        Every argument but socket is passed to the program
+    """)
+    client_parser.add_argument("--socket", type=str, required=True, help="""
+        The unix socket the server listens to
+    """)
+    # every other argument is an argument of the program
+    options, options.args = parser.parse_known_args(args)
+    if options.command != "client" and len(options.args) > 0:
+        parser.error(f"unrecognized arguments: {' '.join(options.args)}")
+    return options
+
+
+def main(args: Optional[List[str]] = None):
+    if args is None:
+        args = sys.argv[1:]
+    options = parse_options(args)
+    if options.command == "client":
+        return run_client(options.socket, options.args)
+
+    logging.basicConfig(level=getattr(logging, options.loglevel))
+    server = RenderServer()
+    if options.socket is not None:
+        server.serve_unix_socket(options.socket)
+    else:
+        server.serve_stream(sys.stdin, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,21 @@
+# Only what every invocation needs is imported here: formatters and heavy modules (jinja2, toml,
+# multiprocessing, ...) are imported by the functions using them, so that the program starts quickly.
+# See benchmarks/bench_startup.py
 import argparse
 import logging
 import math
 import os
-import shutil
+import threading
+import time
 
 from datetime import datetime
-from typing import Any, Iterable, Tuple
+from typing import Any, Iterable, Tuple, List, Optional, IO, Dict, Callable, FrozenSet
 
 import sys
-import toml
 
 from template_formatter import version
 from template_formatter.AppContext import AppContext
-from template_formatter.FStringFormatter import FStringFormatter
-from template_formatter.Jinja2Formatter import Jinja2Formatter
-from template_formatter.PythonFormatFormatter import PythonFormatFormatter
-from template_formatter.PythonFormatter import PythonFormatter
+from template_formatter.Jinja2Model import KeyPath, RecordingDynamicObject, parse_key_path, set_key_path
 
 
 def safe_eval(eval_str: str, **values) -> Any:
@@ -48,6 +48,8 @@ def parse_options(args):
                 there is a pythonic start and end element (e.g., ", ', or \"\"\")
         - python: the template string is interpreted as a python script. Everythign that you will be print
                 on the standard console (e.g., with print) will the rendered 
+        Other formats can be installed as plugins, i.e., packages declaring an entry point in the group 
+        "template_formatter.formatters" (see FormatterRegistry)
     """)
     parser.add_argument("--configFile", type=str, required=False, default=None, help="""
         A configuration file, containing the variables used to format the jinja2 template. Follows the TOML 
@@ -111,6 +113,101 @@ def parse_options(args):
     parser.add_argument("-L", "--lineStatementPrefix", type=str, required=False, default=None, help="""
         the jinja2 string that will start a line statement. If unspecified it is "#"
     """)
+    parser.add_argument("--forceWrite", action="store_true", required=False, default=None, help="""
+        If present, output files are written even if their content has not changed. Otherwise, they are left 
+        untouched (so that build systems do not rebuild what depends on them). In both cases files are written 
+        atomically: an interrupted run never leaves a half-written file
+    """)
+    parser.add_argument("--cacheDir", type=str, required=False, default=None, help="""
+        A directory where we store the compiled jinja2 templates and the parsed configuration and values files, in 
+        order to reuse them across several invocations of the program. The directory can be shared by several 
+        processes at once. If unspecified, no cache is used
+    """)
+    parser.add_argument("--cacheMaxSize", type=int, required=False, default=None, help="""
+        Maximum size (in bytes) of the directory specified by cacheDir. When the cache grows over this size, 
+        the least recently used templates are removed. If unspecified, it is 64MB
+    """)
+    parser.add_argument("-j", "--jobs", type=int, required=False, default=None, help="""
+        Number of parallel jobs used to template a directory: files are rendered by a pool of processes
+        and written/copied by a pool of threads. 0 means one job per CPU. If unspecified, it is 1
+    """)
+    parser.add_argument("--include", type=str, action="append", required=False, default=[], help="""
+        Meaningful only if inputDirectory is set. Pattern (with the syntax of .gitignore, relative to inputDirectory) 
+        of the files to template or copy. Can be repeated. If present, files matching no include pattern are skipped, 
+        and directories which cannot contain such files are not scanned at all
+    """)
+    parser.add_argument("--exclude", type=str, action="append", required=False, default=[], help="""
+        Meaningful only if inputDirectory is set. Pattern (with the syntax of .gitignore, relative to inputDirectory) 
+        of the files and directories to skip (e.g., ".git", "node_modules/"). Can be repeated. Excluded directories are 
+        not scanned at all. Files and directories can be skipped also by listing them in ".templateignore" files inside
+        inputDirectory, which follow the semantics of .gitignore
+    """)
+    parser.add_argument("--copyMode", type=str, required=False, default=None, help="""
+        Meaningful only if inputDirectory is set. How the files which are not templates are copied. Allowed values are:
+         - auto: the fastest strategy supported by the platform and by the filesystems;
+         - reflink: the copy shares the blocks of the original file until one of them is modified (btrfs, xfs, ...);
+         - copy_file_range, sendfile: the kernel copies the file (linux only);
+         - copy: a plain copy;
+         - hardlink: the copy is a hard link to the original file, hence modifying one of them modifies the other.
+        Unsupported strategies fall back to the next ones. If unspecified, it is "auto"
+    """)
+    parser.add_argument("--preserveSymlinks", action="store_true", required=False, default=None, help="""
+        Meaningful only if inputDirectory is set. If present, symbolic links (to files or to directories) are copied
+        as symbolic links with the same target, instead of copying what they point to
+    """)
+    parser.add_argument("--skipIdentical", type=str, required=False, default=None, help="""
+        Meaningful only if inputDirectory is set. If present, files which are not templates are not copied if 
+        their copy is already identical to them. Allowed values are:
+         - mtime: the copy has the same size and modification time (copies keep the modification time of the original);
+         - hash: the copy has the same content
+    """)
+    parser.add_argument("--incremental", action="store_true", required=False, default=None, help="""
+        Meaningful only if inputDirectory is set. If present, we keep a manifest in the output directory and we generate
+        only the files whose input (or the model) has changed since the previous run. Outputs whose input has been
+        removed are deleted as well
+    """)
+    parser.add_argument("--dependencyFile", type=str, required=False, default=None, help="""
+        If present, we save in this file what each generated file depends on: the template, the templates it includes, 
+        extends or imports, the configuration file and the keys of the model it reads.
+    """)
+    parser.add_argument("--dependencyFormat", type=str, required=False, default=None, help="""
+        Format of dependencyFile. Allowed values are:
+         - json: a json object with an entry for each generated file;
+         - make: a makefile, like the ".d" files generated by gcc -MD -MP
+        If unspecified, it is "make" if dependencyFile ends with ".d", "json" otherwise
+    """)
+    parser.add_argument("--batchFile", type=str, required=False, default=None, help="""
+        If present, we render the template (either templateString or inputFile) once for each record in this file.
+        The fields of each record are added to the values of the model. The template is compiled only once.
+        See batchFormat for the allowed formats.
+    """)
+    parser.add_argument("--batchFormat", type=str, required=False, default=None, help="""
+        Format of batchFile. Allowed values are:
+         - jsonl: a json object per line;
+         - csv: a csv file whose first row contains the field names;
+         - toml: a toml file with several [[records]] sections.
+        If unspecified, it is inferred from the extension of batchFile. jsonl and csv files are read while rendering, 
+        so they can be arbitrarily large
+    """)
+    parser.add_argument("--batchOutput", type=str, required=False, default=None, help="""
+        Meaningful only if batchFile is set. Name of the file to generate for each record. You can use:
+          - {index} to refer to the index of the record (starting from 0), even if the record has a field named "index";
+          - {field} to refer to the field named "field" of the record;
+        If the path is relative, it will created w.r.t the CWD. Directories are created if needed. 
+    """)
+    parser.add_argument("--profile", action="store_true", required=False, default=False, help="""
+        If present, we record how long each stage of the run takes (reading the configuration, compiling and rendering
+        templates, writing files, ...), the cache hits and misses and the bytes written, and we print a summary on 
+        the standard error. Profiling can be enabled also by setting the environment variable 
+        TEMPLATE_FORMATTER_PROFILE to 1
+    """)
+    parser.add_argument("--profileReport", type=str, required=False, default=None, help="""
+        If present, we profile the run (see --profile) and we save the report in this file, in JSON format
+    """)
+    parser.add_argument("--profileTrace", type=str, required=False, default=None, help="""
+        If present, we profile the run (see --profile) and we save every recorded event in this file, in the Chrome 
+        trace-event format (it can be opened with chrome://tracing or https://ui.perfetto.dev)
+    """)
     parser.add_argument("-V", "--value", action="append", nargs=2, required=False, default=[], help="""
         Represents a key value that can be used in the jinja2 template. 
         If the same key is addded multiple time, it represents a list of values
@@ -122,66 +219,151 @@ def parse_options(args):
         These values will override the values present in the configFile, if present.
         You can use [] without specifiynic the index to indicate the last element of the list
     """)
+    parser.add_argument("--valuesFile", action="append", required=False, default=[], help="""
+        A file containing many values to set at once. If the file ends with ".json", it needs to contain a json object
+        whose keys are like the ones of --value (e.g., {"a.b": 3, "a.c": [1, 2]}). ".jsonl" files contain such an 
+        object per line and ".yaml" files such a mapping (several documents are allowed, PyYAML is required).
+        Otherwise, each line needs to be "key=value", where key is like the ones of --value. Empty lines and lines 
+        starting with "#" are ignored. Can be repeated. Values in these files override the ones in configFile and are
+        overridden by --value. If cacheDir is set, parsed json and yaml files are cached there
+    """)
 
     return parser.parse_args(args)
 
 
 def update_using_config(app_context: AppContext, config_file: str) -> AppContext:
+    """
+    Update the application context with a configuration file. If app_context.cache_dir is set, the parsed
+    configuration is cached there, so that the file is parsed again only when it changes (see ConfigCache)
+    """
+    from template_formatter.ConfigCache import parse_toml, get_toml_parser_name
+
     abs_config_file = os.path.abspath(config_file)
-    with open(abs_config_file, "r") as f:
-        parsed_toml = toml.loads(f.read())
-
-        if "general" in parsed_toml:
-            general_section = parsed_toml["general"]
-            if "input_file" in general_section:
-                app_context.input_file = general_section["input_file"]
-                if not os.path.isabs(app_context.input_file):
-                    app_context.input_file = os.path.abspath(os.path.join(
-                        os.path.dirname(abs_config_file),
-                        app_context.input_file
-                    ))
-            if "inputDirectory" in general_section:
-                app_context.input_directory = general_section["input_directory"]
-            if "outputDirectory" in general_section:
-                app_context.output_directory = general_section["output_directory"]
-            if "trailingStringTemplateFile" in general_section:
-                app_context.trailing_string_template_file = general_section["trailing_string_template_file"]
-            if "output_file_format" in general_section:
-                app_context.output_file_format = general_section["output_file_format"]
-            if "log_level" in general_section:
-                app_context.log_level = general_section["log_level"]
-            if "block_start_string" in general_section:
-                app_context.block_start_string = general_section["block_start_string"]
-            if "block_end_string" in general_section:
-                app_context.block_end_string = general_section["block_end_string"]
-            if "comment_start_string" in general_section:
-                app_context.comment_start_string = general_section["comment_start_string"]
-            if "comment_end_string" in general_section:
-                app_context.comment_end_string = general_section["comment_end_string"]
-            if "expression_start_string" in general_section:
-                app_context.expression_start_string = general_section["expression_start_string"]
-            if "expression_end_string" in general_section:
-                app_context.expression_end_string = general_section["expression_end_string"]
-            if "line_statement_prefix" in general_section:
-                app_context.line_statement_prefix = general_section["line_statement_prefix"]
-            if "input_file_encoding" in general_section:
-                app_context.input_file_encoding = general_section["input_file_encoding"]
-            if "output_file_encoding" in general_section:
-                app_context.output_file_encoding = general_section["output_file_encoding"]
-            if "write_on_stdout" in general_section:
-                app_context.write_on_stdout = general_section["write_on_stdout"]
-            if "template_string" in general_section:
-                app_context.template_string = general_section["template_string"]
-            if "format" in general_section:
-                app_context.format = general_section["format"]
-
-        if "values" in parsed_toml:
-            for k, v in parsed_toml["values"].items():
-                app_context.model.values.set_field(k, v)
-
-        if "functions" in parsed_toml:
-            for k, v in parsed_toml["functions"].items():
-                app_context.model.functions[k] = safe_eval(v)
+    with _stage(app_context, "parse_config", file=abs_config_file):
+        parsed_toml = _load_parsed_file(app_context, abs_config_file, get_toml_parser_name(), parse_toml)
+    return update_using_parsed_config(app_context, parsed_toml, abs_config_file)
+
+
+def _load_parsed_file(app_context: AppContext, path: str, parser_name: str, parse: Callable[[bytes], Any]) -> Any:
+    """
+    :return: the given file parsed with parse, read from the cache in app_context.cache_dir (if set)
+    """
+    if app_context.cache_dir is None:
+        with open(path, "rb") as f:
+            return parse(f.read())
+    from template_formatter.ConfigCache import ConfigCache
+    return ConfigCache(app_context.cache_dir).load(path, parser_name, parse)
+
+
+def update_using_parsed_config(app_context: AppContext, parsed_toml: Dict[str, Any], abs_config_file: str) -> AppContext:
+    """
+    Update the application context with a configuration file which has already been parsed
+
+    :param app_context: context to update
+    :param parsed_toml: content of the configuration file
+    :param abs_config_file: absolute path of the configuration file. Relative paths in the configuration are relative
+        to it
+    """
+    app_context.config_file = abs_config_file
+
+    if "general" in parsed_toml:
+        general_section = parsed_toml["general"]
+        if "input_file" in general_section:
+            app_context.input_file = general_section["input_file"]
+            if not os.path.isabs(app_context.input_file):
+                app_context.input_file = os.path.abspath(os.path.join(
+                    os.path.dirname(abs_config_file),
+                    app_context.input_file
+                ))
+        if "inputDirectory" in general_section:
+            app_context.input_directory = general_section["input_directory"]
+        if "outputDirectory" in general_section:
+            app_context.output_directory = general_section["output_directory"]
+        if "trailingStringTemplateFile" in general_section:
+            app_context.trailing_string_template_file = general_section["trailing_string_template_file"]
+        if "output_file_format" in general_section:
+            app_context.output_file_format = general_section["output_file_format"]
+        if "log_level" in general_section:
+            app_context.log_level = general_section["log_level"]
+        if "block_start_string" in general_section:
+            app_context.block_start_string = general_section["block_start_string"]
+        if "block_end_string" in general_section:
+            app_context.block_end_string = general_section["block_end_string"]
+        if "comment_start_string" in general_section:
+            app_context.comment_start_string = general_section["comment_start_string"]
+        if "comment_end_string" in general_section:
+            app_context.comment_end_string = general_section["comment_end_string"]
+        if "expression_start_string" in general_section:
+            app_context.expression_start_string = general_section["expression_start_string"]
+        if "expression_end_string" in general_section:
+            app_context.expression_end_string = general_section["expression_end_string"]
+        if "line_statement_prefix" in general_section:
+            app_context.line_statement_prefix = general_section["line_statement_prefix"]
+        if "input_file_encoding" in general_section:
+            app_context.input_file_encoding = general_section["input_file_encoding"]
+        if "output_file_encoding" in general_section:
+            app_context.output_file_encoding = general_section["output_file_encoding"]
+        if "write_on_stdout" in general_section:
+            app_context.write_on_stdout = general_section["write_on_stdout"]
+        if "template_string" in general_section:
+            app_context.template_string = general_section["template_string"]
+        if "format" in general_section:
+            app_context.format = general_section["format"]
+        if "force_write" in general_section:
+            app_context.force_write = general_section["force_write"]
+        if "cache_dir" in general_section:
+            app_context.cache_dir = general_section["cache_dir"]
+            if not os.path.isabs(app_context.cache_dir):
+                app_context.cache_dir = os.path.abspath(os.path.join(
+                    os.path.dirname(abs_config_file),
+                    app_context.cache_dir
+                ))
+        if "cache_max_size" in general_section:
+            app_context.cache_max_size = general_section["cache_max_size"]
+        if "jobs" in general_section:
+            app_context.jobs = general_section["jobs"]
+        if "include" in general_section:
+            app_context.includes = list(general_section["include"])
+        if "exclude" in general_section:
+            app_context.excludes = list(general_section["exclude"])
+        if "copy_mode" in general_section:
+            app_context.copy_mode = general_section["copy_mode"]
+        if "preserve_symlinks" in general_section:
+            app_context.preserve_symlinks = general_section["preserve_symlinks"]
+        if "skip_identical" in general_section:
+            app_context.skip_identical = general_section["skip_identical"]
+        if "incremental" in general_section:
+            app_context.incremental = general_section["incremental"]
+        if "dependency_file" in general_section:
+            app_context.dependency_file = general_section["dependency_file"]
+        if "dependency_format" in general_section:
+            app_context.dependency_format = general_section["dependency_format"]
+        if "batch_file" in general_section:
+            app_context.batch_file = general_section["batch_file"]
+            if not os.path.isabs(app_context.batch_file):
+                app_context.batch_file = os.path.abspath(os.path.join(
+                    os.path.dirname(abs_config_file),
+                    app_context.batch_file
+                ))
+        if "batch_format" in general_section:
+            app_context.batch_format = general_section["batch_format"]
+        if "batch_output" in general_section:
+            app_context.batch_output = general_section["batch_output"]
+
+    if "values" in parsed_toml:
+        # the parsed values are used as they are. They are converted into nodes only if --value writes inside them
+        app_context.model.values.set_fields(parsed_toml["values"])
+
+    if "general" in parsed_toml and "values_file" in parsed_toml["general"]:
+        values_files = parsed_toml["general"]["values_file"]
+        if isinstance(values_files, str):
+            values_files = [values_files]
+        for values_file in values_files:
+            app_context = update_using_values_file(app_context, os.path.join(os.path.dirname(abs_config_file), values_file))
+
+    if "functions" in parsed_toml:
+        for k, v in parsed_toml["functions"].items():
+            app_context.model.functions[k] = safe_eval(v)
 
     return app_context
 
@@ -198,11 +380,113 @@ def pairs(iterable, terminate_with) -> Iterable[Tuple[Any, Any]]:
     yield item1, terminate_with
 
 
-def update_using_command_line(app_context: AppContext, options: argparse.Namespace) -> "AppContext":
+def update_value(app_context: AppContext, key: str, value: Any) -> AppContext:
+    """
+    Set a value of the model, like --value does
+
+    :param app_context: context to update
+    :param key: path of the value to set (e.g., a.b[0].c)
+    :param value: value to set
+    """
+    set_key_path(app_context.model.values, parse_key_path(key), value)
+    return app_context
+
+
+def read_values_file(path: str, encoding: str = "utf-8", cache_dir: Optional[str] = None) -> Iterable[Tuple[str, Any]]:
+    """
+    Read the values in a file, like --valuesFile does. According to the extension of the file, it is:
+
+     - ".json": a json object whose keys are in the same syntax of --value. Values may be nested objects and lists;
+     - ".jsonl" or ".ndjson": a json object (like the one above) per line. Read lazily;
+     - ".yaml" or ".yml": a yaml mapping whose keys are in the same syntax of --value. Values may be nested mappings
+       and sequences. If the file contains several documents, they are read lazily, one at a time. Requires PyYAML;
+     - anything else: each line needs to be "key=value" (values are strings). Empty lines and lines starting with "#"
+       are ignored. Read lazily
+
+    :param path: file to read
+    :param encoding: encoding of the file (json and yaml files need to be encoded in utf-8)
+    :param cache_dir: if set, json and yaml files are parsed once and cached in this directory (see ConfigCache)
+    :return: the keys and the values in the file
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".json", ".yaml", ".yml"):
+        if extension == ".json":
+            import json
+            parser_name, parse = "json", json.loads
+            documents = None
+        else:
+            parser_name, parse = "yaml", lambda x: list(_load_yaml_documents(x))
+            # without a cache we do not need to keep every document in memory
+            documents = _load_yaml_documents(open(path, "rb")) if cache_dir is None else None
+
+        if documents is None:
+            if cache_dir is None:
+                with open(path, "rb") as f:
+                    documents = parse(f.read())
+            else:
+                from template_formatter.ConfigCache import ConfigCache
+                documents = ConfigCache(cache_dir).load(path, parser_name, parse)
+            if not isinstance(documents, list):
+                documents = [documents]
+        for document in documents:
+            if not isinstance(document, dict):
+                raise ValueError(f"{path} needs to contain a mapping from keys to values")
+            yield from document.items()
+        return
+
+    if extension in (".jsonl", ".ndjson"):
+        import json
+
+        with open(path, "r", encoding=encoding) as f:
+            for line_number, line in enumerate(f, start=1):
+                if len(line.strip()) == 0:
+                    continue
+                document = json.loads(line)
+                if not isinstance(document, dict):
+                    raise ValueError(f"{path}:{line_number}: expected a json object")
+                yield from document.items()
+        return
+
+    with open(path, "r", encoding=encoding) as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.rstrip("\r\n")
+            if len(line.strip()) == 0 or line.lstrip().startswith("#"):
+                continue
+            if "=" not in line:
+                raise ValueError(f"{path}:{line_number}: expected key=value")
+            key, value = line.split("=", 1)
+            yield key.strip(), value
+
+
+def _load_yaml_documents(stream: Any) -> Iterable[Any]:
+    """
+    :param stream: yaml content (bytes or a binary file, which is closed at the end)
+    :return: the documents in the content, parsed lazily. We use the C parser of PyYAML, if available
+    """
+    try:
+        import yaml
+    except ImportError:
+        raise ValueError(f"yaml files require PyYAML (pip install pyyaml)")
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    try:
+        yield from yaml.load_all(stream, Loader=loader)
+    finally:
+        if hasattr(stream, "close"):
+            stream.close()
+
+
+def update_using_values_file(app_context: AppContext, path: str) -> AppContext:
+    """
+    Set every value in the given file. See read_values_file
+    """
+    values = app_context.model.values
+    with _stage(app_context, "read_values_file", file=os.path.abspath(path)):
+        for key, value in read_values_file(path, cache_dir=app_context.cache_dir):
+            set_key_path(values, parse_key_path(key), value)
+    return app_context
+
 
-    def handle_single_value(aapp_context: AppContext, akey: str, avalue: Any) -> "AppContext":
-        # keep generating the value
-        exec(f"app_context.model.values.{akey}.set_value(value)", {"value": avalue, "app_context": aapp_context})
+def update_using_command_line(app_context: AppContext, options: argparse.Namespace) -> "AppContext":
 
     if options.inputFile is not None:
         app_context.input_file = options.inputFile
@@ -233,18 +517,48 @@ def update_using_command_line(app_context: AppContext, options: argparse.Namespa
     if options.inputFileEncoding is not None:
         app_context.input_file_encoding = options.inputFileEncoding
     if options.outputFileEncoding is not None:
-        app_context.output_file_encoding = options.output_file_encoding
+        app_context.output_file_encoding = options.outputFileEncoding
     if options.writeOnStdout is not None:
         app_context.write_on_stdout = options.writeOnStdout
     if options.templateString is not None:
         app_context.template_string = options.templateString
     if options.format is not None:
         app_context.format = options.format
-
-    # for key, value in options.value:
-    #     handle_single_value(app_context, key, value)
+    if options.forceWrite is not None:
+        app_context.force_write = options.forceWrite
+    if options.cacheDir is not None:
+        app_context.cache_dir = options.cacheDir
+    if options.cacheMaxSize is not None:
+        app_context.cache_max_size = options.cacheMaxSize
+    if options.jobs is not None:
+        app_context.jobs = options.jobs
+    if len(options.include) > 0:
+        app_context.includes = options.include
+    if len(options.exclude) > 0:
+        app_context.excludes = options.exclude
+    if options.copyMode is not None:
+        app_context.copy_mode = options.copyMode
+    if options.preserveSymlinks is not None:
+        app_context.preserve_symlinks = options.preserveSymlinks
+    if options.skipIdentical is not None:
+        app_context.skip_identical = options.skipIdentical
+    if options.incremental is not None:
+        app_context.incremental = options.incremental
+    if options.dependencyFile is not None:
+        app_context.dependency_file = options.dependencyFile
+    if options.dependencyFormat is not None:
+        app_context.dependency_format = options.dependencyFormat
+    if options.batchFile is not None:
+        app_context.batch_file = options.batchFile
+    if options.batchFormat is not None:
+        app_context.batch_format = options.batchFormat
+    if options.batchOutput is not None:
+        app_context.batch_output = options.batchOutput
+
+    for values_file in options.valuesFile:
+        app_context = update_using_values_file(app_context, values_file)
     for key, value in options.value:
-        handle_single_value(app_context, key, value)
+        update_value(app_context, key, value)
 
     return app_context
 
@@ -273,7 +587,7 @@ def apply_defaults(app_context: AppContext) -> AppContext:
     if app_context.input_file_encoding is None:
         app_context.input_file_encoding = "utf-8"
     if app_context.output_file_encoding is None:
-        app_context.output_file_format = "utf-8"
+        app_context.output_file_encoding = "utf-8"
     if app_context.write_on_stdout is None:
         app_context.write_on_stdout = False
     if app_context.template_string is None:
@@ -286,6 +600,24 @@ def apply_defaults(app_context: AppContext) -> AppContext:
         app_context.output_directory = None
     if app_context.trailing_string_template_file is None:
         app_context.trailing_string_template_file = ".template"
+    if app_context.force_write is None:
+        app_context.force_write = False
+    if app_context.cache_max_size is None:
+        app_context.cache_max_size = 64 * 1024 * 1024
+    if app_context.jobs is None:
+        app_context.jobs = 1
+    if app_context.jobs == 0:
+        app_context.jobs = os.cpu_count() or 1
+    if app_context.includes is None:
+        app_context.includes = []
+    if app_context.excludes is None:
+        app_context.excludes = []
+    if app_context.copy_mode is None:
+        app_context.copy_mode = "auto"
+    if app_context.preserve_symlinks is None:
+        app_context.preserve_symlinks = False
+    if app_context.incremental is None:
+        app_context.incremental = False
 
     return app_context
 
@@ -316,37 +648,669 @@ def add_functions(app_context: AppContext) -> AppContext:
     return app_context
 
 
-def template_string(app_context: AppContext, string: str, formatter: "ITemplateFormatter") -> str:
+def template_string(app_context: AppContext, string: str, formatter: "ITemplateFormatter", model: Any = None) -> str:
     # we need to templatize the string
-    formatter.init_string(string, app_context)
+    _init_string(app_context, string, formatter)
 
-    actual_file_content = formatter.render_template(
-        model=app_context.model.values,
-        commons=app_context.model.commons,
-        functions=app_context.model.functions
-    )
+    actual_file_content = _render(app_context, STRING_TEMPLATE, formatter, model)
 
     formatter.reset()
     return actual_file_content
 
 
-def template_file(app_context: AppContext, file: str, formatter: "ITemplateFormatter") -> str:
+def template_file(app_context: AppContext, file: str, formatter: "ITemplateFormatter", model: Any = None) -> str:
     """
     Template a single user file
 
     :param app_context: context of the whole application
     :param file: file to template
     :param formatter: formatter used to instantiate the template
+    :param model: the values to use in the template. If None, we use the ones in app_context
     :return: a string containing the content of the instantiated file, where each parameter has been replaced with its instantiation
     """
-    formatter.init_file(os.path.abspath(file), app_context.input_file_encoding, app_context)
-    actual_file_content = formatter.render_template(
-        model=app_context.model.values,
+    file = _init_file(app_context, file, formatter)
+    actual_file_content = _render(app_context, file, formatter, model)
+    formatter.reset()
+    return actual_file_content
+
+
+def template_string_stream(app_context: AppContext, string: str, formatter: "ITemplateFormatter", model: Any = None) -> Iterable[str]:
+    """
+    Like template_string, but the string is rendered piece by piece
+
+    :return: the pieces of the rendered string
+    """
+    _init_string(app_context, string, formatter)
+    try:
+        yield from _render_stream(app_context, STRING_TEMPLATE, formatter, model)
+    finally:
+        formatter.reset()
+
+
+def template_file_stream(app_context: AppContext, file: str, formatter: "ITemplateFormatter", model: Any = None) -> Iterable[str]:
+    """
+    Like template_file, but the file is rendered piece by piece. This way we do not need to keep the whole
+    instantiated file in memory
+
+    :return: the pieces of the instantiated file
+    """
+    file = _init_file(app_context, file, formatter)
+    try:
+        yield from _render_stream(app_context, file, formatter, model)
+    finally:
+        formatter.reset()
+
+
+# how the metrics of the formatters name string templates
+STRING_TEMPLATE = "<string>"
+
+
+def _init_string(app_context: AppContext, string: str, formatter: "ITemplateFormatter"):
+    if formatter.metrics_callback is None:
+        formatter.init_string(string, app_context)
+    else:
+        _measure_init(formatter, STRING_TEMPLATE, lambda: formatter.init_string(string, app_context))
+
+
+def _init_file(app_context: AppContext, file: str, formatter: "ITemplateFormatter") -> str:
+    """
+    :return: the absolute path of the file
+    """
+    file = os.path.abspath(file)
+    if formatter.metrics_callback is None:
+        formatter.init_file(file, app_context.input_file_encoding, app_context)
+    else:
+        _measure_init(formatter, file, lambda: formatter.init_file(file, app_context.input_file_encoding, app_context))
+    return file
+
+
+def _measure_init(formatter: "ITemplateFormatter", template: str, init: Callable[[], None]):
+    cache_before = formatter.cache_info()
+    start = time.perf_counter()
+    init()
+    seconds = time.perf_counter() - start
+    cache_hit = None if cache_before is None else formatter.cache_info()[0] > cache_before[0]
+    formatter.metrics_callback("init", seconds, {"template": template, "cache_hit": cache_hit})
+
+
+def _render(app_context: AppContext, template: str, formatter: "ITemplateFormatter", model: Any) -> str:
+    model = app_context.model.values if model is None else model
+    if formatter.metrics_callback is None:
+        return formatter.render_template(model=model, commons=app_context.model.commons, functions=app_context.model.functions)
+    start = time.perf_counter()
+    result = formatter.render_template(model=model, commons=app_context.model.commons, functions=app_context.model.functions)
+    formatter.metrics_callback("render", time.perf_counter() - start, {"template": template, "characters": len(result)})
+    return result
+
+
+def _render_stream(app_context: AppContext, template: str, formatter: "ITemplateFormatter", model: Any) -> Iterable[str]:
+    chunks = formatter.render_stream(
+        model=app_context.model.values if model is None else model,
         commons=app_context.model.commons,
         functions=app_context.model.functions
     )
+    if formatter.metrics_callback is None:
+        return chunks
+    return _measure_stream(formatter, template, chunks)
+
+
+def _measure_stream(formatter: "ITemplateFormatter", template: str, chunks: Iterable[str]) -> Iterable[str]:
+    # only the time spent generating the pieces counts, not the time spent by the caller consuming them
+    seconds = 0.0
+    characters = 0
+    iterator = iter(chunks)
+    while True:
+        start = time.perf_counter()
+        chunk = next(iterator, None)
+        seconds += time.perf_counter() - start
+        if chunk is None:
+            break
+        characters += len(chunk)
+        yield chunk
+    formatter.metrics_callback("render", seconds, {"template": template, "characters": characters})
+
+
+def write_stream(chunks: Iterable[str], stream: IO[str], buffer_size: int = 64 * 1024):
+    """
+    Write the pieces of a rendered template in the given stream. Pieces are buffered, so that we do not perform a
+    write for each small piece, but the buffer never grows (much) over buffer_size characters
+
+    :param chunks: pieces to write
+    :param stream: where to write the pieces
+    :param buffer_size: number of characters to accumulate before writing them
+    """
+    buffer = []
+    buffer_length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffer_length += len(chunk)
+        if buffer_length >= buffer_size:
+            stream.write("".join(buffer))
+            buffer = []
+            buffer_length = 0
+    if len(buffer) > 0:
+        stream.write("".join(buffer))
+
+
+def template_file_dependencies(app_context: AppContext, file: str, formatter: "ITemplateFormatter") -> Optional[List[str]]:
+    """
+    :return: the templates the given template file includes, extends or imports. None if they cannot be determined
+    """
+    _init_file(app_context, file, formatter)
+    result = formatter.get_template_dependencies()
     formatter.reset()
-    return actual_file_content
+    return result
+
+
+def create_formatter(format: str) -> "ITemplateFormatter":
+    """
+    Create the formatter able to handle the given template format
+
+    :param format: one of the formats allowed by the --format option, or a format installed as plugin
+    :return: a new formatter
+    """
+    # formatters are imported only when needed, since some of them (e.g., jinja2) take long to import
+    from template_formatter.FormatterRegistry import registry
+    return registry.create(format)
+
+
+# how many templates are rendered (see _choose_render_strategy)
+SEQUENTIAL = "sequential"
+PROCESSES = "processes"
+THREADS = "threads"
+
+
+def _can_fork() -> bool:
+    import multiprocessing
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+def _choose_render_strategy(app_context: AppContext, formatter: "ITemplateFormatter") -> str:
+    """
+    Choose the fastest safe way to render many templates with the given formatter:
+
+     - SEQUENTIAL if a single job is requested;
+     - PROCESSES if the platform can fork, since the workers inherit the application context (which may contain
+       functions that cannot be pickled) and any formatter is safe in its own process;
+     - THREADS if the formatter declares to be thread safe: each thread renders with its own formatter;
+     - SEQUENTIAL otherwise
+
+    :return: one among SEQUENTIAL, PROCESSES and THREADS
+    """
+    from template_formatter.FormatterRegistry import get_capabilities
+    from template_formatter.ITemplateFormatter import THREAD_SAFE
+
+    if app_context.jobs is None or app_context.jobs <= 1:
+        return SEQUENTIAL
+    if _can_fork():
+        return PROCESSES
+    if THREAD_SAFE in get_capabilities(formatter):
+        return THREADS
+    logging.info(f"fork is not available on this platform and the formatter is not thread safe. Templates will be rendered one at a time")
+    return SEQUENTIAL
+
+
+def _template_name(app_context: AppContext, string: str, formatter: "ITemplateFormatter", rendered_names: Dict[str, Tuple[str, FrozenSet[KeyPath]]], track_dependencies: bool = False) -> Tuple[str, FrozenSet[KeyPath]]:
+    """
+    Template the name of a file or of a directory. Names without template syntax are not rendered at all, and each
+    name is rendered only once per run (the same names often repeat in many directories)
+
+    :param rendered_names: names already rendered, with the keys of the model they read. Updated by this function
+    :param track_dependencies: if set, we compute the keys of the model the name reads. Otherwise, they are empty
+    :return: the rendered name and the keys of the model it reads
+    """
+    result = rendered_names.get(string)
+    if result is not None:
+        if app_context.profiler is not None:
+            app_context.profiler.count("names_reused")
+        return result
+    if not formatter.may_contain_template(string, app_context):
+        result = (string, frozenset())
+        if app_context.profiler is not None:
+            app_context.profiler.count("names_without_template")
+    else:
+        model = RecordingDynamicObject(app_context.model.values) if track_dependencies else None
+        name = template_string(app_context, string, formatter, model=model)
+        result = (name, frozenset(model.accessed_keys) if model is not None else frozenset())
+    rendered_names[string] = result
+    return result
+
+
+def _check_name_collisions(files_to_copy: List[Tuple[str, str]], files_to_template: List[Tuple[str, str, FrozenSet[KeyPath]]]):
+    """
+    :raise ValueError: if several input files generate the same output file
+    """
+    import itertools
+
+    generated = {}
+    collisions = []
+    # output directories are already normalized, while templated names may contain "/" or ".."
+    outputs = itertools.chain(files_to_copy, map(lambda x: (x[0], os.path.normpath(x[1])), files_to_template))
+    for input_file, output_file in outputs:
+        previous = generated.setdefault(output_file, input_file)
+        if previous != input_file:
+            collisions.append(f"{previous} and {input_file} both generate {output_file}")
+    if len(collisions) > 0:
+        raise ValueError(f"name collisions: {'; '.join(collisions)}")
+
+
+def _scan_directory(app_context: AppContext, directory_to_copy: str, directory_to_generate: str, formatter: "ITemplateFormatter", track_dependencies: bool = False) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str, FrozenSet[KeyPath]]]]:
+    """
+    Scan the directory to template, template the names of its files and directories and create the output
+    directories.
+    Files and directories ignored by the .templateignore files or by the include and exclude patterns of app_context
+    are skipped (see DirectoryWalker).
+
+    :param track_dependencies: if set, we compute the keys of the model the names of the templated files read
+    :return: a pair. The first element contains the files to copy as is (input file, output file).
+        The second element contains the files to template (input file, output file, keys of the model the name of
+        the output file reads)
+    :raise ValueError: if several input files generate the same output file
+    """
+    from template_formatter.DirectoryWalker import DirectoryWalker
+
+    files_to_copy = []
+    files_to_template = []
+    rendered_names = {}
+    trailing_string = app_context.trailing_string_template_file
+    # output directory of each input directory. Needed since the name of the directories may be templated
+    output_dirs = {directory_to_copy: os.path.abspath(directory_to_generate)}
+    os.makedirs(directory_to_generate, exist_ok=True)
+    walker = DirectoryWalker(directory_to_copy, app_context.includes, app_context.excludes)
+    for dir_path, folders, files in walker.walk():
+        # output dir_path
+        output_dir_path = output_dirs.pop(dir_path)
+        # We must not create the input directory, since it may be instantiated!
+        # manage directories
+        for entry in folders:
+            if app_context.preserve_symlinks and entry.is_symlink():
+                # the link is copied as is, like a file
+                files_to_copy.append((entry.path, os.path.join(output_dir_path, entry.name)))
+                continue
+            # manage a directory
+            if entry.name.endswith(trailing_string):
+                # strip the trailing string extension. The directory name is a template
+                new_folder_name, _ = _template_name(app_context, entry.name[:-len(trailing_string)], formatter, rendered_names)
+            else:
+                new_folder_name = entry.name
+
+            # copy directory
+            folder_abs_path = os.path.abspath(os.path.join(output_dir_path, new_folder_name))
+            os.makedirs(folder_abs_path, exist_ok=True)
+            output_dirs[entry.path] = folder_abs_path
+
+        # Manage files
+        for entry in files:
+            if entry.name.endswith(trailing_string):
+                # the filename is a template. Rename the file as well
+                new_filename, name_keys = _template_name(app_context, entry.name[:-len(trailing_string)], formatter, rendered_names, track_dependencies)
+                files_to_template.append((entry.path, os.path.join(output_dir_path, new_filename), name_keys))
+            else:
+                # the filename is not a template. Copy the whole file as is
+                files_to_copy.append((entry.path, os.path.join(output_dir_path, entry.name)))
+
+    _check_name_collisions(files_to_copy, files_to_template)
+    return files_to_copy, files_to_template
+
+
+def _template_directory_file(app_context: AppContext, file_to_template: str, output_file: str, name_keys: FrozenSet[KeyPath], formatter: "ITemplateFormatter", track_dependencies: bool = False) -> Tuple[str, str, Optional["TemplateDependencies"]]:
+    """
+    Template the content of a file inside a directory to template (its name has been templated by _scan_directory)
+
+    :param name_keys: keys of the model the name of the output file reads
+    :param track_dependencies: if set, we also compute what the generated file depends on
+    :return: the output file, its content and its dependencies (None if track_dependencies is not set)
+    """
+    start = time.perf_counter()
+    model = RecordingDynamicObject(app_context.model.values, accessed_keys=set(name_keys)) if track_dependencies else None
+    file_content = template_file(
+        app_context=app_context,
+        file=file_to_template,
+        formatter=formatter,
+        model=model
+    )
+    dependencies = _get_dependencies(app_context, file_to_template, formatter, model)
+    if app_context.profiler is not None:
+        # the file is written later
+        app_context.profiler.record("file", "stage", start, time.perf_counter() - start, {"template": file_to_template, "file": output_file})
+    return output_file, file_content, dependencies
+
+
+def _generate_directory_file(app_context: AppContext, file_to_template: str, output_file: str, name_keys: FrozenSet[KeyPath], formatter: "ITemplateFormatter", track_dependencies: bool = False) -> Tuple[str, Optional["TemplateDependencies"]]:
+    """
+    Like _template_directory_file, but the content of the file is written while it is rendered
+
+    :return: the output file and its dependencies (None if track_dependencies is not set)
+    """
+    start = time.perf_counter()
+    model = RecordingDynamicObject(app_context.model.values, accessed_keys=set(name_keys)) if track_dependencies else None
+    logging.info(f"Writing instantiated file {output_file}...")
+    written = _get_output_writer(app_context).write_stream(output_file, template_file_stream(app_context, file_to_template, formatter, model=model))
+    dependencies = _get_dependencies(app_context, file_to_template, formatter, model)
+    if app_context.profiler is not None:
+        app_context.profiler.record("file", "stage", start, time.perf_counter() - start, {"template": file_to_template, "file": output_file})
+    _record_output(app_context, output_file, written)
+    return output_file, dependencies
+
+
+def _get_dependencies(app_context: AppContext, file_to_template: str, formatter: "ITemplateFormatter", model: Optional[RecordingDynamicObject]) -> Optional["TemplateDependencies"]:
+    from template_formatter.DependencyGraph import TemplateDependencies
+
+    if model is None:
+        return None
+    return TemplateDependencies(
+        templates=template_file_dependencies(app_context, file_to_template, formatter),
+        model_keys=model.accessed_keys
+    )
+
+
+def _get_output_writer(app_context: AppContext) -> "OutputWriter":
+    """
+    :return: the writer of the output files of this run. Created the first time it is needed
+    """
+    from template_formatter.OutputWriter import OutputWriter
+
+    if app_context.output_writer is None:
+        app_context.output_writer = OutputWriter(app_context.output_file_encoding or "utf-8", write_if_changed=not app_context.force_write)
+    return app_context.output_writer
+
+
+def _record_output(app_context: AppContext, output_file: str, written: bool):
+    if app_context.profiler is not None:
+        if written:
+            app_context.profiler.add_output(output_file)
+        else:
+            app_context.profiler.count("files_unchanged")
+
+
+def _write_file(app_context: AppContext, output_file: str, content: str):
+    logging.info(f"Writing instantiated file {output_file}...")
+    with _stage(app_context, "write", file=output_file):
+        written = _get_output_writer(app_context).write(output_file, content)
+    _record_output(app_context, output_file, written)
+
+
+def _create_file_copier(app_context: AppContext) -> "FileCopier":
+    from template_formatter.FileCopier import FileCopier
+
+    return FileCopier(app_context.copy_mode, app_context.preserve_symlinks, app_context.skip_identical)
+
+
+def _copy_file(app_context: AppContext, copier: "FileCopier", file_to_copy: str, output_file: str):
+    from template_formatter.FileCopier import SKIPPED
+
+    with _stage(app_context, "copy", file=output_file):
+        strategy = copier.copy(file_to_copy, output_file)
+    if app_context.profiler is not None:
+        app_context.profiler.count(f"copy_{strategy}")
+        if strategy != SKIPPED:
+            app_context.profiler.add_output(output_file, copied=True)
+
+
+class _NoStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def _stage(app_context: AppContext, name: str, **args):
+    """
+    :return: a context manager recording how long its body takes in the profiler, if the run is profiled
+    """
+    if app_context.profiler is None:
+        return _NO_STAGE
+    return app_context.profiler.stage(name, **args)
+
+
+def _new_formatter(app_context: AppContext) -> "ITemplateFormatter":
+    """
+    :return: a new formatter of app_context.format, reporting its metrics to the profiler (if the run is profiled)
+    """
+    formatter = create_formatter(app_context.format)
+    if app_context.profiler is not None:
+        formatter.set_metrics_callback(app_context.profiler.formatter_callback)
+    return formatter
+
+
+def _init_worker_state(app_context: AppContext):
+    # a forked worker starts with a copy of what its parent has recorded so far
+    if app_context.profiler is not None and app_context.profiler.is_forked():
+        app_context.profiler.drain()
+    if app_context.output_writer is not None and app_context.output_writer.is_forked():
+        app_context.output_writer.drain()
+
+
+def _drain_worker_state(app_context: AppContext) -> Optional[Tuple]:
+    """
+    :return: what a forked worker has recorded since the previous call in the profiler and in the output writer, to
+        send to its parent. None if the worker shares them with its parent (i.e., it is a thread)
+    """
+    profile = None
+    if app_context.profiler is not None and app_context.profiler.is_forked():
+        profile = app_context.profiler.drain()
+    if app_context.output_writer is not None and app_context.output_writer.is_forked():
+        return profile, app_context.output_writer.drain()
+    return None if profile is None else (profile, None)
+
+
+def _merge_worker_state(app_context: AppContext, drained: Optional[Tuple]):
+    if drained is None:
+        return
+    profile, written = drained
+    if profile is not None:
+        app_context.profiler.merge(profile)
+    if written is not None:
+        app_context.output_writer.merge(written)
+
+
+# state of each process (or thread) rendering templates in parallel. Set once per worker by its initializer.
+# A forked process runs its tasks in the thread which has run the initializer
+_worker = threading.local()
+
+
+def _init_render_worker(app_context: AppContext):
+    _init_worker_state(app_context)
+    _worker.app_context = app_context
+    _worker.formatter = _new_formatter(app_context)
+
+
+def _render_worker(item: Tuple[str, str, FrozenSet[KeyPath]], track_dependencies: bool, write: bool) -> Tuple[str, Optional[str], Optional["TemplateDependencies"], Optional[Tuple]]:
+    """
+    :return: the output file, its content (None if it has already been written), its dependencies and what the
+        worker has recorded (see _drain_worker_state)
+    """
+    if write:
+        output_file, dependencies = _generate_directory_file(_worker.app_context, *item, formatter=_worker.formatter, track_dependencies=track_dependencies)
+        file_content = None
+    else:
+        output_file, file_content, dependencies = _template_directory_file(_worker.app_context, *item, formatter=_worker.formatter, track_dependencies=track_dependencies)
+    return output_file, file_content, dependencies, _drain_worker_state(_worker.app_context)
+
+
+def _template_files_in_parallel(app_context: AppContext, copier: "FileCopier", files_to_copy: List[Tuple[str, str]], files_to_template: List[Tuple[str, str, FrozenSet[KeyPath]]], formatter: "ITemplateFormatter", track_dependencies: bool) -> List[Tuple[str, str, Optional["TemplateDependencies"]]]:
+    """
+    Render files in a pool of workers, while copying and writing files in a thread pool.
+
+    The pool is chosen by _choose_render_strategy: worker processes are forked from this one, so they inherit the
+    application context; worker threads are used if fork is unavailable and the formatter is thread safe. Otherwise,
+    we render files in this thread. Each worker has its own formatter.
+    Streaming formatters write the files in the workers while rendering them, so that the content of the files is not
+    sent back to this process.
+
+    :return: for each templated file, the file to template, the generated file and its dependencies
+    """
+    import concurrent.futures
+    import itertools
+    from template_formatter.FormatterRegistry import get_capabilities
+    from template_formatter.ITemplateFormatter import STREAMING
+
+    result = []
+    jobs = app_context.jobs
+    strategy = _choose_render_strategy(app_context, formatter) if len(files_to_template) > 0 else SEQUENTIAL
+    logging.info(f"rendering {len(files_to_template)} files with strategy {strategy}")
+    render_pool = None
+    if strategy == PROCESSES:
+        import multiprocessing
+        # processes needs to be forked before starting any thread
+        render_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_render_worker,
+            initargs=(app_context, )
+        )
+    elif strategy == THREADS:
+        render_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_render_worker,
+            initargs=(app_context, )
+        )
+
+    try:
+        if render_pool is not None:
+            rendered_files = render_pool.map(
+                _render_worker,
+                files_to_template,
+                itertools.repeat(track_dependencies),
+                itertools.repeat(STREAMING in get_capabilities(formatter)),
+                chunksize=max(1, len(files_to_template) // (jobs * 4))
+            )
+        else:
+            rendered_files = map(lambda x: _template_directory_file(app_context, *x, formatter=formatter, track_dependencies=track_dependencies) + (None, ), files_to_template)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as io_pool:
+            futures = [io_pool.submit(_copy_file, app_context, copier, file_to_copy, output_file) for file_to_copy, output_file in files_to_copy]
+            for (file_to_template, _, _), (output_file, file_content, dependencies, profile) in zip(files_to_template, rendered_files):
+                _merge_worker_state(app_context, profile)
+                if file_content is not None:
+                    futures.append(io_pool.submit(_write_file, app_context, output_file, file_content))
+                result.append((file_to_template, output_file, dependencies))
+            for future in futures:
+                # raise exceptions, if any
+                future.result()
+    finally:
+        if render_pool is not None:
+            render_pool.shutdown()
+    return result
+
+
+def _init_template(app_context: AppContext, formatter: "ITemplateFormatter"):
+    if app_context.template_string is not None:
+        _init_string(app_context, app_context.template_string, formatter)
+    elif app_context.input_file is not None:
+        _init_file(app_context, app_context.input_file, formatter)
+    else:
+        raise ValueError(f"Invalid input! Either input_file or template_string needs to be defined!")
+
+
+def _render_batch_record(app_context: AppContext, formatter: "ITemplateFormatter", index: int, record: Dict[str, Any]):
+    start = time.perf_counter()
+    # records may have a field named index: the index of the record wins
+    output_file = os.path.abspath(app_context.batch_output.format_map({**record, "index": index}))
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    logging.info(f"Writing instantiated file {output_file}...")
+    template = STRING_TEMPLATE if app_context.template_string is not None else os.path.abspath(app_context.input_file)
+    written = _get_output_writer(app_context).write_stream(output_file, _render_stream(app_context, template, formatter, app_context.model.values.with_fields(record)))
+    if app_context.profiler is not None:
+        app_context.profiler.record("file", "stage", start, time.perf_counter() - start, {"template": template, "file": output_file, "index": index})
+    _record_output(app_context, output_file, written)
+
+
+def _init_batch_worker(app_context: AppContext, formatter: "ITemplateFormatter"):
+    # the template has already been initialized by the parent process
+    _init_worker_state(app_context)
+    _worker.app_context = app_context
+    _worker.formatter = formatter
+
+
+def _init_batch_thread(app_context: AppContext):
+    # threads share the memory of this process: each one initializes the template in its own formatter
+    _worker.app_context = app_context
+    _worker.formatter = _new_formatter(app_context)
+    _init_template(app_context, _worker.formatter)
+
+
+def _render_batch_chunk(chunk: List[Tuple[int, Dict[str, Any]]]) -> Tuple[int, Optional[Tuple]]:
+    """
+    :return: the number of rendered records and what the worker has recorded (see _drain_worker_state)
+    """
+    for index, record in chunk:
+        _render_batch_record(_worker.app_context, _worker.formatter, index, record)
+    return len(chunk), _drain_worker_state(_worker.app_context)
+
+
+def template_batch(app_context: AppContext, records: Iterable[Dict[str, Any]], formatter: "ITemplateFormatter", chunk_size: int = 64) -> int:
+    """
+    Render the same template (either app_context.template_string or app_context.input_file) once per record.
+    The template is compiled only once. Each record is added to the values of the model and the result is written in
+    the file app_context.batch_output, formatted with the record fields and the record index (e.g., "{index}.txt").
+
+    Records are consumed lazily. If app_context.jobs is greater than 1, records are rendered by a pool of processes
+    (or of threads, see _choose_render_strategy), but only a bounded number of records is read in advance.
+
+    :param app_context: context of the whole application
+    :param records: value sets to render
+    :param formatter: formatter used to instantiate the template
+    :param chunk_size: number of records sent at once to a process
+    :return: number of rendered records
+    """
+    import collections
+    import concurrent.futures
+    import itertools
+    import multiprocessing
+
+    if app_context.batch_output is None:
+        raise ValueError(f"batch mode requires the output filename pattern (see --batchOutput)")
+
+    _init_template(app_context, formatter)
+    # created before forking the workers, which send back what they have written
+    _get_output_writer(app_context)
+    try:
+        jobs = app_context.jobs
+        strategy = _choose_render_strategy(app_context, formatter)
+        if strategy == SEQUENTIAL:
+            result = 0
+            for index, record in enumerate(records):
+                _render_batch_record(app_context, formatter, index, record)
+                result += 1
+            return result
+
+        if strategy == PROCESSES:
+            pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_init_batch_worker,
+                initargs=(app_context, formatter)
+            )
+        else:
+            pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=jobs,
+                initializer=_init_batch_thread,
+                initargs=(app_context, )
+            )
+        result = 0
+        records = iter(enumerate(records))
+        with pool:
+            pending = collections.deque()
+            while True:
+                chunk = list(itertools.islice(records, chunk_size))
+                if len(chunk) > 0:
+                    pending.append(pool.submit(_render_batch_chunk, chunk))
+                # backpressure: we do not read more records than the ones the pool can render soon
+                while len(pending) > 0 and (len(pending) >= 2 * jobs or len(chunk) == 0):
+                    rendered, profile = pending.popleft().result()
+                    _merge_worker_state(app_context, profile)
+                    result += rendered
+                if len(chunk) == 0:
+                    break
+        return result
+    finally:
+        formatter.reset()
 
 
 def template_directory(app_context: AppContext, directory_to_copy: str, directory_to_generate: str, formatter: "ITemplateFormatter"):
@@ -355,7 +1319,11 @@ def template_directory(app_context: AppContext, directory_to_copy: str, director
     If the file ends with a specific substring, it is assumed it is a template file. If so, we create an instantiation of the file.
     Otherwise, the file is copied as is.
 
-    Notice that also filenames and directory names can be templates as well
+    Notice that also filenames and directory names can be templates as well.
+    If app_context.jobs is greater than 1, files are rendered, written and copied in parallel.
+    If app_context.incremental is set, only the files whose dependencies have changed since the previous run are
+    generated (see BuildManifest).
+    If app_context.dependency_file is set, we save there what each generated file depends on
 
     :param app_context: context of the whole directory
     :param directory_to_copy: directory where templates are
@@ -364,63 +1332,98 @@ def template_directory(app_context: AppContext, directory_to_copy: str, director
     :return:
     """
 
+    from template_formatter.BuildManifest import BuildManifest
+    from template_formatter.DependencyGraph import DependencyGraph
+
     if not os.path.exists(directory_to_copy):
         raise ValueError(f"{directory_to_copy} does not exist")
     if not os.path.isdir(directory_to_copy):
         raise ValueError(f"{directory_to_copy} is not a valid directory!")
 
-    for dir_path, folders, filenames in os.walk(directory_to_copy):
-        # directories to original root. It i9s most likely somethign like a/b/c
-        path_to_dir_path = os.path.relpath(start=directory_to_copy, path=dir_path)
-        # output dir_path
-        output_dir_path = os.path.abspath(os.path.normpath(os.path.join(directory_to_generate, path_to_dir_path)))
-        # We must not create the input directory, since it may be instantiated!
-        # manage directories
-        for folder_name in folders:
-            # manage a directory
-            if folder_name.endswith(app_context.trailing_string_template_file):
-                # strip the trailing string extension
-                string_to_template = os.path.basename(folder_name)[:-len(app_context.trailing_string_template_file)]
-                # the directory name is a template
-                new_folder_name = template_string(app_context, string_to_template, formatter)
-            else:
-                new_folder_name = folder_name
+    track_dependencies = app_context.incremental or app_context.dependency_file is not None
+    with _stage(app_context, "scan_directory"):
+        files_to_copy, files_to_template = _scan_directory(app_context, directory_to_copy, directory_to_generate, formatter, track_dependencies)
+
+    copier = _create_file_copier(app_context)
+    # created before forking the workers, which send back what they have written
+    _get_output_writer(app_context)
+    manifest = None
+    if app_context.incremental:
+        with _stage(app_context, "load_manifest"):
+            manifest = BuildManifest.load(directory_to_copy, directory_to_generate, app_context)
+            files_to_copy = list(filter(lambda x: not manifest.is_up_to_date(x[0], x[1]), files_to_copy))
+            files_to_template = list(filter(lambda x: not manifest.is_up_to_date(x[0], x[1]), files_to_template))
+        logging.info(f"{len(manifest.entries)} files are up to date, {len(files_to_copy) + len(files_to_template)} need to be generated")
+
+    with _stage(app_context, "generate_files", files=len(files_to_copy) + len(files_to_template)):
+        if app_context.jobs is not None and app_context.jobs > 1:
+            templated_files = _template_files_in_parallel(app_context, copier, files_to_copy, files_to_template, formatter, track_dependencies)
+        else:
+            templated_files = []
+            for file_to_copy, output_file in files_to_copy:
+                _copy_file(app_context, copier, file_to_copy, output_file)
+            for file_to_template, output_file, name_keys in files_to_template:
+                output_file, dependencies = _generate_directory_file(app_context, file_to_template, output_file, name_keys, formatter, track_dependencies)
+                templated_files.append((file_to_template, output_file, dependencies))
+
+    if manifest is not None:
+        with _stage(app_context, "save_manifest"):
+            for file_to_copy, output_file in files_to_copy:
+                if app_context.preserve_symlinks and os.path.islink(file_to_copy):
+                    # links are not recorded: they are cheap to copy again (and they may point to directories)
+                    continue
+                manifest.record(file_to_copy, output_file, copied=True)
+            for file_to_template, output_file, dependencies in templated_files:
+                manifest.record(file_to_template, output_file, dependencies=dependencies)
+            manifest.remove_stale_outputs()
+            manifest.save()
+
+    if app_context.dependency_file is not None:
+        graph = DependencyGraph()
+        if manifest is not None:
+            # the manifest contains also the files that did not need to be generated
+            manifest.add_to_graph(graph, app_context.config_file)
+        else:
+            for file_to_copy, output_file in files_to_copy:
+                graph.add(output_file, [file_to_copy], [])
+            for file_to_template, output_file, dependencies in templated_files:
+                _add_to_graph(graph, app_context, file_to_template, output_file, dependencies)
+        graph.save(app_context.dependency_file, app_context.dependency_format)
 
-            # copy directory
-            folder_abs_path = os.path.abspath(os.path.join(output_dir_path, new_folder_name))
-            os.makedirs(folder_abs_path, exist_ok=True)
 
-        # Manage files
-        for f in filenames:
-            file_to_copy = os.path.join(dir_path, f)
+def _add_to_graph(graph: "DependencyGraph", app_context: AppContext, file_to_template: str, output_file: str, dependencies: "TemplateDependencies"):
+    input_files = [file_to_template]
+    input_files.extend(dependencies.templates or [])
+    if app_context.config_file is not None:
+        input_files.append(app_context.config_file)
+    graph.add(output_file, input_files, dependencies.model_keys, complete=dependencies.templates is not None)
 
-            if file_to_copy.endswith(app_context.trailing_string_template_file):
-                # the filename is a template. Rename the file as well
-                string_to_template = os.path.basename(file_to_copy)[:-len(app_context.trailing_string_template_file)]
-                new_filename = template_string(
-                    app_context=app_context,
-                    string=string_to_template,
-                    formatter=formatter
-                )
-
-                file_content = template_file(
-                    app_context=app_context,
-                    file=file_to_copy,
-                    formatter=formatter
-                )
-
-                # write the file
-                output_file = os.path.join(output_dir_path, new_filename)
-                logging.info(f"Writing instantiated file {output_file}...")
-                with open(output_file, mode="w", encoding=app_context.output_file_encoding) as fw:
-                    fw.write(file_content)
-            else:
-                output_file = os.path.join(output_dir_path, f)
-                # the filename is not a template. Copy the whole file as is
-                shutil.copyfile(file_to_copy, output_file)
+
+def get_output_file(app_context: AppContext, cwd: Optional[str] = None) -> str:
+    """
+    :param app_context: context of the whole application
+    :param cwd: directory relative output files are relative to. If None, we use the CWD
+    :return: the absolute path of the file to generate when we template a single file or string
+    """
+    # generate actual output file
+    # '/path/to/somefile', '.ext'
+    input_filename, input_ext = os.path.splitext(app_context.input_file)
+    input_filename = os.path.abspath(input_filename)
+    input_basedir = os.path.abspath(os.path.dirname(app_context.input_file))
+    input_basename = os.path.basename(app_context.input_file)
+    output_file = app_context.output_file_format.format(
+        filename=input_filename,
+        ext=input_ext,
+        basename=input_basename,
+        basedir=input_basedir
+    )
+    if cwd is not None:
+        output_file = os.path.join(cwd, output_file)
+    return os.path.abspath(output_file)
 
 
 def main(args=None):
+    start = time.perf_counter()
     if args is None:
         args = sys.argv[1:]
 
@@ -431,12 +1434,49 @@ def main(args=None):
         print(version.VERSION)
         return
 
+    if _is_profiling_requested(options):
+        from template_formatter.Profiler import Profiler
+        app_context.profiler = Profiler(start=start)
+        app_context.profiler.record("parse_options", "stage", start, time.perf_counter() - start, {})
+    try:
+        _run(app_context, options)
+        if app_context.output_writer is not None:
+            counts = app_context.output_writer.get_counts()
+            logging.info(f"{counts['files_written']} files written, {counts['files_unchanged']} files unchanged")
+    finally:
+        if app_context.profiler is not None:
+            _report_profile(app_context.profiler, options)
+
+
+# if set to something else than "" or "0", the program is profiled as with --profile
+PROFILE_ENVIRONMENT_VARIABLE = "TEMPLATE_FORMATTER_PROFILE"
+
+
+def _is_profiling_requested(options: argparse.Namespace) -> bool:
+    from_environment = os.environ.get(PROFILE_ENVIRONMENT_VARIABLE, "") not in ("", "0")
+    return options.profile or options.profileReport is not None or options.profileTrace is not None or from_environment
+
+
+def _report_profile(profiler: "Profiler", options: argparse.Namespace):
+    profiler.print_summary(sys.stderr)
+    if options.profileReport is not None:
+        profiler.save_report(options.profileReport)
+    if options.profileTrace is not None:
+        profiler.save_trace(options.profileTrace)
+
+
+def _run(app_context: AppContext, options: argparse.Namespace):
+    if options.cacheDir is not None:
+        # needed before reading the configuration, since the parsed configuration is cached as well
+        app_context.cache_dir = options.cacheDir
     # read values from config if  present
     if options.configFile is not None:
-        app_context = update_using_config(app_context, options.configFile)
+        with _stage(app_context, "update_using_config"):
+            app_context = update_using_config(app_context, options.configFile)
 
     # overwrite values from config
-    app_context = update_using_command_line(app_context, options)
+    with _stage(app_context, "update_using_command_line"):
+        app_context = update_using_command_line(app_context, options)
     # apply defaults on required items
     app_context = apply_defaults(app_context)
 
@@ -460,48 +1500,53 @@ def main(args=None):
     app_context = add_functions(app_context)
 
     logging.info(f"loading file template: {app_context.input_file}")
-    logging.debug(f"parameters are {app_context.model}")
-
-    if app_context.format == "jinja2":
-        formatter = Jinja2Formatter()
-    elif app_context.format == "format":
-        formatter = PythonFormatFormatter()
-    elif app_context.format == "fstring":
-        formatter = FStringFormatter()
-    elif app_context.format == "python":
-        formatter = PythonFormatter()
-    else:
-        raise ValueError(f"invalid format {app_context.format}")
+    # formatting the model is expensive: do it only if the message is logged
+    logging.debug("parameters are %s", app_context.model)
+
+    with _stage(app_context, "create_formatter"):
+        formatter = _new_formatter(app_context)
+
+    if app_context.batch_file is not None:
+        from template_formatter.BatchRecordReader import BatchRecordReader
+        records = BatchRecordReader(app_context.batch_file, app_context.batch_format, app_context.input_file_encoding)
+        with _stage(app_context, "template_batch"):
+            rendered = template_batch(app_context, records, formatter)
+        logging.info(f"rendered {rendered} records")
+        return
 
     if app_context.input_directory is not None:
-        template_directory(app_context, app_context.input_directory, app_context.output_directory, formatter)
+        with _stage(app_context, "template_directory"):
+            template_directory(app_context, app_context.input_directory, app_context.output_directory, formatter)
         # we need to template a whole directory
         return
     else:
+        model = RecordingDynamicObject(app_context.model.values) if app_context.dependency_file is not None else None
         if app_context.template_string is not None:
-            actual_file_content = template_string(app_context, app_context.template_string, formatter)
+            chunks = template_string_stream(app_context, app_context.template_string, formatter, model=model)
         elif app_context.input_file is not None:
-            actual_file_content = template_file(app_context, app_context.input_file, formatter)
+            chunks = template_file_stream(app_context, app_context.input_file, formatter, model=model)
         else:
             raise ValueError(f"Invalid input! Either input_file or template_string needs to be defined!")
 
         if app_context.write_on_stdout:
-            print(actual_file_content)
+            write_stream(chunks, sys.stdout)
+            sys.stdout.write("\n")
         else:
-            # generate actual output file
-            # '/path/to/somefile', '.ext'
-            input_filename, input_ext = os.path.splitext(app_context.input_file)
-            input_filename = os.path.abspath(input_filename)
-            input_basedir = os.path.abspath(os.path.dirname(app_context.input_file))
-            input_basename = os.path.basename(app_context.input_file)
-            actual_output_file = os.path.abspath(app_context.output_file_format.format(
-                filename=input_filename,
-                ext=input_ext,
-                basename=input_basename,
-                basedir=input_basedir
-            ))
-            with open(actual_output_file, "w", encoding=app_context.output_file_encoding) as f:
-                f.write(actual_file_content)
+            actual_output_file = get_output_file(app_context)
+            with _stage(app_context, "file", file=actual_output_file):
+                written = _get_output_writer(app_context).write_stream(actual_output_file, chunks)
+            _record_output(app_context, actual_output_file, written)
+
+            if model is not None:
+                from template_formatter.DependencyGraph import DependencyGraph, TemplateDependencies
+                graph = DependencyGraph()
+                if app_context.template_string is not None:
+                    input_files = [app_context.config_file] if app_context.config_file is not None else []
+                    graph.add(actual_output_file, input_files, model.accessed_keys)
+                else:
+                    templates = template_file_dependencies(app_context, app_context.input_file, formatter)
+                    _add_to_graph(graph, app_context, app_context.input_file, actual_output_file, TemplateDependencies(templates, model.accessed_keys))
+                graph.save(app_context.dependency_file, app_context.dependency_format)
 
 
 if __name__ == "__main__":
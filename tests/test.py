@@ -1,11 +1,27 @@
+import importlib.util
+import json
+import math
 import os
+import shutil
+import tempfile
+import threading
 import unittest
 from unittest.mock import patch
 from io import StringIO
-from typing import Callable
+from typing import Callable, List
 
 from template_formatter import version
-from template_formatter.main import main
+from template_formatter.AppContext import AppContext
+from template_formatter.FormatterRegistry import FormatterRegistry, registry
+from template_formatter.FStringFormatter import FStringFormatter
+from template_formatter.Jinja2Formatter import Jinja2Formatter
+from template_formatter.PythonFormatFormatter import PythonFormatFormatter
+from template_formatter.PythonFormatter import PythonFormatter
+from template_formatter.RenderContext import get_render_context
+from template_formatter.ITemplateFormatter import ITemplateFormatter, STREAMING, THREAD_SAFE, CACHEABLE, ASYNC
+from template_formatter.Jinja2Model import DynamicObject, EMPTY, parse_key_path, set_key_path
+from template_formatter.RenderServer import RenderServer
+from template_formatter.main import main, apply_defaults, create_formatter, _choose_render_strategy, SEQUENTIAL, PROCESSES, THREADS, add_functions, template_file, template_string, template_string_stream, write_stream
 
 
 class MyTestCase(unittest.TestCase):
@@ -20,6 +36,15 @@ class MyTestCase(unittest.TestCase):
             actual_func()
             self.assertTrue(fake_out.getvalue() in expected)
 
+    def assertSameDirectory(self, expected: str, actual: str):
+        expected_files = sorted(map(lambda x: (os.path.relpath(x[0], expected), sorted(x[1]), sorted(x[2])), os.walk(expected)))
+        actual_files = sorted(map(lambda x: (os.path.relpath(x[0], actual), sorted(x[1]), sorted(x[2])), os.walk(actual)))
+        self.assertEqual(expected_files, actual_files)
+        for dir_path, _, filenames in expected_files:
+            for f in filenames:
+                with open(os.path.join(expected, dir_path, f), "rb") as fe, open(os.path.join(actual, dir_path, f), "rb") as fa:
+                    self.assertEqual(fe.read(), fa.read())
+
     # def test_help(self):
     #     self.assertStdoutContains("template-formatter [-h]", lambda: main(["test", "--help"]))
 
@@ -170,6 +195,1074 @@ class MyTestCase(unittest.TestCase):
             '--format', 'fstring',
         ])
 
+    def test_18(self):
+        app_context = apply_defaults(AppContext())
+        app_context.model.values.set_field("name", "Pluto")
+        formatter = Jinja2Formatter(persistent_environment=True)
+        self.assertEqual("Hello Pluto!", template_string(app_context, "Hello {{ model.name }}!", formatter))
+        self.assertEqual((0, 1), formatter.cache_info())
+        self.assertEqual("Hello Pluto!", template_string(app_context, "Hello {{ model.name }}!", formatter))
+        self.assertEqual((1, 1), formatter.cache_info())
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "hello.jinja2")
+            with open(path, "w") as f:
+                f.write("Hi {{ model.name }}")
+            for _ in range(2):
+                self.assertEqual("Hi Pluto", template_file(app_context, path, formatter))
+            self.assertEqual((2, 2), formatter.cache_info())
+            # a changed template is compiled again
+            with open(path, "w") as f:
+                f.write("Bye {{ model.name }}")
+            os.utime(path, ns=(0, 0))
+            self.assertEqual("Bye Pluto", template_file(app_context, path, formatter))
+            self.assertEqual((2, 3), formatter.cache_info())
+
+    def test_19(self):
+        app_context = apply_defaults(AppContext())
+        app_context.model.values.set_field("name", "Pluto")
+        formatter = Jinja2Formatter(persistent_environment=True)
+        self.assertEqual("Hello Pluto!", template_string(app_context, "Hello {{ model.name }}!", formatter))
+        app_context.expression_start_string = "<<"
+        app_context.expression_end_string = ">>"
+        self.assertEqual("Hello Pluto!", template_string(app_context, "Hello << model.name >>!", formatter))
+
+    def test_20(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for _ in range(2):
+                self.assertStdoutEqual("Hello Pluto!", lambda: main([
+                    '--configFile', "config.toml",
+                    '--cacheDir', cache_dir,
+                    '--writeOnStdout',
+                    "Hello {{ model.name }}!"
+                ]))
+            # the compiled template and the parsed configuration
+            self.assertEqual(2, len(os.listdir(cache_dir)))
+            # different delimiters must not reuse the same compiled template
+            self.assertStdoutEqual("Hello {{ model.name }}!", lambda: main([
+                '--configFile', "config.toml",
+                '--cacheDir', cache_dir,
+                '--expressionStartString', '<<',
+                '--expressionEndString', '>>',
+                '--writeOnStdout',
+                "Hello {{ model.name }}!"
+            ]))
+            self.assertEqual(3, len(os.listdir(cache_dir)))
+
+    def test_21(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for i in range(20):
+                self.assertStdoutEqual(f"Hello {i}!", lambda: main([
+                    '--configFile', "config.toml",
+                    '--cacheDir', cache_dir,
+                    '--cacheMaxSize', '4096',
+                    '--writeOnStdout',
+                    f"Hello {i}{{{{ '!' }}}}"
+                ]))
+            self.assertLessEqual(sum(map(lambda x: os.path.getsize(os.path.join(cache_dir, x)), os.listdir(cache_dir))), 4096)
+
+    def test_22(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            for jobs in ("1", "3"):
+                main([
+                    '--configFile', "config.toml",
+                    "--inputDirectory", os.path.join(os.getcwd(), "input"),
+                    "--outputDirectory", os.path.join(output_dir, jobs),
+                    '--format', 'fstring',
+                    '--jobs', jobs,
+                ])
+            self.assertSameDirectory(os.path.join(output_dir, "1"), os.path.join(output_dir, "3"))
+            with open(os.path.join(output_dir, "3", "foo2", "bar-Pluto", "hello.txt")) as f:
+                self.assertEqual("Hello Pluto!", f.read())
+
+    def test_23(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            input_dir = os.path.join(tmp, "input")
+            output_dir = os.path.join(tmp, "output")
+            shutil.copytree(os.path.join(os.getcwd(), "input"), input_dir)
+            with open(os.path.join(input_dir, "foo", "asset.bin"), "wb") as f:
+                f.write(b"binary")
+
+            def run(config_file="config.toml"):
+                main([
+                    '--configFile', config_file,
+                    "--inputDirectory", input_dir,
+                    "--outputDirectory", output_dir,
+                    '--format', 'fstring',
+                    '--incremental',
+                ])
+
+            def mtimes():
+                result = {}
+                for dir_path, _, filenames in os.walk(output_dir):
+                    for f in filenames:
+                        result[os.path.relpath(os.path.join(dir_path, f), output_dir)] = os.stat(os.path.join(dir_path, f)).st_mtime_ns
+                del result[".template-formatter-manifest.json"]
+                return result
+
+            run()
+            first = mtimes()
+            self.assertEqual({"foo/bar/hello.txt", "foo/asset.bin", "foo2/bar-Pluto/hello.txt"}, set(first.keys()))
+            run()
+            self.assertEqual(first, mtimes())
+
+            # only the changed template is generated again
+            with open(os.path.join(input_dir, "foo", "bar", "hello.txt.template"), "w") as f:
+                f.write("bye {model.name}!")
+            run()
+            second = mtimes()
+            self.assertNotEqual(first["foo/bar/hello.txt"], second["foo/bar/hello.txt"])
+            self.assertEqual(first["foo/asset.bin"], second["foo/asset.bin"])
+            self.assertEqual(first["foo2/bar-Pluto/hello.txt"], second["foo2/bar-Pluto/hello.txt"])
+            with open(os.path.join(output_dir, "foo", "bar", "hello.txt")) as f:
+                self.assertEqual("bye Pluto!", f.read())
+
+            # outputs of removed inputs are removed
+            os.remove(os.path.join(input_dir, "foo", "asset.bin"))
+            run()
+            self.assertFalse(os.path.exists(os.path.join(output_dir, "foo", "asset.bin")))
+
+            # changing the model generates every template again
+            with open(os.path.join(tmp, "config.toml"), "w") as f:
+                f.write("[values]\nname = 'Paperino'\n")
+            run(os.path.join(tmp, "config.toml"))
+            self.assertTrue(os.path.exists(os.path.join(output_dir, "foo2", "bar-Paperino", "hello.txt")))
+            self.assertFalse(os.path.exists(os.path.join(output_dir, "foo2", "bar-Pluto", "hello.txt")))
+
+    def test_24(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            input_dir = os.path.join(tmp, "input")
+            output_dir = os.path.join(tmp, "output")
+            os.makedirs(input_dir)
+            with open(os.path.join(input_dir, "part.jinja2"), "w") as f:
+                f.write("{{ model.greeting }}")
+            with open(os.path.join(input_dir, "a.txt.template"), "w") as f:
+                f.write("{% include 'part.jinja2' %} {{ model.name }}")
+            with open(os.path.join(input_dir, "b.txt.template"), "w") as f:
+                f.write("Bye {{ model.name }}")
+
+            def run(greeting: str):
+                main([
+                    '--configFile', "config.toml",
+                    "--inputDirectory", input_dir,
+                    "--outputDirectory", output_dir,
+                    '--incremental',
+                    '--dependencyFile', os.path.join(tmp, "deps.json"),
+                    '--value', 'greeting', greeting,
+                ])
+
+            def mtime(f: str) -> int:
+                return os.stat(os.path.join(output_dir, f)).st_mtime_ns
+
+            run("Hello")
+            with open(os.path.join(output_dir, "a.txt")) as f:
+                self.assertEqual("Hello Pluto", f.read())
+            a, b = mtime("a.txt"), mtime("b.txt")
+
+            # only a.txt reads greeting
+            run("Hi")
+            self.assertNotEqual(a, mtime("a.txt"))
+            self.assertEqual(b, mtime("b.txt"))
+            with open(os.path.join(output_dir, "a.txt")) as f:
+                self.assertEqual("Hi Pluto", f.read())
+
+            # only a.txt includes part.jinja2
+            a = mtime("a.txt")
+            with open(os.path.join(input_dir, "part.jinja2"), "w") as f:
+                f.write("{{ model.greeting }}!")
+            run("Hi")
+            self.assertNotEqual(a, mtime("a.txt"))
+            self.assertEqual(b, mtime("b.txt"))
+
+            with open(os.path.join(tmp, "deps.json")) as f:
+                dependencies = json.load(f)["outputs"]
+            a_dependencies = dependencies[os.path.join(output_dir, "a.txt")]
+            self.assertEqual([
+                os.path.join(input_dir, "a.txt.template"),
+                os.path.join(input_dir, "part.jinja2"),
+                os.path.abspath("config.toml")
+            ], a_dependencies["inputs"])
+            self.assertEqual(["greeting", "name"], a_dependencies["model_keys"])
+            self.assertEqual(["name"], dependencies[os.path.join(output_dir, "b.txt")]["model_keys"])
+
+            # keys which are missing, or only tested, are dependencies too
+            input_dir = os.path.join(tmp, "flags")
+            os.makedirs(input_dir)
+            with open(os.path.join(input_dir, "c.txt.template"), "w") as f:
+                f.write("{% if model.flag %}yes{% else %}no{% endif %} {{ model.extra }}")
+
+            def run_flags(values: str) -> str:
+                with open(os.path.join(tmp, "flags.toml"), "w") as f:
+                    f.write("[values]\n" + values)
+                main(['--configFile', os.path.join(tmp, "flags.toml"), "--inputDirectory", input_dir, "--outputDirectory", os.path.join(tmp, "flags_output"), '--incremental'])
+                with open(os.path.join(tmp, "flags_output", "c.txt")) as f:
+                    return f.read()
+
+            self.assertEqual("yes None", run_flags(""))
+            self.assertEqual("yes x", run_flags('extra = "x"\n'))
+            self.assertEqual("no x", run_flags('extra = "x"\nflag = false\n'))
+            self.assertEqual("yes x", run_flags('extra = "x"\nflag = true\n'))
+
+    def test_25(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            main([
+                '--configFile', "config.toml",
+                '--outputFile', os.path.join(tmp, "example.txt"),
+                '--dependencyFile', os.path.join(tmp, "example.d"),
+            ])
+            with open(os.path.join(tmp, "example.d")) as f:
+                self.assertEqual(
+                    f"{os.path.join(tmp, 'example.txt')}: {os.path.abspath('example.jinja2')} \\\n  {os.path.abspath('config.toml')}\n"
+                    f"\n"
+                    f"{os.path.abspath('config.toml')}:\n"
+                    f"{os.path.abspath('example.jinja2')}:\n",
+                    f.read()
+                )
+
+    def test_26(self):
+        app_context = apply_defaults(AppContext())
+        formatter = Jinja2Formatter(persistent_environment=True)
+        template = "{% for i in range(100000) %}{{ i }}\n{% endfor %}"
+        chunks = list(template_string_stream(app_context, template, formatter))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(template_string(app_context, template, formatter), "".join(chunks))
+
+        writes = []
+
+        class FakeStream:
+            def write(self, s: str):
+                writes.append(len(s))
+
+        write_stream(iter(chunks), FakeStream(), buffer_size=1024)
+        self.assertEqual(sum(map(len, chunks)), sum(writes))
+        self.assertLess(max(writes), 1024 + max(map(len, chunks)))
+
+    def test_27(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            main([
+                '--configFile', "config.toml",
+                '--outputFile', os.path.join(tmp, "example.txt"),
+            ])
+            with open(os.path.join(tmp, "example.txt")) as f:
+                self.assertEqual(f"Hello Pluto!\n\nHello aaaaa\n\nThe version is {version.VERSION}", f.read())
+
+    def test_28(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "tenants.jsonl"), "w") as f:
+                for i in range(200):
+                    f.write(json.dumps({"tenant": f"t{i}", "port": 8000 + i}) + "\n")
+            for jobs in ("1", "2"):
+                main([
+                    '--configFile', "config.toml",
+                    '--batchFile', os.path.join(tmp, "tenants.jsonl"),
+                    '--batchOutput', os.path.join(tmp, jobs, "{tenant}.conf"),
+                    '--jobs', jobs,
+                    "{{ model.name }} {{ model.tenant }}:{{ model.port }}"
+                ])
+                self.assertEqual(200, len(os.listdir(os.path.join(tmp, jobs))))
+                with open(os.path.join(tmp, jobs, "t42.conf")) as f:
+                    self.assertEqual("Pluto t42:8042", f.read())
+
+    def test_29(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "tenants.csv"), "w") as f:
+                f.write("tenant,port\nfoo,1\nbar,2\n")
+            with open(os.path.join(tmp, "tenants.toml"), "w") as f:
+                f.write("[[records]]\ntenant = 'foo'\nport = 1\n[[records]]\ntenant = 'bar'\nport = 2\n")
+            for batch_file in ("tenants.csv", "tenants.toml"):
+                main([
+                    '--configFile', "config.toml",
+                    '--batchFile', os.path.join(tmp, batch_file),
+                    '--batchOutput', os.path.join(tmp, "{index}-{tenant}.conf"),
+                    '--format', 'format',
+                    "{model.tenant}:{model.port}"
+                ])
+                with open(os.path.join(tmp, "1-bar.conf")) as f:
+                    self.assertEqual("bar:2", f.read())
+
+            # a record may have a field named index
+            with open(os.path.join(tmp, "indexed.csv"), "w") as f:
+                f.write("index,tenant\na,foo\nb,bar\n")
+            main(['--batchFile', os.path.join(tmp, "indexed.csv"), '--batchOutput', os.path.join(tmp, "indexed-{index}-{tenant}.conf"), '--format', 'format', "{model.index}"])
+            with open(os.path.join(tmp, "indexed-1-bar.conf")) as f:
+                self.assertEqual("b", f.read())
+
+    def test_30(self):
+        server = RenderServer()
+        for name in ("Pluto", "Pippo"):
+            response = server.handle({"id": name, "template": "hello {{ model.name }}!", "values": {"name": name}, "write_on_stdout": True})
+            self.assertEqual({"id": name, "output": f"hello {name}!"}, response)
+        response = server.handle({"id": 3, "args": ["--configFile", "config.toml", "--format", "format", "-w", "{model.name} {model.a.b}"], "values": [["a.b", "5"]]})
+        self.assertEqual({"id": 3, "output": "Pluto 5"}, response)
+        response = server.handle({"id": 4, "args": ["--inputDirectory", "input", "--outputDirectory", "output/foo"]})
+        self.assertTrue(response["fallback"])
+        # the configuration is parsed once. It is copied only for requests writing inside its values
+        config = server._load_config(os.path.abspath("config.toml"), False)
+        self.assertIs(config, server._load_config(os.path.abspath("config.toml"), False))
+        self.assertEqual("Pluto 42", server.handle({"args": ["--configFile", "config.toml", "--format", "format", "-w", "{model.name} {model.age}"]})["output"])
+        self.assertEqual({"name": "Pluto", "age": 42}, config["values"])
+        response = server.handle({"args": ["--configFile", "config.toml", "--value", "name", "Pippo", "-w", "{{ model.name }}"]})
+        self.assertEqual("Pippo", response["output"])
+        self.assertEqual({"name": "Pluto", "age": 42}, config["values"])
+        # what the parser prints is in the response, not on the stdout of the server
+        stdout = StringIO()
+        with patch("sys.stdout", stdout), patch("sys.stderr", StringIO()):
+            help_response = server.handle({"id": 5, "args": ["--help"]})
+            error_response = server.handle({"id": 6, "args": ["--valuee", "a", "1"]})
+        self.assertEqual("", stdout.getvalue())
+        self.assertIn("usage:", help_response["output"])
+        self.assertNotIn("error", help_response)
+        self.assertIn("unrecognized arguments", error_response["error"])
+
+        output = StringIO()
+        server.serve_stream(StringIO('{"id": 1, "template": "{{ 1 + 2 }}", "write_on_stdout": true}\n\nnot json\n'), output)
+        responses = list(map(json.loads, output.getvalue().splitlines()))
+        self.assertEqual({"id": 1, "output": "3"}, responses[0])
+        self.assertIn("error", responses[1])
+
+    def test_31(self):
+        import socket
+        from template_formatter.RenderServer import run_client, main as server_main
+        with tempfile.TemporaryDirectory() as tmp:
+            # no server: the client renders in process
+            socket_path = os.path.join(tmp, "server.sock")
+            self.assertStdoutEqual("hello 3", lambda: run_client(socket_path, ["--value", "a", "3", "-w", "hello {{ model.a }}"]))
+
+            server = RenderServer().create_unix_server(socket_path)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                self.assertStdoutEqual("hello 4", lambda: server_main(["client", "--socket", socket_path, "--value", "a", "4", "-w", "hello {{ model.a }}"]))
+                server_main(["client", "--socket", socket_path, "--configFile", "config.toml", "--outputFile", os.path.join(tmp, "example.txt")])
+                with open(os.path.join(tmp, "example.txt")) as f:
+                    self.assertEqual(f"Hello Pluto!\n\nHello aaaaa\n\nThe version is {version.VERSION}", f.read())
+                # paths are relative to the directory of the client
+                with open(os.path.join(tmp, "values.json"), "w") as f:
+                    f.write('{"a": 5}')
+                response = RenderServer().handle({"args": ["--valuesFile", "values.json", "-w", "hello {{ model.a }}"], "cwd": tmp})
+                self.assertEqual("hello 5", response["output"])
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+            # a server closing the connection before answering
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as broken_server:
+                broken_server.bind(socket_path + ".broken")
+                broken_server.listen(1)
+
+                def close_connection():
+                    connection, _ = broken_server.accept()
+                    connection.recv(4096)
+                    connection.close()
+
+                thread = threading.Thread(target=close_connection)
+                thread.start()
+                self.assertStdoutEqual("hello 6", lambda: run_client(socket_path + ".broken", ["--value", "a", "6", "-w", "hello {{ model.a }}"]))
+                thread.join()
+
+            # "serve" and "client" are templates for the program
+            self.assertStdoutEqual("serve", lambda: main(["serve", "-w"]))
+
+
+    def test_32(self):
+        self.assertStdoutEqual("Paperino 3 [1, 2]", lambda: main([
+            '--configFile', "config.toml",
+            '--format', 'format',
+            '--value', 'name', 'Paperino',
+            '--value', 'a.b[0].c', '3',
+            '--value', 'numbers[0]', '1',
+            '--value', 'numbers[1]', '0',
+            '--value', 'numbers[]', '2',
+            '-w',
+            "{model.name} {model.a.b[0].c} {model.numbers}"
+        ]))
+        with self.assertRaises(ValueError):
+            main(["--value", "a[x]", "3", "-w", "hello"])
+
+    def test_33(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "values.txt"), "w") as f:
+                f.write("# a comment\n\n")
+                for i in range(1000):
+                    f.write(f"persons[{i}].name=p{i}\n")
+            with open(os.path.join(tmp, "values.json"), "w") as f:
+                json.dump({"persons[-1].name": "last", "answer": 42}, f)
+            self.assertStdoutEqual("p0 p998 last 42", lambda: main([
+                '--valuesFile', os.path.join(tmp, "values.txt"),
+                '--valuesFile', os.path.join(tmp, "values.json"),
+                '-w',
+                "{{ model.persons[0].name }} {{ model.persons[998].name }} {{ model.persons[999].name }} {{ model.answer }}"
+            ]))
+
+            # objects and lists become fields and items, not plain values
+            with open(os.path.join(tmp, "nested.json"), "w") as f:
+                json.dump({"db": {"host": "h1", "ports": [80, {"number": 443}]}, "hosts": ["a", "b"], "persons[1]": {"name": "Topoli"}}, f)
+            self.assertStdoutEqual("h1 443 b c Topoli h2 5", lambda: main([
+                '--valuesFile', os.path.join(tmp, "nested.json"),
+                '--value', 'db.backup', 'h2',
+                '--value', 'hosts[2]', 'c',
+                '--value', 'db.ports[0]', '5',
+                '-w',
+                "{{ model.db.host }} {{ model.db.ports[1].number }} {{ model.hosts[1] }} {{ model.hosts[2] }} "
+                "{{ model.persons[1].name }} {{ model.db.backup }} {{ model.db.ports[0] }}"
+            ]))
+
+
+    def test_34(self):
+        values = DynamicObject()
+        person = {"name": "Pluto"}
+        values.set_fields({"person": person, "numbers": [1, 2]})
+        # reading missing keys does not change the model
+        self.assertIs(EMPTY, values.foo.bar[3])
+        self.assertEqual("None", str(values.foo.bar))
+        self.assertFalse("foo" in values)
+        with self.assertRaises(ValueError):
+            values.foo.set_value(3)
+        self.assertEqual("{person={'name': 'Pluto'}, numbers=[1, 2]}", str(values))
+        # writing inside plain values converts them into nodes, without copying them
+        set_key_path(values, parse_key_path("person.surname"), "Bianchi")
+        set_key_path(values, parse_key_path("numbers[2]"), 3)
+        self.assertIs(person, values.person._dictionary)
+        self.assertEqual("Pluto Bianchi [1, 2, 3]", f"{values.person.name} {values.person.surname} {values.numbers}")
+
+
+    def test_35(self):
+        self.assertStdoutEqual("a,None,C,d", lambda: main([
+            '--value', 'rows[2]', 'c',
+            '--value', 'rows[0]', 'a',
+            '--value', 'rows[-1]', 'C',
+            '--value', 'rows[3]', 'x',
+            '--value', 'rows[]', 'd',
+            '-w',
+            "{{ model.rows|join(',') }}"
+        ]))
+        values = DynamicObject()
+        set_key_path(values, parse_key_path("rows[1000000].x"), "v")
+        self.assertEqual("v", str(values.rows[-1].x))
+        self.assertIs(EMPTY, values.rows[10])
+        self.assertEqual(1000001, len(values.rows._list))
+        with self.assertRaises(ValueError):
+            set_key_path(values, parse_key_path("rows[-1000002]"), "v")
+
+
+    def test_36(self):
+        app_context = apply_defaults(AppContext())
+        app_context.model.values.set_field("name", "Pluto")
+        formatter = FStringFormatter(cache_size=2)
+        template = "'hello {model.name} {len(model.name)}'"
+        self.assertEqual("hello Pluto 5", template_string(app_context, template, formatter))
+        app_context.model.functions["len"] = lambda x: 42
+        self.assertEqual("hello Pluto 42", template_string(app_context, template, formatter))
+        other = AppContext()
+        other.model.values.set_field("name", "Pippo")
+        self.assertEqual("hello Pippo 42", template_string(other, "'hello {model.name} 42'", formatter))
+        with self.assertRaises(SyntaxError):
+            formatter.init_string("'{'", app_context)
+
+
+    def test_37(self):
+        app_context = apply_defaults(AppContext())
+        app_context.model.values.set_fields({"name": "Pluto", "tenant": {"name": "acme"}, "width": 8, "l": [1, 2]})
+        app_context = add_functions(app_context)
+        formatter = PythonFormatFormatter()
+        template = "{{{model.name}}} {model.tenant[name]!r:>{model.width}} {model.l[1]:03d} {math.pi:.2f} '\\"
+        self.assertEqual(template.format(model=app_context.model.values, math=math), template_string(app_context, template, formatter))
+        with self.assertRaises(KeyError):
+            template_string(app_context, "{foo.bar}", formatter)
+        with self.assertRaises(IndexError):
+            template_string(app_context, "{} {0}", formatter)
+        # builtins are not names of the template
+        for name in ("str", "open", "getattr"):
+            with self.assertRaises(KeyError):
+                template_string(app_context, f"{{{name}}}", formatter)
+        app_context.model.values.get_or_create_field("odd").set_field("a-b", 1)
+        self.assertEqual("1", template_string(app_context, "{model.odd.a-b}", formatter))
+
+
+    def test_38(self):
+        import concurrent.futures
+        import sys
+        formatter = PythonFormatter()
+        app_context = apply_defaults(AppContext())
+        formatter.init_string("for i in range(model.n):\n    print(model.name, i, end=';')\nimport sys\nprint('x', file=sys.stderr)", app_context)
+
+        def render(i: int) -> str:
+            values = DynamicObject()
+            values.set_fields({"name": f"t{i}", "n": 100})
+            return formatter.render_template(values, {}, {})
+
+        stdout = sys.stdout
+        with patch('sys.stderr', new=StringIO()):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(render, range(64)))
+        self.assertIs(stdout, sys.stdout)
+        for i, result in enumerate(results):
+            self.assertEqual("".join(f"t{i} {j};" for j in range(100)), result)
+
+
+    def test_39(self):
+        app_context = add_functions(apply_defaults(AppContext()))
+        app_context.model.values.set_field("name", "Pluto")
+        model = app_context.model
+        context = get_render_context(model.commons, model.functions)
+        self.assertIs(context, get_render_context(model.commons, model.functions))
+        # a new model (e.g., a record of a batch) does not build the context again
+        names = context.get_names(model.values)
+        self.assertIs(names, context.get_names(model.values))
+        other = DynamicObject()
+        self.assertIs(other, context.get_names(other)["model"])
+        self.assertIs(context, get_render_context(model.commons, model.functions))
+        formatter = Jinja2Formatter(persistent_environment=True)
+        self.assertEqual("1 Pluto 0,1,2 3", template_string(app_context, "{% set x = 1 %}{{ x }} {{ model.name }} {{ range(3)|join(',') }} {{ len(model.name|string) - 2 }}", formatter))
+        # variables set by a template do not leak in the shared context
+        self.assertEqual("False", template_string(app_context, "{{ x is defined }}", formatter))
+        model.functions["shout"] = lambda x: str(x).upper()
+        self.assertIsNot(context, get_render_context(model.commons, model.functions))
+        for f in (formatter, FStringFormatter(), PythonFormatFormatter()):
+            template = "{{ shout(model.name) }}" if f is formatter else "'{shout(model.name)}'" if isinstance(f, FStringFormatter) else "{shout.__name__}"
+            self.assertIn(template_string(app_context, template, f), ("PLUTO", "<lambda>"))
+        # replacing a function is seen by the next render
+        model.functions["f"] = lambda: "one"
+        self.assertEqual("one", template_string(app_context, "{{ f() }}", formatter))
+        model.functions["f"] = lambda: "two"
+        self.assertEqual("two", template_string(app_context, "{{ f() }}", formatter))
+        self.assertEqual("two", template_string(app_context, "'{f()}'", FStringFormatter()))
+        # the names extended over many globals are bounded
+        context = get_render_context(model.commons, model.functions)
+        for globals in [{} for _ in range(100)]:
+            context.get_names(model.values, globals)
+        self.assertLessEqual(len(context._extended), context.MAX_EXTENDED)
+        # formatters rendering in many threads at once, with different environments and models
+        errors = []
+
+        def render(index: int):
+            try:
+                f = Jinja2Formatter()
+                for i in range(50):
+                    values = DynamicObject()
+                    values.set_field("name", f"{index}-{i}")
+                    self.assertEqual(f"{index}-{i} 3", template_string(app_context, "{{ model.name }} {{ len('abc') }}", f, model=values))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=render, args=(index, )) for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+
+
+    def test_40(self):
+        import subprocess
+        import sys
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        script = "\n".join([
+            "import sys",
+            "from template_formatter.main import main",
+            "main(['--format', 'format', '-w', '--value', 'name', 'Pluto', 'Hello {model.name}'])",
+            "print(sorted(m for m in ('jinja2', 'toml', 'multiprocessing') if m in sys.modules))",
+        ])
+        output = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True, check=True).stdout
+        self.assertEqual("Hello Pluto\n[]\n", output)
+
+
+    def test_41(self):
+        import string
+
+        class DollarFormatter(ITemplateFormatter):
+            def __init__(self, prefix: str):
+                self.prefix = prefix
+                self.template = None
+
+            def init_string(self, s, app_context):
+                self.template = string.Template(s)
+
+            def init_file(self, f, encoding, app_context):
+                with open(f, encoding=encoding) as handle:
+                    self.template = string.Template(handle.read())
+
+            def render_template(self, model, commons, functions):
+                return self.prefix + self.template.substitute(name=model.name)
+
+            def reset(self):
+                self.template = None
+
+        local_registry = FormatterRegistry()
+        local_registry.register("json", "json:JSONDecoder")
+        self.assertIs(json.JSONDecoder, local_registry.load("json"))
+        self.assertEqual(frozenset(), local_registry.capabilities("json"))
+        with self.assertRaises(ValueError):
+            local_registry.load("not-installed")
+
+        self.assertIn("jinja2", registry.names())
+        self.assertEqual(frozenset([STREAMING, THREAD_SAFE, CACHEABLE, ASYNC]), registry.capabilities("jinja2"))
+        self.assertEqual(frozenset([THREAD_SAFE, CACHEABLE]), registry.capabilities("fstring"))
+        self.assertIsInstance(create_formatter("format"), PythonFormatFormatter)
+        registry.register("dollar", DollarFormatter, prefix="> ")
+        try:
+            self.assertStdoutEqual("> Hello Pluto", lambda: main(['--format', 'dollar', '-w', '--value', 'name', 'Pluto', 'Hello $name']))
+        finally:
+            registry.unregister("dollar")
+        with self.assertRaises(ValueError):
+            create_formatter("dollar")
+
+
+    def test_42(self):
+        app_context = apply_defaults(AppContext())
+        self.assertEqual(SEQUENTIAL, _choose_render_strategy(app_context, Jinja2Formatter()))
+        app_context.jobs = 3
+        with patch('template_formatter.main._can_fork', return_value=True):
+            self.assertEqual(PROCESSES, _choose_render_strategy(app_context, Jinja2Formatter()))
+        with patch('template_formatter.main._can_fork', return_value=False):
+            self.assertEqual(THREADS, _choose_render_strategy(app_context, FStringFormatter()))
+            self.assertEqual(SEQUENTIAL, _choose_render_strategy(app_context, object()))
+
+            with tempfile.TemporaryDirectory() as tmp:
+                for format, jobs in (("fstring", "1"), ("fstring", "3"), ("jinja2", "3")):
+                    main([
+                        '--configFile', "config.toml",
+                        "--inputDirectory", os.path.join(os.getcwd(), "input"),
+                        "--outputDirectory", os.path.join(tmp, format + jobs),
+                        '--format', format,
+                        '--jobs', jobs,
+                    ])
+                self.assertSameDirectory(os.path.join(tmp, "fstring1"), os.path.join(tmp, "fstring3"))
+                with open(os.path.join(tmp, "fstring3", "foo2", "bar-Pluto", "hello.txt")) as f:
+                    self.assertEqual("Hello Pluto!", f.read())
+
+                with open(os.path.join(tmp, "tenants.jsonl"), "w") as f:
+                    for i in range(100):
+                        f.write(json.dumps({"tenant": f"t{i}"}) + "\n")
+                main([
+                    '--configFile', "config.toml",
+                    '--batchFile', os.path.join(tmp, "tenants.jsonl"),
+                    '--batchOutput', os.path.join(tmp, "batch", "{tenant}.conf"),
+                    '--jobs', '4',
+                    "{{ model.name }} {{ model.tenant }}"
+                ])
+                self.assertEqual(100, len(os.listdir(os.path.join(tmp, "batch"))))
+                with open(os.path.join(tmp, "batch", "t42.conf")) as f:
+                    self.assertEqual("Pluto t42", f.read())
+
+
+    def test_43(self):
+        events = []
+        formatter = PythonFormatFormatter()
+        formatter.set_metrics_callback(lambda event, seconds, details: events.append((event, details)))
+        app_context = add_functions(apply_defaults(AppContext()))
+        app_context.model.values.set_field("name", "Pluto")
+        for _ in range(2):
+            self.assertEqual("Hello Pluto", template_string(app_context, "Hello {model.name}", formatter))
+        self.assertEqual([
+            ("init", {"template": "<string>", "cache_hit": False}),
+            ("render", {"template": "<string>", "characters": 11}),
+            ("init", {"template": "<string>", "cache_hit": True}),
+            ("render", {"template": "<string>", "characters": 11}),
+        ], events)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with patch('sys.stderr', new=StringIO()) as fake_err:
+                main([
+                    '--configFile', "config.toml",
+                    "--inputDirectory", os.path.join(os.getcwd(), "input"),
+                    "--outputDirectory", os.path.join(tmp, "output"),
+                    '--format', 'fstring',
+                    '--jobs', '2',
+                    '--profileReport', os.path.join(tmp, "report.json"),
+                    '--profileTrace', os.path.join(tmp, "trace.json"),
+                ])
+            self.assertIn("stage/template_directory", fake_err.getvalue())
+            with open(os.path.join(tmp, "report.json")) as f:
+                report = json.load(f)
+            output_file = os.path.join(tmp, "output", "foo2", "bar-Pluto", "hello.txt")
+            self.assertEqual(1, report["stages"]["stage/update_using_config"]["count"])
+            self.assertEqual(2, report["stages"]["stage/file"]["count"])
+            self.assertIn({"file": output_file, "seconds": next(x["seconds"] for x in report["files"] if x["file"] == output_file), "bytes": 12}, report["files"])
+            self.assertEqual(2, report["counters"]["files_written"])
+            self.assertEqual(24, report["counters"]["bytes_written"])
+            self.assertGreater(report["counters"]["cache_misses"], 0)
+            with open(os.path.join(tmp, "trace.json")) as f:
+                trace = json.load(f)
+            self.assertTrue(all(x["ph"] == "X" for x in trace["traceEvents"]))
+            self.assertIn("parse_options", map(lambda x: x["name"], trace["traceEvents"]))
+
+            with patch.dict(os.environ, {"TEMPLATE_FORMATTER_PROFILE": "1"}), patch('sys.stderr', new=StringIO()) as fake_err:
+                self.assertStdoutEqual("Hello", lambda: main(['--format', 'format', '-w', 'Hello']))
+            self.assertIn("formatter/render", fake_err.getvalue())
+
+        # events recorded by other threads while draining are not lost
+        from template_formatter.Profiler import Profiler
+        profiler = Profiler()
+        threads = [threading.Thread(target=lambda: [profiler.record("e", "test", 0, 0, {}) for _ in range(5000)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        drained = 0
+        while any(map(lambda x: x.is_alive(), threads)):
+            drained += len(profiler.drain()[0])
+        for thread in threads:
+            thread.join()
+        self.assertEqual(20000, drained + len(profiler.drain()[0]))
+
+
+    def test_44(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "config.toml"), "w") as f:
+                f.write('[general]\nformat = "format"\n\n[values]\nname = "Pluto"\n')
+            with open(os.path.join(tmp, "values.json"), "w") as f:
+                f.write('{"tenant.name": "acme", "ports[0]": 80}')
+            with open(os.path.join(tmp, "values.jsonl"), "w") as f:
+                f.write('{"tenant.region": "eu"}\n\n{"ports[1]": 443}\n')
+            cache_dir = os.path.join(tmp, "cache")
+            args = [
+                '--configFile', os.path.join(tmp, "config.toml"),
+                '--cacheDir', cache_dir,
+                '--valuesFile', os.path.join(tmp, "values.json"),
+                '--valuesFile', os.path.join(tmp, "values.jsonl"),
+                '-w',
+                "{model.name} {model.tenant.name} {model.tenant.region} {model.ports[0]} {model.ports[1]}"
+            ]
+            for _ in range(2):
+                self.assertStdoutEqual("Pluto acme eu 80 443", lambda: main(args))
+            # config.toml and values.json
+            self.assertEqual(2, len(os.listdir(cache_dir)))
+
+            if importlib.util.find_spec("yaml") is not None:
+                with open(os.path.join(tmp, "values.yaml"), "w") as f:
+                    f.write("tenant.name: acme\nports[0]: 80\n---\nports[1]: 443\n")
+                for cache in ([], ['--cacheDir', cache_dir]):
+                    self.assertStdoutEqual("acme 80 443", lambda: main(cache + ['--valuesFile', os.path.join(tmp, "values.yaml"), '--format', 'format', '-w', "{model.tenant.name} {model.ports[0]} {model.ports[1]}"]))
+                # nested mappings and sequences
+                with open(os.path.join(tmp, "nested.yaml"), "w") as f:
+                    f.write("db:\n  host: h1\n  replicas:\n    - host: h2\n---\ntenant:\n  regions: [eu, us]\n")
+                for cache in ([], ['--cacheDir', cache_dir]):
+                    self.assertStdoutEqual("h1 h2 us", lambda: main(cache + ['--valuesFile', os.path.join(tmp, "nested.yaml"), '-w', "{{ model.db.host }} {{ model.db.replicas[0].host }} {{ model.tenant.regions[1] }}"]))
+                with open(os.path.join(tmp, "nested.json"), "w") as f:
+                    f.write('{"db": {"host": "h1", "replicas": [{"host": "h2"}]}}')
+                self.assertStdoutEqual("h1 h2", lambda: main(['--cacheDir', cache_dir, '--valuesFile', os.path.join(tmp, "nested.json"), '-w', "{{ model.db.host }} {{ model.db.replicas[0].host }}"]))
+
+            # an entry is reused only if the content of the file has not changed, even if size and mtime are the same
+            stat = os.stat(os.path.join(tmp, "config.toml"))
+            with open(os.path.join(tmp, "config.toml"), "w") as f:
+                f.write('[general]\nformat = "format"\n\n[values]\nname = "Topoli"\n')
+            os.utime(os.path.join(tmp, "config.toml"), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            self.assertStdoutEqual("Topoli", lambda: main(['--configFile', os.path.join(tmp, "config.toml"), '--cacheDir', cache_dir, '-w', "{model.name}"]))
+
+
+    def test_45(self):
+        from template_formatter.FileCopier import FileCopier, COPY_MODES, HARDLINK, SKIPPED, SYMLINK
+
+        with tempfile.TemporaryDirectory() as tmp:
+            input_dir = os.path.join(tmp, "input")
+            os.makedirs(os.path.join(input_dir, "assets"))
+            content = os.urandom(300000)
+            with open(os.path.join(input_dir, "assets", "image.bin"), "wb") as f:
+                f.write(content)
+            with open(os.path.join(input_dir, "name.txt.template"), "w") as f:
+                f.write("{{ model.name }}")
+            os.symlink(os.path.join("assets", "image.bin"), os.path.join(input_dir, "link.bin"))
+            os.symlink("assets", os.path.join(input_dir, "linked_assets"))
+
+            for mode in COPY_MODES:
+                output_dir = os.path.join(tmp, mode)
+                main(['--inputDirectory', input_dir, '--outputDirectory', output_dir, '--copyMode', mode, '--value', 'name', 'Pluto'])
+                with open(os.path.join(output_dir, "assets", "image.bin"), "rb") as f:
+                    self.assertEqual(content, f.read())
+                self.assertEqual(mode == HARDLINK, os.path.samefile(os.path.join(input_dir, "assets", "image.bin"), os.path.join(output_dir, "assets", "image.bin")))
+                # links are followed by default
+                self.assertFalse(os.path.islink(os.path.join(output_dir, "link.bin")))
+                with open(os.path.join(output_dir, "link.bin"), "rb") as f:
+                    self.assertEqual(content, f.read())
+
+            output_dir = os.path.join(tmp, "symlinks")
+            main(['--inputDirectory', input_dir, '--outputDirectory', output_dir, '--preserveSymlinks', '--value', 'name', 'Pluto'])
+            self.assertEqual(os.path.join("assets", "image.bin"), os.readlink(os.path.join(output_dir, "link.bin")))
+            self.assertEqual("assets", os.readlink(os.path.join(output_dir, "linked_assets")))
+            with open(os.path.join(output_dir, "link.bin"), "rb") as f:
+                self.assertEqual(content, f.read())
+
+            for skip_identical in ("mtime", "hash"):
+                copier = FileCopier(skip_identical=skip_identical, preserve_symlinks=True)
+                output_file = os.path.join(tmp, f"{skip_identical}.bin")
+                self.assertNotEqual(SKIPPED, copier.copy(os.path.join(input_dir, "assets", "image.bin"), output_file))
+                self.assertEqual(SKIPPED, copier.copy(os.path.join(input_dir, "assets", "image.bin"), output_file))
+                self.assertEqual(SKIPPED, copier.copy(os.path.join(input_dir, "link.bin"), os.path.join(output_dir, "link.bin")))
+                # same size, different content
+                with open(output_file, "r+b") as f:
+                    f.write(b"x" if content[:1] != b"x" else b"y")
+                if skip_identical == "mtime":
+                    os.utime(output_file, ns=(0, 0))
+                self.assertNotEqual(SKIPPED, copier.copy(os.path.join(input_dir, "assets", "image.bin"), output_file))
+                with open(output_file, "rb") as f:
+                    self.assertEqual(content, f.read())
+            self.assertEqual(SYMLINK, FileCopier(preserve_symlinks=True).copy(os.path.join(input_dir, "link.bin"), os.path.join(output_dir, "link.bin")))
+
+            # an output hard linked to its input is replaced, not written through
+            output_file = os.path.join(tmp, "hardlink.bin")
+            FileCopier(HARDLINK).copy(os.path.join(input_dir, "assets", "image.bin"), output_file)
+            with open(os.path.join(tmp, "other.bin"), "wb") as f:
+                f.write(b"other")
+            FileCopier().copy(os.path.join(tmp, "other.bin"), output_file)
+            with open(os.path.join(input_dir, "assets", "image.bin"), "rb") as f:
+                self.assertEqual(content, f.read())
+
+            self.assertRaises(ValueError, lambda: FileCopier("teleport"))
+
+            # kernel copies stopping before the end of the input are completed
+            from template_formatter.FileCopier import _copy_file_range, _sendfile
+
+            def stop_after(function: Callable, count: int) -> Callable:
+                calls = []
+
+                def copy(*args):
+                    calls.append(args)
+                    return function(*args[:-1], min(args[-1], 1000)) if len(calls) <= count else 0
+                return copy
+
+            for name, copy in (("copy_file_range", _copy_file_range), ("sendfile", _sendfile)):
+                if not hasattr(os, name):
+                    continue
+                for count in (0, 3):
+                    output_file = os.path.join(tmp, f"{name}{count}.bin")
+                    with patch(f"os.{name}", stop_after(getattr(os, name), count)):
+                        with open(os.path.join(input_dir, "assets", "image.bin"), "rb") as fsrc, open(output_file, "wb") as fdst:
+                            copy(fsrc, fdst, len(content))
+                    with open(output_file, "rb") as f:
+                        self.assertEqual(content, f.read())
+
+    def test_46(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            input_dir = os.path.join(tmp, "input")
+            for path in [".git/HEAD", "node_modules/lib/index.js", "src/main.py.template", "src/debug.log", "src/keep.log",
+                         "src/build/out.o", "build/out.o", "docs/readme.md", "docs/api/index.md", "{{ model.name }}.template/a.txt"]:
+                os.makedirs(os.path.dirname(os.path.join(input_dir, path)), exist_ok=True)
+                with open(os.path.join(input_dir, path), "w") as f:
+                    f.write("{{ model.name }}")
+            with open(os.path.join(input_dir, ".templateignore"), "w") as f:
+                f.write("# generated\n/build/\nnode_modules\n*.log\n!keep.log\n")
+            with open(os.path.join(input_dir, "docs", ".templateignore"), "w") as f:
+                f.write("api/\n")
+
+            def generated(*args) -> List[str]:
+                output_dir = os.path.join(tmp, "output")
+                shutil.rmtree(output_dir, ignore_errors=True)
+                main(['--inputDirectory', input_dir, '--outputDirectory', output_dir, '--value', 'name', 'Pluto', *args])
+                result = []
+                for dir_path, _, filenames in os.walk(output_dir):
+                    result.extend(os.path.relpath(os.path.join(dir_path, f), output_dir).replace(os.sep, "/") for f in filenames)
+                return sorted(result)
+
+            self.assertEqual([".git/HEAD", "Pluto/a.txt", "docs/readme.md", "src/build/out.o", "src/keep.log", "src/main.py"], generated())
+            self.assertEqual(["Pluto/a.txt", "docs/readme.md", "src/keep.log", "src/main.py"], generated('--exclude', '.git', '--exclude', 'src/build/'))
+            self.assertEqual(["src/main.py"], generated('--include', 'src/**/*.py.template'))
+            self.assertEqual(["docs/readme.md", "src/keep.log"], generated('--include', '*.md', '--include', 'src/keep.log'))
+            # an exclude pattern cannot be overridden by a negation in an ignore file
+            self.assertEqual(["Pluto/a.txt", "docs/readme.md", "src/build/out.o", "src/main.py"], generated('--exclude', '.git/', '--exclude', '*.log'))
+
+    def test_47(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            input_dir = os.path.join(tmp, "input")
+            for module in range(3):
+                os.makedirs(os.path.join(input_dir, f"module{module}", "{{ model.name }}.template"))
+                for name in ("{{ model.name }}.txt.template", "plain.txt.template"):
+                    with open(os.path.join(input_dir, f"module{module}", "{{ model.name }}.template", name), "w") as f:
+                        f.write("{{ model.version }}")
+            output_dir = os.path.join(tmp, "output")
+            report = os.path.join(tmp, "report.json")
+            main(['--inputDirectory', input_dir, '--outputDirectory', output_dir, '--incremental', '--profileReport', report, '--value', 'name', 'Pluto', '--value', 'version', '1'])
+            for module in range(3):
+                self.assertEqual(["Pluto.txt", "plain.txt"], sorted(os.listdir(os.path.join(output_dir, f"module{module}", "Pluto"))))
+            with open(report) as f:
+                counters = json.load(f)["counters"]
+            # each name is rendered once, plain.txt is not rendered at all
+            self.assertEqual(1, counters["names_without_template"])
+            self.assertEqual(6, counters["names_reused"])
+
+            # the name of the output depends on the model
+            main(['--inputDirectory', input_dir, '--outputDirectory', output_dir, '--incremental', '--value', 'name', 'Topoli', '--value', 'version', '1'])
+            self.assertEqual(["Topoli.txt", "plain.txt"], sorted(os.listdir(os.path.join(output_dir, "module0", "Topoli"))))
+            # stale outputs have been removed
+            self.assertEqual([], os.listdir(os.path.join(output_dir, "module0", "Pluto")))
+
+            # two inputs generating the same output
+            with open(os.path.join(input_dir, "module0", "Pluto.txt.template"), "w") as f:
+                f.write("a")
+            with open(os.path.join(input_dir, "module0", "{{ model.name }}.txt.template"), "w") as f:
+                f.write("b")
+            self.assertRaises(ValueError, lambda: main(['--inputDirectory', input_dir, '--outputDirectory', output_dir, '--value', 'name', 'Pluto']))
+            # a templated file and a copied one
+            os.rename(os.path.join(input_dir, "module0", "Pluto.txt.template"), os.path.join(input_dir, "module0", "Pluto.txt"))
+            self.assertRaises(ValueError, lambda: main(['--inputDirectory', input_dir, '--outputDirectory', output_dir, '--value', 'name', 'Pluto']))
+            # nothing has been overwritten
+            self.assertFalse(os.path.exists(os.path.join(output_dir, "module0", "Pluto.txt")))
+
+    def test_48(self):
+        from template_formatter.OutputWriter import OutputWriter
+
+        with tempfile.TemporaryDirectory() as tmp:
+            output_file = os.path.join(tmp, "out.txt")
+            args = ['--format', 'format', '--outputFile', output_file, '--value', 'name', 'Pluto', "{model.name} è"]
+            main(args)
+            os.utime(output_file, ns=(0, 0))
+            # same content: the file is not touched
+            main(args)
+            self.assertEqual(0, os.stat(output_file).st_mtime_ns)
+            main(args + ['--forceWrite'])
+            self.assertNotEqual(0, os.stat(output_file).st_mtime_ns)
+            main(args[:-1] + ['--outputFileEncoding', 'latin-1', "{model.name} è"])
+            with open(output_file, "rb") as f:
+                self.assertEqual("Pluto è".encode("latin-1"), f.read())
+
+            input_dir = os.path.join(tmp, "input")
+            os.makedirs(input_dir)
+            for i in range(6):
+                with open(os.path.join(input_dir, f"{i}.txt.template"), "w") as f:
+                    f.write("{{ model.name }}" + str(i))
+            report = os.path.join(tmp, "report.json")
+            for name, jobs, written, unchanged in (("Pluto", "1", 6, None), ("Pluto", "2", None, 6), ("Topoli", "2", 6, None)):
+                main(['--inputDirectory', input_dir, '--outputDirectory', os.path.join(tmp, "output"), '--jobs', jobs, '--profileReport', report, '--value', 'name', name])
+                with open(report) as f:
+                    counters = json.load(f)["counters"]
+                self.assertEqual(written, counters.get("files_written"))
+                self.assertEqual(unchanged, counters.get("files_unchanged"))
+
+            # a failure while generating the file leaves the previous version untouched
+            writer = OutputWriter()
+
+            def chunks():
+                yield "half"
+                raise ValueError("template error")
+
+            self.assertTrue(writer.write(os.path.join(tmp, "atomic.txt"), "previous"))
+            self.assertRaises(ValueError, lambda: writer.write_stream(os.path.join(tmp, "atomic.txt"), chunks()))
+            with open(os.path.join(tmp, "atomic.txt")) as f:
+                self.assertEqual("previous", f.read())
+            self.assertFalse(writer.write_stream(os.path.join(tmp, "atomic.txt"), iter(["prev", "ious"])))
+            self.assertTrue(writer.write_stream(os.path.join(tmp, "atomic.txt"), iter(["prev", "ious", "!"])))
+            self.assertEqual({"files_written": 2, "files_unchanged": 1}, writer.get_counts())
+            self.assertFalse(any(map(lambda x: x.endswith(".tmp"), os.listdir(tmp))))
+
+            # the temporary file is created only once the content differs, and it starts with the part matched so far
+            writer.BUFFER_SIZE = 3
+            with patch("tempfile.mkstemp", wraps=tempfile.mkstemp) as mkstemp:
+                self.assertFalse(writer.write_stream(os.path.join(tmp, "atomic.txt"), iter(["pre", "vio", "us!"])))
+                self.assertEqual(0, mkstemp.call_count)
+                for pieces in (["previ", "OUS!"], ["previous!", "?"], ["prev"], ["previous", "!", "?"], [""]):
+                    self.assertTrue(writer.write_stream(os.path.join(tmp, "atomic.txt"), iter(pieces)))
+                    with open(os.path.join(tmp, "atomic.txt")) as f:
+                        self.assertEqual("".join(pieces), f.read())
+                self.assertEqual(5, mkstemp.call_count)
+            # a failure after the first difference leaves the previous version untouched as well
+            writer.write(os.path.join(tmp, "atomic.txt"), "previous")
+
+            def different_chunks():
+                yield "prev"
+                yield "IOUS"
+                raise ValueError("template error")
+
+            self.assertRaises(ValueError, lambda: writer.write_stream(os.path.join(tmp, "atomic.txt"), different_chunks()))
+            with open(os.path.join(tmp, "atomic.txt")) as f:
+                self.assertEqual("previous", f.read())
+            self.assertFalse(any(map(lambda x: x.endswith(".tmp"), os.listdir(tmp))))
+
+    def test_49(self):
+        import asyncio
+        from template_formatter.AsyncRenderer import AsyncRenderer
+
+        app_context = add_functions(apply_defaults(AppContext()))
+        app_context.model.values.set_field("name", "Pluto")
+        renderer = AsyncRenderer(app_context)
+        self.assertFalse(renderer.use_async)
+        renderer.close()
+
+        # lookups running at once, and their maximum
+        running = [0, 0]
+        # every lookup waits until "size" lookups run at once: it fails (instead of hanging) if renders are not concurrent
+        barrier = {"size": 1, "event": None}
+
+        def arm_barrier(size: int):
+            barrier.update(size=size, event=asyncio.Event())
+            running[1] = 0
+
+        async def lookup(key: str) -> str:
+            running[0] += 1
+            running[1] = max(running)
+            if running[0] >= barrier["size"]:
+                barrier["event"].set()
+            try:
+                await asyncio.wait_for(barrier["event"].wait(), 10)
+                await asyncio.sleep(0)
+            finally:
+                running[0] -= 1
+            return key
+
+        app_context.model.functions["lookup"] = lookup
+
+        with tempfile.TemporaryDirectory() as tmp:
+            input_dir = os.path.join(tmp, "input")
+            os.makedirs(os.path.join(input_dir, "{{ model.name }}.template"))
+            for i in range(20):
+                with open(os.path.join(input_dir, "{{ model.name }}.template", f"{i}.txt.template"), "w") as f:
+                    f.write("{{ lookup('" + str(i) + "') }} {{ model.name }}")
+            with open(os.path.join(input_dir, "copied.txt"), "w") as f:
+                f.write("{{ model.name }}")
+            output_dir = os.path.join(tmp, "output")
+
+            async def run():
+                async with AsyncRenderer(app_context, concurrency=5) as renderer:
+                    self.assertTrue(renderer.use_async)
+                    arm_barrier(1)
+                    self.assertEqual("a Pluto", await renderer.render_string("{{ lookup('a') }} {{ model.name }}"))
+                    # renders waiting for a lookup do not block the others
+                    arm_barrier(3)
+                    results = await asyncio.gather(*[renderer.render_string("{{ lookup(model.key) }}", model={"key": str(i)}) for i in range(3)])
+                    self.assertEqual(["0", "1", "2"], results)
+                    arm_barrier(1)
+                    chunks = [x async for x in renderer.stream_file(os.path.join(input_dir, "{{ model.name }}.template", "1.txt.template"))]
+                    self.assertEqual("1 Pluto", "".join(chunks))
+                    # the bound is reached, but never exceeded
+                    arm_barrier(5)
+                    self.assertEqual(21, await renderer.template_directory(input_dir, output_dir))
+                    self.assertLessEqual(running[1], 5)
+
+            asyncio.run(run())
+            with open(os.path.join(output_dir, "Pluto", "7.txt")) as f:
+                self.assertEqual("7 Pluto", f.read())
+            with open(os.path.join(output_dir, "copied.txt")) as f:
+                self.assertEqual("{{ model.name }}", f.read())
+
+            # a formatter rendering templates in threads
+            app_context.model.functions.pop("lookup")
+            app_context.format = "format"
+
+            async def run_sync():
+                async with AsyncRenderer(app_context) as renderer:
+                    self.assertFalse(renderer.use_async)
+                    self.assertEqual("Pluto", await renderer.render_string("{model.name}"))
+                    self.assertEqual("x" * 100000, "".join([x async for x in renderer.stream_string("x" * 100000)]))
+                    output_file = os.path.join(output_dir, "copied.txt")
+                    self.assertTrue(await renderer.write_file(os.path.join(input_dir, "copied.txt"), output_file))
+                    self.assertFalse(await renderer.write_file(os.path.join(input_dir, "copied.txt"), output_file))
+                    with open(output_file) as f:
+                        self.assertEqual("{ model.name }", f.read())
+
+            asyncio.run(run_sync())
+
+        # outside an event loop, async templates are still rendered piece by piece
+        steps = []
+
+        async def step(i: int) -> int:
+            steps.append(i)
+            return i
+
+        app_context.model.functions["step"] = step
+        chunks = template_string_stream(app_context, "{% for i in range(3) %}{{ step(i) }},{% endfor %}", Jinja2Formatter(persistent_environment=True, enable_async=True))
+        self.assertEqual("0", next(chunks))
+        self.assertEqual([0], steps)
+        self.assertEqual(",1,2,", "".join(chunks))
+        self.assertEqual([0, 1, 2], steps)
+
 
 if __name__ == '__main__':
     unittest.main()